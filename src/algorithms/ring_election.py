@@ -45,14 +45,14 @@ class RingElection(Blockchain):
     async def on_start(self):
         await asyncio.sleep(random.uniform(1.0, 3.0))
         if not self.running:
-            peer = list(self.nodes.values())[0]
+            _node_id, peer = self.neighbours[0]
             print(f'[Node {self.node_id}] Starting by selecting a node: {self.node_id_from_peer(peer)}')
             self.ez_send(peer, ElectionMessage(self.node_id))
 
     @message_wrapper(TerminationMessage)
     async def on_terminate(self, peer: Peer, _: TerminationMessage) -> None:
         if self.running:
-            _next_node_id, next_peer = [x for x in self.nodes.items() if x[1] != peer][0]
+            _next_node_id, next_peer = self.other_neighbours(peer)[0]
             self.ez_send(next_peer, TerminationMessage())
             self.running = False
             self.stop()
@@ -61,7 +61,7 @@ class RingElection(Blockchain):
     async def on_message(self, peer: Peer, payload: ElectionMessage) -> None:
         self.running = True
         # Sending it around the ring to the other peer we received it from.
-        next_node_id, next_peer = [x for x in self.nodes.items() if x[1] != peer][0]
+        next_node_id, next_peer = self.other_neighbours(peer)[0]
         print(f'[Node {self.node_id}] Got a message from with elector id: {payload.elector}')
 
         received_id = payload.elector
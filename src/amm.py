@@ -0,0 +1,120 @@
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+# balances and reserves are integers in base units, amounts in transactions are whole coins
+UNIT = 10 ** 8
+# pool fees are expressed in 1/FEE_DENOMINATOR of the input
+FEE_DENOMINATOR = 10_000
+
+
+def pair(coin_a: str, coin_b: str) -> Tuple[str, str]:
+    return (coin_a, coin_b) if coin_a < coin_b else (coin_b, coin_a)
+
+
+@dataclass
+class Pool:
+    """
+    Constant product pool of two coins, ``coin_a`` sorts before ``coin_b``.
+    """
+    coin_a: str
+    coin_b: str
+    reserve_a: int
+    reserve_b: int
+    fee: int = 30
+
+    @property
+    def invariant(self) -> int:
+        return self.reserve_a * self.reserve_b
+
+    def reserves(self, coin_in: str) -> Tuple[int, int]:
+        return (self.reserve_a, self.reserve_b) if coin_in == self.coin_a else (self.reserve_b, self.reserve_a)
+
+    def after_fee(self, amount: int) -> int:
+        return amount * (FEE_DENOMINATOR - self.fee) // FEE_DENOMINATOR
+
+    def quote(self, coin_in: str, amount: int) -> int:
+        """
+        What a single swap of ``amount`` of ``coin_in`` pays out at the current reserves.
+        """
+        reserve_in, reserve_out = self.reserves(coin_in)
+        amount = self.after_fee(amount)
+        return reserve_out * amount // (reserve_in + amount)
+
+    def settle(self, amounts_a: Sequence[int], amounts_b: Sequence[int]) -> Tuple[List[int], List[int]]:
+        """
+        Swap a batch of ``coin_a`` and ``coin_b`` inputs at one clearing price and return what each
+        input pays out, in the other coin.
+
+        Every swap gets the price ``(reserve_b + in_b) / (reserve_a + in_a)``, the inputs taken after
+        fees. Opposite swaps trade with each other and only the difference moves along the curve, which
+        keeps the product of the reserves exactly. Outputs are rounded down, so the fees and the
+        rounding stay in the pool and the invariant can only grow.
+        """
+        in_a = [self.after_fee(amount) for amount in amounts_a]
+        in_b = [self.after_fee(amount) for amount in amounts_b]
+        price_b = self.reserve_b + sum(in_b)
+        price_a = self.reserve_a + sum(in_a)
+        out_b = [amount * price_b // price_a for amount in in_a]
+        out_a = [amount * price_a // price_b for amount in in_b]
+        reserve_a = self.reserve_a + sum(amounts_a) - sum(out_a)
+        reserve_b = self.reserve_b + sum(amounts_b) - sum(out_b)
+        if reserve_a <= 0 or reserve_b <= 0 or reserve_a * reserve_b < self.invariant:
+            raise ValueError(f'settlement breaks the {self.coin_a}/{self.coin_b} invariant')
+        self.reserve_a, self.reserve_b = reserve_a, reserve_b
+        return out_b, out_a
+
+
+class AMM:
+    """
+    Constant product pools keyed by their coin pair.
+
+    Quotes never change the reserves. The swaps of a block are settled together by ``settle``,
+    one pass over the swaps to sum the inputs of every pool and direction and one to price them,
+    so the result only depends on the block and not on the order nodes see the swaps in.
+    """
+
+    def __init__(self, pools: Iterable[Pool] = ()) -> None:
+        self.pools: Dict[Tuple[str, str], Pool] = {}
+        for pool in pools:
+            self.add_pool(pool)
+
+    def add_pool(self, pool: Pool) -> None:
+        if pair(pool.coin_a, pool.coin_b) != (pool.coin_a, pool.coin_b):
+            pool.coin_a, pool.coin_b, pool.reserve_a, pool.reserve_b = \
+                pool.coin_b, pool.coin_a, pool.reserve_b, pool.reserve_a
+        self.pools[(pool.coin_a, pool.coin_b)] = pool
+
+    def pool(self, coin_in: str, coin_out: str) -> Optional[Pool]:
+        return self.pools.get(pair(coin_in, coin_out))
+
+    def quote(self, coin_in: str, coin_out: str, amount: int) -> int:
+        pool = self.pool(coin_in, coin_out)
+        return pool.quote(coin_in, amount) if pool is not None and amount > 0 else 0
+
+    def settle(self, swaps: Sequence[Tuple[str, str, int]]) -> List[int]:
+        """
+        Settle (coin_in, coin_out, amount) swaps and return their outputs, in order.
+        Every pair in ``swaps`` needs a pool.
+        """
+        batches: Dict[Tuple[str, str], Tuple[List[int], List[int]]] = {}
+        for i, (coin_in, coin_out, _) in enumerate(swaps):
+            key = pair(coin_in, coin_out)
+            batch = batches.setdefault(key, ([], []))
+            batch[0 if coin_in == key[0] else 1].append(i)
+        outputs = [0] * len(swaps)
+        for key, (sell_a, sell_b) in batches.items():
+            out_b, out_a = self.pools[key].settle([swaps[i][2] for i in sell_a], [swaps[i][2] for i in sell_b])
+            for i, amount in zip(sell_a, out_b):
+                outputs[i] = amount
+            for i, amount in zip(sell_b, out_a):
+                outputs[i] = amount
+        return outputs
+
+    def snapshot(self) -> dict:
+        return {f'{a}/{b}': [pool.reserve_a, pool.reserve_b] for (a, b), pool in self.pools.items()}
+
+    def restore(self, state: dict) -> None:
+        for key, (reserve_a, reserve_b) in state.items():
+            pool = self.pools.get(tuple(key.split('/')))
+            if pool is not None:
+                pool.reserve_a, pool.reserve_b = reserve_a, reserve_b
@@ -0,0 +1,271 @@
+# Command to run a benchmark from console
+# cd src; python benchmark.py --nodes 8 --topology sparse --txs 300 --rate 50 --output results/sparse.json
+#
+# All nodes run in this process on ipv8's mock endpoints, so no sockets are opened and a seeded run
+# always uses the same topology, the same senders and the same submission schedule.
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+from typing import Dict, List, Optional
+
+from ipv8.test.mocking.ipv8 import MockIPv8
+
+from blockchain import BlockchainNode
+from log.logging_config import setup_logging
+from mining import MiningEngine
+from topology import FAMILIES, generate
+
+TOPOLOGIES = ('sparse', 'dense') + FAMILIES
+# the degree of the families, 4 or less on small networks
+DEGREE = 4
+
+
+def build_topology(kind: str, num_nodes: int, seed: int) -> List[List[int]]:
+    """
+    Adjacency lists for ``num_nodes`` nodes: one of the topology families, where sparse is a ring with
+    random chords up to degree 4 and dense a ring with random chords up to half of the nodes.
+    """
+    if kind not in TOPOLOGIES:
+        raise ValueError(f'Unknown topology {kind}')
+    if kind == 'sparse':
+        kind, degree = 'ring-chords', DEGREE
+    elif kind == 'dense':
+        kind, degree = 'ring-chords', num_nodes // 2
+    else:
+        degree = DEGREE if kind != 'scale-free' else DEGREE // 2
+    degree = max(1, min(degree, num_nodes - 1))
+    if kind == 'random-regular' and num_nodes * degree % 2:
+        degree -= 1
+    return generate(kind, num_nodes, degree, seed)
+
+
+def percentiles(values: List[float], points=(50, 90, 99)) -> Dict[str, Optional[float]]:
+    if not values:
+        return {f'p{p}': None for p in points}
+    ordered = sorted(values)
+    return {f'p{p}': ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] for p in points}
+
+
+class BenchmarkNode(BlockchainNode):
+    """
+    BlockchainNode that records when blocks and finalized transactions reach it.
+    """
+    data_dir = None
+
+    def __init__(self, settings) -> None:
+        super().__init__(settings)
+        self.mining_engine = MiningEngine()
+        self.max_messages = float('inf')
+        self.block_times: Dict[str, float] = {}
+        self.finalized_times: Dict[str, float] = {}
+        self.duplicate_blocks = 0
+        # event loop CPU spent in message handlers, mining runs on worker threads and is reported separately
+        self.handler_cpu = 0.0
+        self.messages_sent = 0
+        self.bytes_sent = 0
+
+    def on_packet(self, packet, warn_unknown: bool = True) -> None:
+        start = time.thread_time()
+        try:
+            super().on_packet(packet, warn_unknown)
+        finally:
+            self.handler_cpu += time.thread_time() - start
+
+    def append_block(self, block):
+        if block.hash in self.block_tree:
+            self.duplicate_blocks += 1
+        else:
+            self.block_times.setdefault(block.hash, time.time())
+        return super().append_block(block)
+
+    def update_pending_finalized_txs(self, block):
+        now = time.time()
+        for tx in block.transactions:
+            self.finalized_times.setdefault(tx.tx_id, now)
+        super().update_pending_finalized_txs(block)
+
+
+class Simulation:
+    def __init__(self, num_nodes: int, topology: str, seed: int, latency: float = 0.0) -> None:
+        self.num_nodes = num_nodes
+        self.topology_name = topology
+        self.seed = seed
+        self.latency = latency
+        self.topology = build_topology(topology, num_nodes, seed)
+        self.random = random.Random(seed)
+        self.nodes: List[MockIPv8] = []
+        self.submitted: Dict[str, float] = {}
+        self.accepted = 0
+
+    @property
+    def overlays(self) -> List[BenchmarkNode]:
+        return [node.overlay for node in self.nodes]
+
+    def link(self, overlay: BenchmarkNode) -> None:
+        # count what the node sends and optionally deliver it after a fixed delay
+        endpoint = overlay.endpoint
+        send = endpoint.send
+
+        def counted_send(address, packet):
+            overlay.messages_sent += 1
+            overlay.bytes_sent += len(packet)
+            if self.latency:
+                asyncio.get_running_loop().call_later(self.latency, send, address, packet)
+            else:
+                send(address, packet)
+        endpoint.send = counted_send
+
+    async def start(self) -> None:
+        random.seed(self.seed)
+        self.nodes = [MockIPv8("medium", BenchmarkNode) for _ in range(self.num_nodes)]
+        for i, node in enumerate(self.nodes):
+            node.overlay.node_id = i
+            node.overlay.event = asyncio.Event()
+            self.link(node.overlay)
+        for i, connections in enumerate(self.topology):
+            for j in connections:
+                self.nodes[i].overlay.walk_to(self.nodes[j].endpoint.wan_address)
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            if all(len(node.overlay.get_peers()) >= len(self.topology[i]) for i, node in enumerate(self.nodes)):
+                break
+        keys = {node.my_peer.public_key.key_to_bin(): i for i, node in enumerate(self.nodes)}
+        for node in self.nodes:
+            for peer in node.overlay.get_peers():
+                node.overlay.set_node(keys[peer.public_key.key_to_bin()], peer)
+
+    async def stop(self) -> None:
+        for node in self.nodes:
+            await node.stop()
+
+    async def drive(self, txs: int, rate: float) -> float:
+        """
+        Submit ``txs`` transactions at ``rate`` per second from random nodes, returns the time it took.
+        """
+        start = time.time()
+        for k in range(txs):
+            sender = self.random.randrange(self.num_nodes)
+            receiver = self.random.choice([i for i in range(self.num_nodes) if i != sender])
+            overlay = self.nodes[sender].overlay
+            tx = overlay.send_web_transaction(receiver, self.random.randint(1, 5))
+            if tx is not None and tx.tx_id in overlay.mempool:
+                self.submitted[tx.tx_id] = time.time()
+                self.accepted += 1
+            delay = start + (k + 1) / rate - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        return time.time() - start
+
+    async def settle(self, timeout: float) -> None:
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            await asyncio.sleep(0.2)
+            if all(tx_id in overlay.mempool.finalized for overlay in self.overlays for tx_id in self.submitted):
+                break
+
+    def report(self, duration: float) -> dict:
+        overlays = self.overlays
+        first_latency, all_latency = [], []
+        finalized_everywhere = 0
+        for tx_id, submitted in self.submitted.items():
+            times = [o.finalized_times[tx_id] for o in overlays if tx_id in o.finalized_times]
+            if times:
+                first_latency.append(min(times) - submitted)
+            if len(times) == len(overlays):
+                all_latency.append(max(times) - submitted)
+                finalized_everywhere += 1
+
+        propagation = []
+        tip = overlays[0].block_tree.tip
+        for block in (overlays[0].block_tree.chain() if tip is not None else []):
+            times = [o.block_times[block.hash] for o in overlays if block.hash in o.block_times]
+            if len(times) == len(overlays):
+                propagation.append(max(times) - min(times))
+
+        return {
+            'accepted_tx_per_second': self.accepted / duration if duration else None,
+            'finalized_tx_per_second': finalized_everywhere / duration if duration else None,
+            'submitted': len(self.submitted),
+            'finalized_everywhere': finalized_everywhere,
+            'finalization_latency_first': percentiles(first_latency),
+            'finalization_latency_all': percentiles(all_latency),
+            'block_propagation': {**percentiles(propagation),
+                                  'mean': statistics.fmean(propagation) if propagation else None},
+            'duplicate_transactions': sum(o.collision_num for o in overlays),
+            'duplicate_blocks': sum(o.duplicate_blocks for o in overlays),
+            'chain_heights': [o.block_tree.height for o in overlays],
+            'tips_agree': len({o.block_tree.tip.hash if o.block_tree.tip else None for o in overlays}) == 1,
+            'nodes': [{
+                'node_id': o.node_id,
+                'degree': len(self.topology[o.node_id]),
+                'handler_cpu_seconds': o.handler_cpu,
+                'mining_seconds': o.mining_engine.seconds,
+                'hashes': o.mining_engine.hashes,
+                'messages_sent': o.messages_sent,
+                'bytes_sent': o.bytes_sent,
+            } for o in overlays],
+        }
+
+
+def git_version() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmark(nodes: int, topology: str, txs: int, rate: float, seed: int = 42,
+                        latency: float = 0.0, settle: float = 10.0) -> dict:
+    simulation = Simulation(nodes, topology, seed, latency)
+    await simulation.start()
+    try:
+        duration = await simulation.drive(txs, rate)
+        await simulation.settle(settle)
+        results = simulation.report(duration)
+    finally:
+        await simulation.stop()
+    return {
+        'version': git_version(),
+        'config': {'nodes': nodes, 'topology': topology, 'txs': txs, 'rate': rate, 'seed': seed,
+                   'latency': latency, 'settle': settle},
+        'topology': simulation.topology,
+        'results': results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run N blockchain nodes in-process and measure throughput')
+    parser.add_argument('--nodes', type=int, default=5)
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='ring')
+    parser.add_argument('--txs', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=20.0, help='submitted transactions per second')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency', type=float, default=0.0, help='one-way message delay in seconds')
+    parser.add_argument('--settle', type=float, default=10.0, help='seconds to wait for finalization after the load')
+    parser.add_argument('--output', type=str, default=None, help='write the results to this JSON file')
+    parser.add_argument('--verbose', action='store_true', help='keep the nodes\' console output')
+    args = parser.parse_args()
+
+    setup_logging()
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+        report = asyncio.run(run_benchmark(args.nodes, args.topology, args.txs, args.rate, args.seed,
+                                           args.latency, args.settle))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            f.write(output)
+        print(f'Output written to {args.output}')
+    else:
+        print(output)
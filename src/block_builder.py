@@ -0,0 +1,159 @@
+import heapq
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+SELECT_ARRIVAL = 'arrival'
+SELECT_FEE = 'fee'
+
+
+class BlockBuilder:
+    """
+    Template of the transactions for the next block, kept up to date as transactions arrive.
+
+    A block holds at most ``max_transactions`` transactions and ``max_bytes`` of serialized transactions.
+    New transactions are appended while there is room. With fee selection a full template swaps its
+    lowest-fee transaction for a new one that pays more, with arrival selection it keeps the oldest ones.
+    The template is refilled from the mempool only when the tip moves, and the transactions of a sender
+    are handed out in nonce order. It is ready to be mined once it is full or ``max_age`` seconds old.
+    When given, ``eligible`` tells which pending transactions the template may take and ``first_nonce`` the
+    nonce a sender's transactions in the next block have to start at, a block only gets the run of
+    transactions that follows it without gaps.
+    """
+
+    def __init__(self, mempool, size_of: Callable[[object], int], max_transactions: int = 500,
+                 max_bytes: int = 40_000, selection: str = SELECT_ARRIVAL, max_age: float = 2.0,
+                 eligible: Optional[Callable[[object], bool]] = None,
+                 first_nonce: Optional[Callable[[bytes], int]] = None) -> None:
+        if selection not in (SELECT_ARRIVAL, SELECT_FEE):
+            raise ValueError(f'Unknown selection {selection}')
+        self.mempool = mempool
+        self.size_of = size_of
+        self.max_transactions = max_transactions
+        self.max_bytes = max_bytes
+        self.selection = selection
+        self.max_age = max_age
+        self.eligible = eligible or (lambda tx: True)
+        self.first_nonce = first_nonce
+        self.transactions: Dict[str, object] = {}
+        self.sizes: Dict[str, int] = {}
+        self.size = 0
+        self.created = time.time()
+        self._fee_heap: List[Tuple[int, int, str]] = []
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self.transactions)
+
+    def __contains__(self, tx_id: str) -> bool:
+        return tx_id in self.transactions
+
+    @property
+    def full(self) -> bool:
+        return len(self.transactions) >= self.max_transactions or self.size >= self.max_bytes
+
+    @property
+    def ready(self) -> bool:
+        return bool(self.transactions) and (self.full or time.time() - self.created >= self.max_age)
+
+    def fits(self, size: int) -> bool:
+        return len(self.transactions) < self.max_transactions and self.size + size <= self.max_bytes
+
+    def add(self, tx) -> bool:
+        """
+        Add an eligible pending transaction if it fits or, with fee selection, outbids the cheapest one.
+        """
+        if tx.tx_id in self.transactions or not self.eligible(tx):
+            return False
+        size = self.size_of(tx)
+        if not self.transactions:
+            self.created = time.time()
+        if self.fits(size):
+            self._insert(tx, size)
+            return True
+        if self.selection != SELECT_FEE:
+            return False
+        # drop the cheapest transactions while that makes room for a better paying one
+        dropped = []
+        while self._fee_heap and not self.fits(size):
+            fee, _, tx_id = self._fee_heap[0]
+            if tx_id not in self.transactions:
+                heapq.heappop(self._fee_heap)
+                continue
+            if fee >= tx.fee:
+                break
+            heapq.heappop(self._fee_heap)
+            dropped.append(self.discard(tx_id))
+        if self.fits(size):
+            self._insert(tx, size)
+            return True
+        for old in dropped:
+            self._insert(old, self.size_of(old))
+        return False
+
+    def _insert(self, tx, size: int) -> None:
+        self.transactions[tx.tx_id] = tx
+        self.sizes[tx.tx_id] = size
+        self.size += size
+        if self.selection == SELECT_FEE:
+            heapq.heappush(self._fee_heap, (tx.fee, self._next, tx.tx_id))
+            if len(self._fee_heap) > 2 * len(self.transactions) + 64:
+                # drop the entries of transactions that left the template
+                self._fee_heap = [entry for entry in self._fee_heap if entry[2] in self.transactions]
+                heapq.heapify(self._fee_heap)
+        self._next += 1
+
+    def discard(self, tx_id: str):
+        tx = self.transactions.pop(tx_id, None)
+        if tx is not None:
+            self.size -= self.sizes.pop(tx_id)
+        return tx
+
+    def reset(self) -> None:
+        """
+        Start over from the pending transactions, e.g. after a reorg.
+        """
+        self.transactions.clear()
+        self.sizes.clear()
+        self.size = 0
+        self._fee_heap = []
+        self.fill()
+
+    def fill(self) -> None:
+        """
+        Top the template up with pending transactions, best ones first.
+        """
+        if self.full:
+            return
+        candidates = self.mempool.by_fee() if self.selection == SELECT_FEE else self.mempool
+        for tx in candidates:
+            if self.add(tx) and self.full:
+                    break
+
+    def take(self) -> List:
+        """
+        The transactions for a block, every sender's transactions in nonce order.
+        """
+        by_sender: Dict[bytes, List] = {}
+        for tx in self.transactions.values():
+            by_sender.setdefault(tx.public_key_bin, []).append(tx)
+        for public_key_bin, txs in by_sender.items():
+            txs.sort(key=lambda tx: tx.nonce)
+            if self.first_nonce is not None:
+                nonce = self.first_nonce(public_key_bin)
+                run = [tx for tx in txs if tx.nonce >= nonce]
+                end = 0
+                while end < len(run) and run[end].nonce == nonce + end:
+                    end += 1
+                txs[:] = run[:end]
+            txs.reverse()
+        # every sender keeps the slots its transactions were selected into
+        return [by_sender[tx.public_key_bin].pop() for tx in self.transactions.values()
+                if by_sender[tx.public_key_bin]]
+
+    def on_block(self, block) -> None:
+        """
+        Drop the transactions a new canonical block included and refill the template.
+        """
+        for tx in block.transactions:
+            self.discard(tx.tx_id)
+        self.fill()
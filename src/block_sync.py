@@ -0,0 +1,180 @@
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Set
+
+from block_tree import GENESIS_HASH
+
+
+@dataclass
+class RangeRequest:
+    start: int
+    end: int
+    peer: object = None
+    deadline: float = 0.0
+    attempts: int = 0
+    failed: Set = field(default_factory=set)
+
+
+class BlockSync:
+    """
+    Headers-first catch-up for a node that fell behind.
+
+    The node first asks one peer for the headers above its tip, then splits the missing block numbers
+    into ranges of ``range_size`` and requests them from all connected peers at once, with at most
+    ``max_in_flight`` ranges per peer. Ranges that are not answered within ``timeout`` seconds are
+    retried with another peer, up to ``max_attempts`` times.
+    """
+
+    def __init__(self, node, range_size: int = 50, max_in_flight: int = 2, timeout: float = 5.0,
+                 max_attempts: int = 3, max_headers: int = 200) -> None:
+        self.node = node
+        self.range_size = range_size
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.max_headers = max_headers
+        self.target = 0
+        self.headers: Dict[int, str] = {}
+        self.queue: Deque[RangeRequest] = deque()
+        self.in_flight: Dict[int, RangeRequest] = {}
+        self.header_peer = None
+        self.header_deadline = 0.0
+        self.round_tip = 0
+        # responses whose blocks are still being validated
+        self.processing = 0
+
+    @property
+    def syncing(self) -> bool:
+        return self.target > self.tip_number
+
+    @property
+    def tip_number(self) -> int:
+        tip = self.node.block_tree.tip
+        return tip.number if tip is not None else 0
+
+    def known(self, block_hash: str) -> bool:
+        store = self.node.store
+        return (block_hash == GENESIS_HASH or block_hash in self.node.block_tree
+                or (store is not None and block_hash in store))
+
+    def start(self, peer, target: int) -> None:
+        """
+        Catch up to block ``target``, which ``peer`` announced.
+        """
+        if target <= max(self.tip_number, self.target):
+            return
+        self.target = target
+        if self.header_peer is None and not self.queue and not self.in_flight:
+            self.request_headers(peer, self.tip_number + 1)
+        if not self.node.is_pending_task_active("block_sync"):
+            self.node.register_task("block_sync", self.tick, interval=1.0, delay=1.0)
+
+    def stop(self) -> None:
+        self.target = 0
+        self.headers.clear()
+        self.queue.clear()
+        self.in_flight.clear()
+        self.header_peer = None
+        self.node.cancel_pending_task("block_sync")
+
+    def request_headers(self, peer, start: int) -> None:
+        count = min(self.target - start + 1, self.max_headers)
+        self.round_tip = self.tip_number
+        self.header_peer = peer
+        self.header_deadline = time.time() + self.timeout
+        self.node.ez_send(peer, self.node.create_headers_request(start, count))
+
+    def on_headers(self, peer, start: int, headers: List) -> None:
+        if peer != self.header_peer:
+            return
+        self.header_peer = None
+        if not headers:
+            self.stop()
+            return
+        first = headers[0]
+        if not self.known(first.prev_block_hash) and start > 1:
+            # the peer's chain forked below our tip, look further back
+            self.request_headers(peer, max(1, start - self.range_size))
+            return
+
+        for header in headers:
+            self.headers[header.number] = header.hash
+        last = headers[-1].number
+        self.target = max(self.target, last)
+        for range_start in range(start, last + 1, self.range_size):
+            self.queue.append(RangeRequest(range_start, min(range_start + self.range_size - 1, last)))
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        peers = list(self.node.get_peers())
+        if not peers:
+            return
+        load = {peer: 0 for peer in peers}
+        for request in self.in_flight.values():
+            if request.peer in load:
+                load[request.peer] += 1
+        while self.queue:
+            # retries go to a peer that did not fail this range before, if there is one
+            candidates = [p for p in load if p not in self.queue[0].failed] or list(load)
+            peer = min(candidates, key=load.get)
+            if load[peer] >= self.max_in_flight:
+                break
+            request = self.queue.popleft()
+            request.peer = peer
+            request.deadline = time.time() + self.timeout
+            request.attempts += 1
+            self.in_flight[request.start] = request
+            load[peer] += 1
+            self.node.ez_send(peer, self.node.create_blocks_request(self.node.node_id, request.start, request.end))
+
+    async def on_blocks(self, peer, start: int, end: int, blocks: List) -> None:
+        request = self.in_flight.get(start)
+        if request is None or request.peer != peer:
+            return
+        del self.in_flight[start]
+        if end < request.end:
+            # the rest of the range follows in the next response
+            request.start = end + 1
+            request.deadline = time.time() + self.timeout
+            self.in_flight[request.start] = request
+        self.dispatch()
+
+        self.processing += 1
+        try:
+            for block in blocks:
+                expected = self.headers.get(block.number)
+                if expected is not None and expected != block.hash:
+                    continue
+                await self.node.process_block(peer, block)
+        finally:
+            self.processing -= 1
+        self.finish_if_done()
+
+    def finish_if_done(self) -> None:
+        if self.queue or self.in_flight or self.header_peer is not None or self.processing:
+            return
+        if self.syncing and self.tip_number > self.round_tip:
+            # more blocks appeared while we were downloading
+            peers = list(self.node.get_peers())
+            if peers:
+                self.request_headers(peers[0], self.tip_number + 1)
+                return
+        self.stop()
+
+    def tick(self) -> None:
+        now = time.time()
+        if self.header_peer is not None and now > self.header_deadline:
+            peers = [p for p in self.node.get_peers() if p != self.header_peer] or list(self.node.get_peers())
+            self.header_peer = None
+            if peers:
+                self.request_headers(peers[0], self.tip_number + 1)
+        for start, request in list(self.in_flight.items()):
+            if now <= request.deadline:
+                continue
+            del self.in_flight[start]
+            request.failed.add(request.peer)
+            if request.attempts < self.max_attempts:
+                self.queue.append(request)
+        self.dispatch()
+        self.finish_if_done()
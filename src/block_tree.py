@@ -0,0 +1,254 @@
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional
+
+from difficulty import bits_to_target
+
+# prev_block_hash of the first block of a chain
+GENESIS_HASH = '0'
+# a block has to be newer than the median time of this many blocks before it
+MEDIAN_TIME_BLOCKS = 11
+
+
+def block_work(block) -> int:
+    """
+    Expected number of hashes needed to mine ``block``.
+    """
+    return 2 ** 256 // (bits_to_target(block.bits) + 1)
+
+
+@dataclass(eq=False)
+class BlockNode:
+    block: object
+    parent: Optional['BlockNode']
+    depth: int
+    work: int
+
+    @property
+    def hash(self) -> str:
+        return self.block.hash
+
+
+@dataclass
+class ChainUpdate:
+    # blocks that became part of the canonical chain, oldest first
+    connected: List = field(default_factory=list)
+    # blocks that left the canonical chain, newest first
+    disconnected: List = field(default_factory=list)
+    added: bool = False
+    orphan: bool = False
+    # blocks that turned out to be invalid when they were about to connect, they left the tree
+    invalid: List = field(default_factory=list)
+
+    @property
+    def reorg(self) -> bool:
+        return bool(self.disconnected)
+
+
+class BlockTree:
+    """
+    Index of every known block by hash with parent pointers and the cumulative work per block.
+
+    The canonical chain is kept as a list indexed by depth, so extending the best tip, detecting a
+    reorg and looking up a block by height only touch the blocks that actually changed.
+    Blocks whose parent is still unknown wait in the orphan pool until the parent is inserted.
+    """
+
+    def __init__(self, max_orphans: int = 1000) -> None:
+        self.nodes: Dict[str, BlockNode] = {}
+        self.orphans: Dict[str, Dict[str, object]] = OrderedDict()
+        self.orphan_count = 0
+        self.max_orphans = max_orphans
+        self.tips: Dict[str, BlockNode] = {}
+        self.best: Optional[BlockNode] = None
+        self.canonical: List[BlockNode] = []
+
+    def __contains__(self, block_hash: str) -> bool:
+        return block_hash in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def tip(self):
+        return self.best.block if self.best else None
+
+    @property
+    def height(self) -> int:
+        """
+        Number of the best tip, which also counts the blocks below an anchored tree.
+        """
+        return self.best.block.number if self.best else 0
+
+    @property
+    def fork_count(self) -> int:
+        return len(self.tips)
+
+    def get(self, block_hash: str):
+        node = self.nodes.get(block_hash)
+        return node.block if node else None
+
+    def is_canonical(self, block_hash: str) -> bool:
+        node = self.nodes.get(block_hash)
+        return node is not None and self._is_canonical(node)
+
+    def _is_canonical(self, node: BlockNode) -> bool:
+        return node.depth < len(self.canonical) and self.canonical[node.depth] is node
+
+    def median_time(self, block_hash: str, count: int = MEDIAN_TIME_BLOCKS) -> Optional[int]:
+        """
+        Median time of ``block_hash`` and up to ``count - 1`` of its ancestors, or None if the block is unknown.
+        """
+        node = self.nodes.get(block_hash)
+        if node is None:
+            return None
+        times = []
+        while node is not None and len(times) < count:
+            times.append(node.block.time)
+            node = node.parent
+        times.sort()
+        return times[len(times) // 2]
+
+    def block_at(self, number: int):
+        """
+        Canonical block with the given block number, or None.
+        """
+        if not self.canonical:
+            return None
+        depth = number - self.canonical[0].block.number
+        if 0 <= depth < len(self.canonical):
+            return self.canonical[depth].block
+        return None
+
+    def chain(self, start: int = 0) -> Iterator:
+        """
+        Walk the canonical chain from depth ``start`` up to the best tip.
+        """
+        for node in self.canonical[start:]:
+            yield node.block
+
+    def missing_parents(self) -> List[str]:
+        return list(self.orphans)
+
+    def anchor(self, block) -> None:
+        """
+        Start an empty tree at ``block`` without knowing its parent, e.g. the oldest block loaded from disk.
+        """
+        if self.nodes:
+            raise ValueError('Only an empty block tree can be anchored')
+        node = self._connect(block)
+        node.parent = None
+        self.best = node
+        self.canonical = [node]
+
+    def prune(self, keep: int) -> int:
+        """
+        Forget the canonical blocks more than ``keep`` blocks below the best tip and the forks that branch
+        off below them, the oldest block left becomes the anchor. Returns the number of blocks dropped.
+        """
+        cut = len(self.canonical) - keep
+        if cut <= 0:
+            return 0
+        root = self.canonical[cut]
+        kept = {root.hash}
+        # children are always connected after their parent
+        for node in self.nodes.values():
+            if node.parent is not None and node.parent.hash in kept:
+                kept.add(node.hash)
+        dropped = len(self.nodes) - len(kept)
+        self.nodes = {block_hash: node for block_hash, node in self.nodes.items() if block_hash in kept}
+        self.tips = {block_hash: node for block_hash, node in self.tips.items() if block_hash in kept}
+        root.parent = None
+        for node in self.nodes.values():
+            node.depth -= cut
+        del self.canonical[:cut]
+        return dropped
+
+    def insert(self, block) -> ChainUpdate:
+        """
+        Add ``block`` to the tree and move the best tip if it now has the most cumulative work.
+        """
+        if block.hash in self.nodes or block.hash in self.orphans.get(block.prev_block_hash, ()):
+            return ChainUpdate()
+        if block.prev_block_hash != GENESIS_HASH and block.prev_block_hash not in self.nodes:
+            self._add_orphan(block)
+            return ChainUpdate(added=True, orphan=True)
+
+        best = self.best
+        pending = [block]
+        while pending:
+            node = self._connect(pending.pop())
+            if best is None or node.work > best.work:
+                best = node
+            children = self.orphans.pop(node.hash, {})
+            self.orphan_count -= len(children)
+            pending.extend(children.values())
+
+        update = ChainUpdate(added=True)
+        if best is not self.best:
+            self._set_best(best, update)
+        return update
+
+    def remove(self, block_hash: str) -> ChainUpdate:
+        """
+        Drop an invalid block together with the blocks built on it and the orphans waiting for them.
+        A canonical block cuts the canonical chain back to its parent, the returned update moves the
+        chain from there to the best remaining tip.
+        """
+        node = self.nodes.get(block_hash)
+        if node is None:
+            return ChainUpdate()
+        removed = {block_hash}
+        # children are always connected after their parent
+        for other in self.nodes.values():
+            if other.parent is not None and other.parent.hash in removed:
+                removed.add(other.hash)
+        for removed_hash in removed:
+            del self.nodes[removed_hash]
+            self.tips.pop(removed_hash, None)
+            self.orphan_count -= len(self.orphans.pop(removed_hash, {}))
+        parent = node.parent
+        if parent is not None and not any(other.parent is parent for other in self.nodes.values()):
+            self.tips[parent.hash] = parent
+        if self._is_canonical(node):
+            del self.canonical[node.depth:]
+            self.best = self.canonical[-1] if self.canonical else None
+
+        update = ChainUpdate()
+        best = max(self.tips.values(), key=lambda tip: tip.work, default=None)
+        if best is not None and (self.best is None or best.work > self.best.work):
+            self._set_best(best, update)
+        return update
+
+    def _connect(self, block) -> BlockNode:
+        parent = self.nodes.get(block.prev_block_hash)
+        if parent is None:
+            node = BlockNode(block, None, 0, block_work(block))
+        else:
+            node = BlockNode(block, parent, parent.depth + 1, parent.work + block_work(block))
+            self.tips.pop(parent.hash, None)
+        self.nodes[block.hash] = node
+        self.tips[block.hash] = node
+        return node
+
+    def _add_orphan(self, block) -> None:
+        self.orphans.setdefault(block.prev_block_hash, {})[block.hash] = block
+        self.orphan_count += 1
+        while self.orphan_count > self.max_orphans:
+            _, dropped = self.orphans.popitem(last=False)
+            self.orphan_count -= len(dropped)
+
+    def _set_best(self, best: BlockNode, update: ChainUpdate) -> None:
+        # walk back from the new tip until we meet the canonical chain
+        connected = []
+        node = best
+        while node is not None and not self._is_canonical(node):
+            connected.append(node)
+            node = node.parent
+        keep = node.depth + 1 if node is not None else 0
+
+        update.disconnected = [n.block for n in reversed(self.canonical[keep:])]
+        update.connected = [n.block for n in reversed(connected)]
+        del self.canonical[keep:]
+        self.canonical.extend(reversed(connected))
+        self.best = best
@@ -1,33 +1,48 @@
-import copy
+import asyncio
 import hashlib
+import os
 import random
-from binascii import hexlify
-from collections import defaultdict
 from dataclasses import dataclass
 import time
-from decimal import Decimal
+from typing import List, Optional
 
 from ipv8.community import CommunitySettings
 from ipv8.messaging.payload_dataclass import overwrite_dataclass
-from ipv8.types import Peer
+from ipv8.types import MessageHandlerFunction, Peer
 
 from algorithms.echo_algorithm import *
 from algorithms.ring_election import *
 
-from da_types import Blockchain, message_wrapper
-from merkle_util import merkle_root, merkle_proof
+from da_types import AnyPayload, Blockchain, message_wrapper
+from block_builder import BlockBuilder
+from block_tree import GENESIS_HASH, BlockTree, ChainUpdate
+from amm import UNIT
+from ledger import SWAP_TARGET, Ledger
+from events import EventBus
+from mempool import Mempool
+from nonce_index import NonceIndex
+from query_cache import QueryCache
+from storage import BlockStore
+from block_sync import BlockSync
+from gossip import Gossip
+from validation import BlockValidator
+from merkle_util import MerkleTree
+from metrics import NodeMetrics
+from difficulty import Retarget, bits_to_target, difficulty, target_to_bits
+from mining import MiningEngine, MiningJob, ProcessPoolMiningEngine
+from verification import SignatureVerifier
+from wire import KEY_HASH_SIZE, UnknownKeyError, WireCodec, block_size, bytes_to_hash, encode_header, \
+    encode_transaction_fields, hash_to_bytes, transaction_size
 from log.logging_config import *
 
 
-# Create logger
-# setup_logging()
-#
-#
-# logger = logging.getLogger('my_app')
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', filename='./log/app.log',)
 # We are using a custom dataclass implementation.
 dataclass = overwrite_dataclass(dataclass)
 
+# fields in the cached encoding of a transaction
+SIGNED_FIELDS = frozenset(('sender', 'receiver', 'is_uniswap', 'coin', 'amount', 'nonce', 'fee'))
+
+
 @dataclass(
     msg_id=1
 )
@@ -41,8 +56,31 @@ class Transaction:
     signature: bytes
     tx_id: str
     nonce: int
+    fee: int = 0
     ttl: int = 3
 
+    def compute_tx_id(self) -> str:
+        # the id commits to everything that is signed and to the signature, so the Merkle root of a block
+        # and the ids used to relay and deduplicate transactions cover their whole content
+        return hashlib.sha256(self.get_signing_bytes() + self.signature).hexdigest()
+
+    def __setattr__(self, name, value):
+        # drop the cached encoding when a field it covers changes
+        if name in SIGNED_FIELDS:
+            self.__dict__.pop('encoded_fields', None)
+        super().__setattr__(name, value)
+
+    def get_encoded_fields(self) -> bytes:
+        # packed once and shared by signing, verifying and sending
+        encoded = self.__dict__.get('encoded_fields')
+        if encoded is None:
+            encoded = self.encoded_fields = encode_transaction_fields(self)
+        return encoded
+
+    def get_signing_bytes(self) -> bytes:
+        # the signature covers everything but itself, the ttl and the tx_id, which is a hash of the signed content
+        return self.public_key_bin + self.get_encoded_fields()
+
     # def __post_init__(self):
     #     self.tx_id = hashlib.sha256(f'{self.sender}{self.receiver}{self.amount}{self.nonce}'.encode()).hexdigest()
 
@@ -54,30 +92,63 @@ class Block:
     number: int
     prev_block_time: int
     prev_block_hash: str
-    difficulty: str
-    puzzle_target: str
+    # compact form of the target the block hash has to stay below
+    bits: int
     transactions: list[Transaction]
     time: int
     hash: str
     nonce: int
+    merkle_root: bytes = b''
+    # public key of the miner, it is part of the hashed header
+    miner: bytes = b''
 
     def __post_init__(self):
         # self.hash = 0
         # self.time = 0
         # self.nonce = 0
         self.hashing_value = ""
+        self.merkle_tree = None
+        self.target = None
+        self.encoded_header = None
 
     def get_hashing_value(self, public_key_bin):
         # fix bug: 'Transaction' object has no attribute 'tx_id'
-        return "".join([tx.tx_id for tx in self.transactions]) + str(self.nonce) + str(self.number) + str(public_key_bin)
+        prefix, suffix = self.get_hashing_parts(public_key_bin)
+        return (prefix + str(self.nonce).encode() + suffix).decode()
+
+    def get_hashing_parts(self, public_key_bin) -> tuple[bytes, bytes]:
+        # the hashing value is prefix + nonce + suffix, so miners can hash the prefix only once,
+        # it covers the parent, the times and the target so the proof of work cannot be reused on
+        # another chain and the times, which the retarget depends on, cannot be changed in transit
+        prefix = (f'{self.prev_block_hash}{self.prev_block_time:016x}{self.time:016x}{self.bits:08x}'
+                  f'{self.merkle_root.hex()}').encode()
+        return prefix, (str(self.number) + str(public_key_bin)).encode()
+
+    def get_encoded_header(self) -> bytes:
+        # blocks are only sent once they are mined, after that the header does not change
+        if getattr(self, 'encoded_header', None) is None:
+            self.encoded_header = encode_header(self)
+        return self.encoded_header
+
+    def get_target(self) -> int:
+        if getattr(self, 'target', None) is None:
+            self.target = bits_to_target(self.bits)
+        return self.target
+
+    def get_merkle_tree(self) -> MerkleTree:
+        # only cached for blocks that do not change anymore, use compute_merkle_root while building
+        # (received payloads are created without __post_init__)
+        if getattr(self, 'merkle_tree', None) is None:
+            self.merkle_tree = MerkleTree(bytes.fromhex(tx.tx_id) for tx in self.transactions)
+        return self.merkle_tree
+
+    def compute_merkle_root(self) -> bytes:
+        return MerkleTree(bytes.fromhex(tx.tx_id) for tx in self.transactions).root
 
     def add_transaction(self, transaction: Transaction) -> bool:
-        if len(self.transactions) < 3:
-            if transaction not in self.transactions:
-                self.transactions.append(transaction)
-            return True
-        else:
-            return False
+        # limits and duplicates are handled by the BlockBuilder
+        self.transactions.append(transaction)
+        return True
 
     # def mine(self):
     #     now = time.time()
@@ -113,6 +184,100 @@ class BlocksRequest:
             f'{self.sender}{self.start_block_number}{self.end_block_number}'.encode()).hexdigest()
 
 
+@dataclass(
+    msg_id=4
+)
+class BlocksResponse:
+    # one batch of a requested range, a range that does not fit in one message is split over several
+    start_block_number: int
+    end_block_number: int
+    # the blocks in the wire encoding
+    blocks: bytes
+
+
+@dataclass
+class BlockHeader:
+    number: int
+    hash: str
+    prev_block_hash: str
+
+
+@dataclass(
+    msg_id=5
+)
+class HeadersRequest:
+    start_block_number: int
+    count: int
+
+
+@dataclass(
+    msg_id=6
+)
+class HeadersResponse:
+    start_block_number: int
+    headers: list[BlockHeader]
+
+
+@dataclass(
+    msg_id=7
+)
+class Inventory:
+    # concatenated raw 32-byte hashes
+    ttl: int
+    tx_hashes: bytes
+    block_hashes: bytes
+
+
+@dataclass(
+    msg_id=8
+)
+class GetData:
+    tx_hashes: bytes
+    block_hashes: bytes
+
+
+@dataclass(
+    msg_id=9
+)
+class CompactBlock:
+    # a block header in the wire encoding and only the ids of its transactions, the receiver takes
+    # them from its mempool
+    header: bytes
+    tx_ids: bytes
+
+
+@dataclass(
+    msg_id=10
+)
+class GetBlockTransactions:
+    block_hash: bytes
+    tx_hashes: bytes
+
+
+@dataclass(
+    msg_id=11
+)
+class BlockTransactions:
+    block_hash: bytes
+    transactions: bytes
+
+
+@dataclass(
+    msg_id=12
+)
+class Transactions:
+    # transactions in the wire encoding
+    transactions: bytes
+
+
+@dataclass(
+    msg_id=13
+)
+class MissingKeys:
+    # concatenated key hashes the receiver of a message could not resolve
+    key_hashes: bytes
+
+
 # class LiquidityPool:
 #     def __init__(self):
 #         self.pools = {'BTC': 10000, 'ETH': 100000}
@@ -165,120 +330,186 @@ class BlocksRequest:
 
 
 class BlockchainNode(Blockchain):
+    # upper bound for the blocks packed into one BlocksResponse, well below the UDP datagram limit
+    max_message_size = 50_000
+    # every node stores its chain in data_dir/node<node_id>, None keeps everything in memory
+    data_dir = './data'
+    snapshot_interval = 50
+    # canonical blocks loaded into the block tree on restart, older ones are read from the store
+    restore_depth = 100
+
     def __init__(self, settings: CommunitySettings) -> None:
         self.logger = logging.getLogger(__name__)
+        # before the Community registers its handlers, every handler is timed
+        self.metrics = NodeMetrics(self)
 
         super().__init__(settings)
         self.counter = 1
         self.max_messages = 15
         self.executed_checks = 0
 
-        self.pending_txs: list[Transaction] = []
-        self.finalized_txs: list[Transaction] = []
-        self.balances = defaultdict(lambda:  {'BTC': 100, 'ETH': 1000})
-        self.pools = {'BTC': 10000, 'ETH': 100000}
-        self.c = self.pools["BTC"] * self.pools["ETH"]
-        self.blocks: list[Block] = []
-        self.longest_chain: list[Block] = []
+        # evicted transactions leave the template and the nonce buffer with the mempool
+        self.mempool = Mempool(on_evict=lambda tx: self.drop_transactions([tx]))
+        self.nonces = NonceIndex()
+        # new transactions and canonical blocks, streamed to the web API
+        self.events = EventBus()
+        self.queries = QueryCache(self)
+        self.ledger = Ledger()
+        self.block_tree = BlockTree()
+        self.store: Optional[BlockStore] = None
+        self.snapshot_depth = 0
         self.collision_num: int = 0
 
-        self.difficulty: str = "13"
+        self.mining_engine: MiningEngine = ProcessPoolMiningEngine()
+        self.verifier = SignatureVerifier(self.crypto)
+        self.block_sync = BlockSync(self)
+        self.gossip = Gossip(self)
+        self.validator = BlockValidator(self)
+        self.wire = WireCodec(Transaction, Block)
+        # received blocks are validated and inserted one at a time, in arrival order
+        self.block_lock = asyncio.Lock()
+
+        # the first blocks need about 2^13 hashes, the window retargets towards target_block_time
         self.target_block_time = 3
-        self.puzzle_target = self.calculate_puzzle_target()
-        self.curr_block = self.create_current_block()
-        # Block(1, int(time.time()), '0', str(self.difficulty), str(self.puzzle_target), [],  int(time.time()), '0')
+        self.retarget = Retarget(target_to_bits(2 ** 243), self.target_block_time)
+        self.builder = BlockBuilder(self.mempool, transaction_size, eligible=self.is_minable,
+                                    first_nonce=self.nonces.next_confirmed)
+        # the block that is being mined, if any
+        self.curr_block: Optional[Block] = None
 
         # add structure to storing transactions in blocks
         self.key_pair = self.crypto.generate_key("medium")
-        self.add_message_handler(Transaction, self.on_transaction)
+        self.add_message_handler(Transactions, self.on_transactions)
+        self.add_message_handler(MissingKeys, self.on_missing_keys)
         self.add_message_handler(Block, self.on_block)
         self.add_message_handler(BlocksRequest, self.on_blocks_request)
+        self.add_message_handler(BlocksResponse, self.on_blocks_response)
+        self.add_message_handler(HeadersRequest, self.on_headers_request)
+        self.add_message_handler(HeadersResponse, self.on_headers_response)
+        self.add_message_handler(Inventory, self.on_inventory)
+        self.add_message_handler(GetData, self.on_get_data)
+        self.add_message_handler(CompactBlock, self.on_compact_block)
+        self.add_message_handler(GetBlockTransactions, self.on_get_block_transactions)
+        self.add_message_handler(BlockTransactions, self.on_block_transactions)
+
+
+    def add_message_handler(self, msg_num: int | type[AnyPayload], callback: MessageHandlerFunction) -> None:
+        super().add_message_handler(msg_num, self.metrics.time_handler(callback))
+
+    async def started(self, node_id, connections, event, use_localhost=True) -> None:
+        # from now on our records also go to this node's own log file
+        self.logger = NodeLogger(__name__, node_id)
+        await super().started(node_id, connections, event, use_localhost)
+        if self.data_dir is not None:
+            self.open_store(os.path.join(self.data_dir, f'node{node_id}'))
+
+    def open_store(self, path: str) -> None:
+        start = time.time()
+        self.store = BlockStore(path, self.serializer.pack_serializable,
+                                lambda data: self.serializer.unpack_serializable(Block, data)[0])
+        height = self.store.height
+        if height == 0:
+            return
 
-
-    def create_block(self):
-        self.calculate_difficulty()
-        self.calculate_puzzle_target()
-        self.curr_block = Block(prev_block_hash=self.blocks[-1].hash,
-                                prev_block_time=self.blocks[-1].time,
-                                difficulty=str(self.difficulty),
-                                puzzle_target=self.puzzle_target,
-                                transactions=[],
-                                number=self.blocks[-1].number + 1,
-                                time=int(time.time()),
-                                hash='0',
-                                nonce=0)
-
-    def create_current_block(self):
-        try:
-            self.calculate_difficulty()
-            self.calculate_puzzle_target()
-        except:
-            pass
-        return Block(1, int(time.time()), '0', self.difficulty, self.puzzle_target, [], int(time.time()), '0',
-                     0)
-
-    def calculate_difficulty(self):
-        if len(self.blocks) > 1:
-            avg_block_time = (self.blocks[-1].time - self.blocks[0].time) / len(self.blocks)
-        else:
-            avg_block_time = self.target_block_time  # Fallback to target block time if not enough blocks
-
-        # Calculate difficulty as base-2 logarithm
-        current_difficulty_log = Decimal(self.difficulty)
-        if avg_block_time < self.target_block_time:
-            new_difficulty_log = current_difficulty_log + Decimal('0.13750352375')  # Approximation for log2(1.1)
-        else:
-            new_difficulty_log = current_difficulty_log - Decimal('0.13750352375')  # Approximation for log2(0.9)
-
-        # Convert the new difficulty back to string for consistency with existing code
-        self.difficulty = str(new_difficulty_log)
-        print(f'Node {self.node_id} difficulty log2: {new_difficulty_log}')
-
-
-    def calculate_puzzle_target(self):
-        # Max value in log scale
-        max_value_log = Decimal(256)  # Equivalent to log2(2^256)
-
-        # Calculate target as difference from max value
-        current_difficulty_log = Decimal(self.difficulty)
-        new_puzzle_target_log = max_value_log - current_difficulty_log
-
-        # Store and return the puzzle target in log scale
-        self.puzzle_target = str(new_puzzle_target_log)
-        try:
-            print(f'Node {self.node_id} puzzle target log2: {new_puzzle_target_log}')
-        except:
-            pass
-        return self.puzzle_target
+        depth, state = self.store.load_snapshot()
+        if state is not None and depth > 0 and self.store.block_at_depth(depth - 1).hash != state['ledger']['tip']:
+            # the snapshot belongs to a chain that was reorganized away
+            depth, state = 0, None
+        if state is not None:
+            self.ledger.restore(state['ledger'])
+            self.nonces.restore(state.get('nonces', {}))
+        replayed = self.store.chain(depth)
+        self.ledger.replay(replayed)
+        for block in replayed:
+            self.nonces.confirm(block)
+        # keep numbering our transactions after the ones already on the chain
+        self.counter = max(self.counter, self.nonces.next_nonce(self.my_peer.public_key.key_to_bin()))
+        self.snapshot_depth = depth
+
+        blocks = self.store.chain(height - self.restore_depth)
+        self.block_tree.anchor(blocks[0])
+        for block in blocks[1:]:
+            self.block_tree.insert(block)
+        for block in blocks:
+            self.update_pending_finalized_txs(block)
+        self.retarget.reset(blocks[-self.retarget.window:])
+        self.builder.reset()
+        self.queries.rebuild()
+        self.logger.info(f'Node {self.node_id} restored {height} blocks from {path} '
+                         f'(snapshot at {depth}) in {time.time() - start:.3f}s')
+
+    def save_snapshot(self) -> None:
+        self.store.save_snapshot(self.store.height, {'ledger': self.ledger.snapshot(), 'nonces': self.nonces.snapshot()})
+        self.snapshot_depth = self.store.height
+
+    def get_block_at(self, number: int) -> Optional[Block]:
+        block = self.block_tree.block_at(number)
+        if block is None and self.store is not None and self.block_tree.canonical:
+            # blocks below the tree's oldest block are only on disk
+            first = self.block_tree.canonical[0]
+            if number < first.block.number:
+                block = self.store.block_at_depth(self.store.height - len(self.block_tree.canonical) + number - first.block.number)
+        return block
+
+    def create_block(self) -> Block:
+        tip = self.block_tree.tip
+        now = int(time.time())
+        block = Block(prev_block_hash=tip.hash if tip else GENESIS_HASH,
+                      prev_block_time=tip.time if tip else now,
+                      bits=self.retarget.next_bits(),
+                      transactions=self.select_transactions(),
+                      number=tip.number + 1 if tip else 1,
+                      # the time is hashed, it has to be after the median time of the blocks before it
+                      time=max(now, self.block_tree.median_time(tip.hash) + 1) if tip else now,
+                      hash='0',
+                      nonce=0)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('Node %s difficulty: %.0f', self.node_id, difficulty(block.get_target()))
+        return block
+
+    def is_minable(self, tx: Transaction) -> bool:
+        """
+        Whether ``tx`` may go into the next block on its own: its earlier nonces are known and the
+        sender can pay for it right now.
+        """
+        return self.nonces.is_ready(tx) and self.ledger.can_apply(tx)
+
+    def select_transactions(self) -> List[Transaction]:
+        """
+        The template's transactions that fit on top of the tip together, the ones that never will are dropped.
+        """
+        transactions, invalid = self.validator.select(self.builder.take())
+        if invalid:
+            self.logger.info('Node %s dropped %s transactions that cannot be mined', self.node_id, len(invalid))
+            self.drop_transactions(invalid)
+        return transactions
 
     def sign_transaction(self, transaction: Transaction) -> None:
-        initial_ttl = transaction.ttl
-        transaction.ttl = 0
-        transaction.signature = self.crypto.create_signature(self.my_peer.key, self.serializer.pack_serializable(transaction))
-        transaction.ttl = initial_ttl
+        transaction.signature = self.crypto.create_signature(self.my_peer.key,
+                                                             transaction.get_signing_bytes())
+        # the id hashes the signature as well, so it is only known once the transaction is signed
+        transaction.tx_id = transaction.compute_tx_id()
 
     def verify_signature(self, transaction: Transaction) -> bool:
-        # create transaction copy without signature and then verify
-        tx_copy = copy.deepcopy(transaction)
-        tx_copy.signature = b''
-        tx_copy.ttl = 0
-        public_key = self.crypto.key_from_public_bin(tx_copy.public_key_bin)
-        return self.crypto.is_valid_signature(public_key, self.serializer.pack_serializable(tx_copy), transaction.signature)
+        return self.verifier.verify_now(transaction.public_key_bin, transaction.get_signing_bytes(),
+                                        transaction.signature)
+
+    async def verify_transaction(self, transaction: Transaction) -> bool:
+        # batched on the verifier's worker pool, so the event loop keeps running
+        return await self.verifier.verify(transaction.public_key_bin, transaction.get_signing_bytes(),
+                                          transaction.signature)
 
     def create_transaction(self):
-        peer = random.choice([i for i in self.get_peers()])
-        peer_id = self.node_id_from_peer(peer)
+        peer_id, _peer = random.choice(self.neighbours)
         tx = Transaction(self.node_id, peer_id, 10, b'', b'', '', self.counter)
         tx.public_key_bin = self.my_peer.public_key.key_to_bin()
         # tx.tx_id = hashlib.sha256(f'{tx.sender}{tx.receiver}{tx.amount}{tx.nonce}'.encode()).hexdigest()
-        tx.tx_id = hashlib.sha256(f'{hexlify(tx.public_key_bin)}{tx.nonce}'.encode()).hexdigest()
 
         self.sign_transaction(tx)
         self.counter += 1
-        self.pending_txs.append(tx)
+        self.add_transaction(tx)
 
-        for peer in list(self.get_peers()):
-            self.ez_send(peer, tx)
+        self.gossip.announce_tx(tx)
             
         if self.counter > self.max_messages:
             self.cancel_pending_task("tx_create")
@@ -289,123 +520,87 @@ class BlockchainNode(Blockchain):
         tx = Transaction(self.node_id, self.node_id, is_uniswap=True, coin=coin, amount=amount, public_key_bin=b'', signature=b'', tx_id='', nonce=self.counter)
         tx.public_key_bin = self.my_peer.public_key.key_to_bin()
         # tx.tx_id = hashlib.sha256(f'{tx.sender}{tx.receiver}{tx.amount}{tx.nonce}'.encode()).hexdigest()
-        tx.tx_id = hashlib.sha256(f'{hexlify(tx.public_key_bin)}{tx.nonce}'.encode()).hexdigest()
 
         self.sign_transaction(tx)
         self.counter += 1
-        self.pending_txs.append(tx)
-
-        if coin == 'BTC':
-            self.pools['BTC'] = self.pools['BTC']+tx.amount
-            old_eth = self.pools['ETH']
-            self.pools['ETH'] = self.c / int(self.pools['BTC'])
-            self.balances[self.node_id]['BTC'] -= tx.amount
-            self.balances[self.node_id]['ETH'] += old_eth - self.pools['ETH']
-            self.logger.info(f'Node {self.node_id} added {tx.amount} BTC to the pool')
-            self.logger.info(f'Node {self.node_id} has the following pools: {self.pools}')
-            self.logger.info(f'Node {self.node_id} has the following balances: {self.balances}')
-        else:
-            self.pools['ETH'] = self.pools['ETH'] + tx.amount
-            old_btc = self.pools['BTC']
-            self.pools['BTC'] = self.c / int(self.pools['ETH'])
-            self.balances[self.node_id]['ETH'] -= tx.amount
-            self.balances[self.node_id]['BTC'] += old_btc - self.pools['BTC']
-            self.logger.info(f'Node {self.node_id} added {tx.amount} ETH to the pool')
-            self.logger.info(f'Node {self.node_id} has the following pools: {self.pools}')
-            self.logger.info(f'Node {self.node_id} has the following balances: {self.balances}')
-
-        for peer in list(self.get_peers()):
-            self.ez_send(peer, tx)
+        self.add_transaction(tx)
+
+        # the pools only change when the swap is settled in a block, at that block's clearing price
+        self.logger.info(f'Node {self.node_id} swaps {tx.amount} {coin}, quoted at {self.ledger.quote(coin, tx.amount) / UNIT} '
+                         f'{SWAP_TARGET[coin]} with pools {self.ledger.amm.snapshot()}')
+        self.logger.info(f'Node {self.node_id} has the following balances: {self.ledger.account(self.node_id)}')
+
+        self.gossip.announce_tx(tx)
 
         if self.counter > self.max_messages:
             self.cancel_pending_task("tx_create")
             self.stop()
-            return
+        return tx
 
     def create_uniswap_transaction(self, coin):
         tx = Transaction(self.node_id, self.node_id, is_uniswap=True, coin=coin, public_key_bin=b'', signature=b'', tx_id='', nonce=self.counter)
         tx.public_key_bin = self.my_peer.public_key.key_to_bin()
         # tx.tx_id = hashlib.sha256(f'{tx.sender}{tx.receiver}{tx.amount}{tx.nonce}'.encode()).hexdigest()
-        tx.tx_id = hashlib.sha256(f'{hexlify(tx.public_key_bin)}{tx.nonce}'.encode()).hexdigest()
 
         self.sign_transaction(tx)
         self.counter += 1
-        self.pending_txs.append(tx)
-
-        if coin == 'BTC':
-            self.pools['BTC'] -= tx.amount
-            self.pools['ETH'] += tx.amount
-        else:
-            self.pools['BTC'] += tx.amount
-            self.pools['ETH'] -= tx.amount
+        self.add_transaction(tx)
 
-        for peer in list(self.get_peers()):
-            self.ez_send(peer, tx)
+        self.gossip.announce_tx(tx)
 
         if self.counter > self.max_messages:
             self.cancel_pending_task("tx_create")
             self.stop()
             return
 
-    def append_block(self, block: Block):
-        self.blocks.append(block)
-        self.blocks.sort(key=lambda x: x.number)
-        self.find_optimal_chain()
-
-    def broadcast_current_block(self):
-        self.logger.info(f'Node {self.node_id} is broadcasting self.curr_block! {self.curr_block.number}')
-
-        for peer in list(self.get_peers()):
-            self.ez_send(peer, self.curr_block)
-
-    def find_optimal_chain(self):
-        # Initialize variables to store chains and remaining blocks
-        chains = []
-        blocks_still_not_in_chain = self.blocks.copy()
-
-        # Iterate while there are still blocks not added to any chain
-        while blocks_still_not_in_chain:
-            # Start a new chain with the first block in the list
-            current_chain = [blocks_still_not_in_chain.pop(0)]
-
-            # Try to extend the chain
-            i = 0
-            while i < len(blocks_still_not_in_chain):
-                block = blocks_still_not_in_chain[i]
-                if block.prev_block_hash == current_chain[-1].hash:
-                    current_chain.append(block)
-                    blocks_still_not_in_chain.pop(i)
-                else:
-                    i += 1
-
-            # Append the current chain to the list of chains
-            chains.append(current_chain)
-
-        # Debugging output to trace chains
-        try:
-            print(f'Node {self.node_id} has {len(chains)} chains')
-            self.logger.info(f'Node {self.node_id} has {len(chains)} chains')
-            for chain in chains:
-                self.logger.info(f'Chain length: {len(chain)}')
-                for block in chain:
-                    self.logger.info(f'Block number: {block.number}, hash: {block.hash}')
-        except Exception as e:
-            self.logger.info(f"An error occurred while printing chain details: {e}")
-
-    def check_curr_block(self) :
-        self.logger.info(f'Node {self.node_id} is checking self.curr_block!')
-
-        for txs in self.pending_txs:
-            result = self.curr_block.add_transaction(txs)
-
-            if result == False:
-                self.logger.info(f'{self.node_id} has full cur_block!')
-
-                self.cancel_pending_task("mine_block")
-                self.register_mine_task()
+    @property
+    def balances(self) -> dict:
+        return self.ledger.balances
+
+    @property
+    def longest_chain(self) -> list[Block]:
+        return list(self.block_tree.chain())
+
+    def append_block(self, block: Block) -> ChainUpdate:
+        update = self.block_tree.insert(block)
+        if update.reorg:
+            self.logger.info(f'Node {self.node_id} reorganized {len(update.disconnected)} blocks, '
+                             f'new tip {self.block_tree.tip.number} {self.block_tree.tip.hash}')
+        elif update.orphan:
+            self.logger.info(f'Node {self.node_id} keeps block {block.number} as orphan, parent {block.prev_block_hash} is unknown')
+        if update.connected:
+            self.logger.info(f'Node {self.node_id} has chain height {self.block_tree.height} '
+                             f'with {self.block_tree.fork_count} tips')
+        if self.store is not None and update.added:
+            self.store.append(block)
+            if update.connected:
+                self.store.set_chain(self.store.height - len(update.disconnected), update.connected)
+        return update
+
+    def add_transaction(self, tx: Transaction) -> bool:
+        """
+        Add a new transaction to the mempool and, once its sender's earlier nonces are known, to the
+        next block's template.
+        """
+        if not self.mempool.add(tx):
+            return False
+        for ready in self.nonces.add(tx):
+            self.builder.add(ready)
+        self.queries.on_transaction(tx)
+        self.check_curr_block()
+        if self.events:
+            self.events.publish('transaction', tx)
+        return True
 
-                self.logger.info(f'Node {self.node_id} created new block with number {self.curr_block.number}')
-                self.logger.info(f'node {self.node_id} has the following blocks: {[block.number for block in self.blocks]}')
+    def check_curr_block(self):
+        # mine the template once it is full or old enough, without restarting a running job
+        if self.builder.ready and not self.is_pending_task_active("mine_block"):
+            self.logger.info(f'Node {self.node_id} mines a block with {len(self.builder)} transactions')
+            self.register_mine_task()
+        if self.builder and not self.is_pending_task_active("check_block"):
+            self.register_task("check_block", self.check_curr_block, interval=0.25, delay=0.25)
+        elif not self.builder:
+            self.cancel_pending_task("check_block")
 
     def on_start(self):
         # self.start_client()
@@ -424,201 +619,371 @@ class BlockchainNode(Blockchain):
     def register_mine_task(self):
         self.register_task("mine_block", self.mine)
 
-    def mine(self):
+    async def unload(self):
+        self.mining_engine.close()
+        self.block_sync.stop()
+        await super().unload()
+        if self.store is not None:
+            self.store.close()
+
+    async def mine(self):
         now = time.time()
-        # loop = asyncio.get_event_loop()
-        self.logger.info(f'Someone is mining block {self.curr_block.number}...')
-        while True:
-            self.curr_block.hashing_value = self.curr_block.get_hashing_value(self.my_peer.public_key.key_to_bin())
-            self.curr_block.hash = hashlib.sha256(self.curr_block.hashing_value.encode()).hexdigest()
-            # Use 2^target for comparison
-            target_value = 2 ** Decimal(self.curr_block.puzzle_target)
-
-            if int(self.curr_block.hash, 16) < target_value:
-                self.curr_block.time = int(self.curr_block.prev_block_time + time.time() - now)
-                self.logger.info(f'Block {self.curr_block.number} is mined. Here is hash: {self.curr_block.hash}')
-                self.logger.info(f'Block {self.curr_block.number} based on hashing value:{self.curr_block.hashing_value}')
-                self.logger.info(f'Block {self.curr_block.number} based on nonce:{self.curr_block.nonce}')
-                self.logger.info(f'It took {time.time() - now} seconds to mine this block {self.curr_block.number}')
-                self.append_block(self.curr_block)
-                self.update_pending_finalized_txs(self.curr_block)
-                for peer in self.get_peers():
-                    self.logger.info(f'sending block {self.curr_block.number}')
-                    self.ez_send(peer, self.curr_block)
-                self.create_block()
-                return self.curr_block.hash
-            self.curr_block.nonce += 1
+        block = self.curr_block = self.create_block()
+        public_key_bin = self.my_peer.public_key.key_to_bin()
+        self.logger.debug('Node %s is mining block %s', self.node_id, block.number)
+        block.merkle_root = block.compute_merkle_root()
+        block.miner = public_key_bin
+        prefix, suffix = block.get_hashing_parts(public_key_bin)
+        job = MiningJob(block.number, prefix, suffix, block.get_target(), block.nonce)
+        result = await self.mining_engine.mine(job)
+        tip = self.block_tree.tip
+        if result is None or block is not self.curr_block or block.prev_block_hash != (tip.hash if tip else GENESIS_HASH):
+            self.logger.debug('Node %s stopped mining block %s', self.node_id, block.number)
+            return None
+        self.curr_block = None
+
+        block.nonce = result.nonce
+        block.hash = result.hash
+        block.hashing_value = block.get_hashing_value(public_key_bin)
+        self.metrics.mining_seconds.observe(time.time() - now)
+        self.logger.info('Node %s mined block %s with %s transactions in %.2fs, hash %s nonce %s, %s hashes at %.0f H/s',
+                         self.node_id, block.number, len(block.transactions), time.time() - now, block.hash,
+                         block.nonce, result.hashes, self.mining_engine.hashrate)
+        self.logger.debug('Block %s based on hashing value: %s', block.number, block.hashing_value)
+        update = self.on_chain_update(self.append_block(block))
+        if not any(connected is block for connected in update.connected):
+            _, invalid = self.validator.select(block.transactions)
+            self.logger.warning('Node %s mined an invalid block %s, dropping %s of its transactions',
+                                self.node_id, block.number, len(invalid))
+            self.drop_transactions(invalid)
+            return None
+        self.gossip.announce_block(block)
+        return block.hash
+
+    def drop_transactions(self, transactions) -> None:
+        """
+        Remove pending transactions that can never get into the chain, or were evicted, from the mempool,
+        the block builder and the nonce buffer.
+        """
+        for tx in transactions:
+            self.mempool.remove(tx.tx_id)
+            self.builder.discard(tx.tx_id)
+            self.nonces.discard(tx)
+        self.queries.on_removed(transactions)
+
     def start_validator(self):
         self.register_task("check_txs", self.check_transactions, delay=2, interval=1)
 
     def check_transactions(self):
-        for tx in self.pending_txs:
-            # block = self.find_block_for_transaction(tx)
-            if tx.is_uniswap == False:
-                if self.balances[tx.sender][tx.coin] - tx.amount >= 0:
-                    self.balances[tx.sender][tx.coin] -= tx.amount
-                    self.balances[tx.receiver][tx.coin] += tx.amount
-                    # self.pending_txs.remove(tx)
-                    # self.finalized_txs.append(tx)
-            else:
-                if tx.coin == "ETH":
-                    if self.balances[tx.sender][tx.coin] - tx.amount >= 0:
-                        self.balances[tx.sender][tx.coin] -= tx.amount
-                        self.balances[tx.receiver]["BTC"] += tx.amount
-                else:
-                    if self.balances[tx.sender][tx.coin] - tx.amount >= 0:
-                        self.balances[tx.sender][tx.coin] -= tx.amount
-                        self.balances[tx.receiver]["ETH"] += tx.amount
-
-
-
+        # balances are applied by the ledger when blocks join the longest chain, this only reports progress
         self.executed_checks += 1
 
         if self.executed_checks > 5:
-            # print(f'balances: {self.balances}')
-            self.logger.info(f'balances: {self.balances}')
-            # print(f'amount of transactions: {len(self.curr_block.transactions)}')
-            # self.logger.info(f'amount of transactions: {len(self.curr_block.transactions)}')
-            self.logger.info(f'node id: {self.node_id}, self.pending_txs length: {len(self.pending_txs)}, '
-                        f'self.finalized_txs length: {len(self.finalized_txs)}, number of collision: {self.collision_num}')
-
-    def verify_block(self, block: Block) -> bool:
-        return True
-        # if block.hash != hashlib.sha256(block.get_hashing_value().encode()).hexdigest() \
-        #         and int(block.hash, 16) < float(self.puzzle_target):
-        #     return False
-        # else:
-        #     return True
+            # the balances of every account are only formatted when debugging
+            self.logger.debug('balances: %s', self.balances)
+            self.logger.info('node id: %s, pending txs: %s, finalized txs: %s, number of collision: %s',
+                             self.node_id, len(self.mempool), len(self.mempool.finalized), self.collision_num)
 
     def send_web_transaction(self, peer_recipient, amount = 10):
         tx = Transaction(self.node_id, peer_recipient, False, "ETH", amount, b'', b'', '', self.counter,)
         tx.public_key_bin = self.my_peer.public_key.key_to_bin()
-        tx.tx_id = hashlib.sha256(f'{hexlify(tx.public_key_bin)}{tx.nonce}'.encode()).hexdigest()
 
         self.sign_transaction(tx)
         self.counter += 1
-        self.pending_txs.append(tx)
+        self.add_transaction(tx)
 
-        
-
-        for peer in list(self.get_peers()):
-            self.ez_send(peer, tx)
+        self.gossip.announce_tx(tx)
 
         if self.counter > self.max_messages:
             self.cancel_pending_task("tx_create")
             self.stop()
-            return
+        return tx
+
+    def decode_wire(self, peer: Peer, decode, data: bytes):
+        try:
+            return decode(peer, data)
+        except UnknownKeyError as e:
+            # we evicted keys the peer thinks we have, ask it to send them in full
+            self.ez_send(peer, MissingKeys(b''.join(e.key_hashes)))
+        except ValueError as e:
+            self.logger.warning(f'Node {self.node_id} dropped a malformed message from '
+                                f'{self.node_id_from_peer(peer)}: {e}')
+        return None
+
+    def send_transactions(self, peer: Peer, transactions) -> None:
+        # as few messages as fit under max_message_size
+        writer = self.wire.writer(peer)
+        for tx in transactions:
+            if len(writer) and len(writer) + transaction_size(tx) > self.max_message_size:
+                self.ez_send(peer, Transactions(writer.getvalue()))
+                writer = self.wire.writer(peer)
+            writer.add_transaction(tx)
+        if len(writer):
+            self.ez_send(peer, Transactions(writer.getvalue()))
+
+    @message_wrapper(Transactions)
+    async def on_transactions(self, peer: Peer, payload: Transactions) -> None:
+        transactions = self.decode_wire(peer, self.wire.decode_transactions, payload.transactions)
+        for tx in transactions or ():
+            await self.on_transaction(peer, tx)
+
+    @message_wrapper(MissingKeys)
+    def on_missing_keys(self, peer: Peer, payload: MissingKeys) -> None:
+        key_hashes = payload.key_hashes
+        self.wire.forget(peer, [key_hashes[i:i + KEY_HASH_SIZE] for i in range(0, len(key_hashes), KEY_HASH_SIZE)])
 
-    @message_wrapper(Transaction)
     async def on_transaction(self, peer: Peer, payload: Transaction) -> None:
-        print(self.node_id, payload.ttl)
-        if self.verify_signature(payload):
-
-            # Add to pending transactions if signature is verified
-            print(f'transaction nonce:{payload.nonce}')
-            self.logger.info(f'transaction nonce:{payload.nonce}')
-            print(f'[Node {self.node_id}] Received transaction {payload.nonce} from {self.node_id_from_peer(peer)}')
-            self.logger.info(f'[Node {self.node_id_from_peer(peer)}] -> [Node {self.node_id}] TTL: {payload.ttl} amount: {payload.amount} VAD ')
-            
-            if (hexlify(payload.public_key_bin), payload.nonce) not in [(hexlify(tx.public_key_bin), tx.nonce) for tx in
-                                                                        self.finalized_txs] and (
-                    hexlify(payload.public_key_bin), payload.nonce) not in [(hexlify(tx.public_key_bin), tx.nonce) for
-                                                                            tx in self.pending_txs]:
-
-                self.pending_txs.append(payload)
-                self.logger.info(
-                    f'Node {self.node_id} already have {len(self.finalized_txs)} from finalized and {len(self.pending_txs)} in pending')
-                self.check_curr_block()
-            else:
-                self.collision_num += 1
-                pass
-            
-            if payload.ttl > 1:
-                payload.ttl -= 1
-                # Gossip to other nodes
-                for peer in list(self.get_peers()):
-                    print(
-                        f'[Node {self.node_id}] sending transaction {payload.nonce} with TTL: {payload.ttl} for {self.node_id_from_peer(peer)}')
-                    self.ez_send(peer, payload)
+        self.metrics.transactions_received.inc()
+        # unsolicited transactions keep the TTL they came with
+        ttl = self.gossip.received_tx(payload)
+        ttl = payload.ttl if ttl is None else ttl
+        # drop duplicates before spending time on their signature
+        if self.mempool.contains(payload):
+            self.collision_num += 1
+            self.metrics.transactions_duplicate.inc()
+            return
+        reason = self.nonces.check(payload)
+        if reason is not None:
+            self.metrics.transactions_invalid.inc()
+            self.logger.debug('Node %s dropped transaction %s: %s', self.node_id, payload.nonce, reason)
+            return
+        if not await self.verify_transaction(payload):
+            self.metrics.transactions_invalid.inc()
+            self.logger.warning('Node %s dropped transaction %s with an invalid signature', self.node_id, payload.nonce)
+            return
+
+        # Add to pending transactions if signature is verified
+        if not self.add_transaction(payload):
+            # another copy arrived while this one was being verified
+            self.collision_num += 1
+            self.metrics.transactions_duplicate.inc()
+            return
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info('[Node %s] -> [Node %s] transaction %s TTL: %s amount: %s VAD, %s pending and %s finalized',
+                             self.node_id_from_peer(peer), self.node_id, payload.nonce, ttl, payload.amount,
+                             len(self.mempool), len(self.mempool.finalized), extra={'event': 'transaction'})
+
+        if ttl > 1:
+            self.metrics.transactions_forwarded.inc()
+            self.gossip.announce_tx(payload, ttl - 1, exclude=peer)
 
     def create_blocks_request(self, sender, start_block_number, end_block_number):
         request = BlocksRequest(sender, start_block_number, end_block_number)
         return request
 
-    def update_pending_finalized_txs(self, block):
-        # we need to remove from pending_txs transactions that were already included in mined block
-        self.logger.info(f'Node {self.node_id} Updating of pending_txs and finalized_txs............')
-       
-        for tx in self.pending_txs:
-            if tx not in block.transactions:
-                self.pending_txs.remove(tx)
-                self.finalized_txs.append(tx)
+    def create_headers_request(self, start_block_number, count):
+        return HeadersRequest(start_block_number, count)
+
+    def create_inventory(self, ttl, tx_hashes, block_hashes):
+        return Inventory(ttl, tx_hashes, block_hashes)
+
+    def create_get_data(self, tx_hashes, block_hashes):
+        return GetData(tx_hashes, block_hashes)
 
-    def clean_curr_block_txs(self, payload):
-        # we need to remove transactions included in mined block from out curr_block.transactions
-        self.logger.info(f'Node {self.node_id} Cleaning of self.curr_block_txs............')
-        new_txs_list = []
+    def create_compact_block(self, peer, block):
+        writer = self.wire.writer(peer)
+        writer.add_header(block)
+        return CompactBlock(writer.getvalue(), b''.join(bytes.fromhex(tx.tx_id) for tx in block.transactions))
 
-        for tx in payload.transactions:
-            if tx not in self.curr_block.transactions:
-                new_txs_list.append(tx)
+    def create_get_block_transactions(self, block_hash, tx_hashes):
+        return GetBlockTransactions(hash_to_bytes(block_hash), tx_hashes)
 
-        self.curr_block.transactions = new_txs_list
+    def create_block_transactions(self, peer, block_hash, transactions):
+        return BlockTransactions(hash_to_bytes(block_hash), self.wire.encode_transactions(peer, transactions))
+
+    def get_transaction_proof(self, tx_id: str):
+        # returns the canonical block holding the transaction and its merkle inclusion proof
+        block = self.block_tree.get(self.ledger.applied.get(tx_id, ''))
+        if block is None:
+            return None, None
+        index = next(i for i, tx in enumerate(block.transactions) if tx.tx_id == tx_id)
+        return block, block.get_merkle_tree().proof(index)
+
+    def update_pending_finalized_txs(self, block):
+        # transactions included in a block of the longest chain are finalized
+        self.logger.debug('Node %s finalizes the transactions of block %s', self.node_id, block.number)
+
+        for tx in block.transactions:
+            self.mempool.finalize(tx)
+
+    def revert_finalized_txs(self, block):
+        # transactions of a block that left the longest chain are pending again
+        for tx in block.transactions:
+            self.mempool.unfinalize(tx)
+
+    def apply_chain_update(self, update: ChainUpdate) -> ChainUpdate:
+        """
+        Revert and apply the blocks of ``update``. Every connected block is checked against the state it
+        builds on first, an invalid one is dropped from the block tree with the blocks built on it and
+        the chain moves to the best remaining tip instead. Returns the blocks that were really
+        disconnected and connected.
+        """
+        applied = ChainUpdate(added=update.added, orphan=update.orphan)
+        while update.disconnected or update.connected:
+            for block in update.disconnected:
+                if not self.ledger.revert_block(block):
+                    self.logger.warning(f'Node {self.node_id} cannot revert block {block.number}, no undo record left')
+                self.nonces.revert(block)
+                self.revert_finalized_txs(block)
+                if applied.connected and applied.connected[-1] is block:
+                    applied.connected.pop()
+                else:
+                    applied.disconnected.append(block)
+            invalid = None
+            for i, block in enumerate(update.connected):
+                reason = self.validator.check_connected(block)
+                if reason is not None:
+                    invalid = i
+                    break
+                self.ledger.apply_block(block)
+                for ready in self.nonces.confirm(block):
+                    # held transactions whose missing nonce the block confirmed can go into the next block
+                    if ready.tx_id in self.mempool.pending:
+                        self.builder.add(ready)
+                self.update_pending_finalized_txs(block)
+                applied.connected.append(block)
+            if invalid is None:
+                break
+            block = update.connected[invalid]
+            self.metrics.blocks_invalid.inc()
+            self.validator.rejected += 1
+            self.logger.warning(f'Node {self.node_id} dropped block {block.number} {block.hash} and the blocks '
+                                f'built on it: {reason}')
+            applied.invalid.append(block)
+            follow = self.block_tree.remove(block.hash)
+            if self.store is not None:
+                # the stored chain ends with the blocks of the update, cut it back to the invalid block's parent
+                depth = self.store.height - (len(update.connected) - invalid)
+                self.store.set_chain(depth - len(follow.disconnected), follow.connected)
+            update = follow
+        return applied
+
+    def on_chain_update(self, update: ChainUpdate) -> ChainUpdate:
+        """
+        Apply ``update`` and bring everything that follows the chain up to date, returns the applied update.
+        """
+        update = self.apply_chain_update(update)
+        if update.disconnected or update.invalid:
+            # the retarget window has to follow the new chain
+            self.retarget.reset(self.block_tree.chain(max(0, len(self.block_tree.canonical) - self.retarget.window)))
+        else:
+            for block in update.connected:
+                self.retarget.push(block)
+        if self.events:
+            for block in update.connected:
+                self.events.publish('block', block)
+        if update.disconnected:
+            self.builder.reset()
+        else:
+            for block in update.connected:
+                self.builder.on_block(block)
+        self.queries.on_chain_update(update)
+        if self.store is not None and len(self.block_tree.canonical) >= 2 * self.restore_depth:
+            # older blocks are read from disk, like after a restart
+            self.block_tree.prune(self.restore_depth)
+        if self.store is not None and self.store.height - self.snapshot_depth >= self.snapshot_interval:
+            self.save_snapshot()
+        return update
 
     @message_wrapper(Block)
-    def on_block(self, peer: Peer, payload: Block) -> None:
-        if self.verify_block(payload):
-            print(f'[Node {self.node_id}] Received block {payload.number} from [Node {self.node_id_from_peer(peer)}]')
-            self.logger.info(
-                f'[Node {self.node_id}] Received block {payload.number} from [Node {self.node_id_from_peer(peer)}]')
-
-        #     # pull gossip
-        #     prev_block_number = 0 if len(self.blocks) == 0 else self.blocks[-1].number
-        #     if (payload.number - prev_block_number == 1):
-        #         self.logger.info('we received block  that we can append')
-        #         # we received block  that we can append
-        #         self.blocks.append(payload)
-        #         self.update_pending_finalized_txs(payload)
-        #         self.clean_curr_block_txs(payload)
-            self.append_block(payload)
-            # only if the block is for longest chain
-            self.update_pending_finalized_txs(payload)
-            self.clean_curr_block_txs(payload)
-            self.check_curr_block()
-
-        #         # broadcast to all peers
-        #         for peer in self.get_peers():
-        #             self.ez_send(peer, payload)
-        #     elif (payload.number - prev_block_number) < 1:
-        #         self.logger.info('we received block that we already have')
-        #         # we already have this block, then
-        #         # broadcast to all peers
-        #         for peer in self.get_peers():
-        #             self.ez_send(peer, payload)
-        #     else:
-        #         # we received block that we don't have
-        #         # and it cannot be appended
-        #         self.update_pending_finalized_txs(payload)
-        #         self.clean_curr_block_txs(payload)
-
-        #         start_block_number = self.blocks[-1].number + 1
-        #         end_block_number = payload.number
-
-        #         self.logger.info(
-        #             f'we received block that we dont have, need request from block from {start_block_number} to {end_block_number}')
-        #         request_message = self.create_blocks_request(self.node_id, start_block_number, end_block_number)
-
-            #     for peer in self.get_peers():
-            #         self.ez_send(peer, request_message)
-
-            # self.logger.info(f'Node {self.node_id} has the following blocks: {[block.number for block in self.blocks]}')
+    async def on_block(self, peer: Peer, payload: Block) -> None:
+        await self.process_block(peer, payload)
+
+    async def process_block(self, peer: Peer, block: Block) -> Optional[ChainUpdate]:
+        self.metrics.blocks_received.inc()
+        async with self.block_lock:
+            if block.hash in self.block_tree:
+                self.metrics.blocks_duplicate.inc()
+                return None
+            reason = await self.validator.validate(block)
+            if reason is not None:
+                self.metrics.blocks_invalid.inc()
+                self.logger.warning(f'Node {self.node_id} rejected block {block.number} from '
+                                    f'{self.node_id_from_peer(peer)}: {reason}')
+                return None
+            return self.accept_block(peer, block)
+
+    def accept_block(self, peer: Peer, block: Block) -> ChainUpdate:
+        self.logger.info('[Node %s] Received block %s from [Node %s]', self.node_id, block.number,
+                         self.node_id_from_peer(peer))
+
+        update = self.append_block(block)
+        if update.orphan:
+            # we are missing its ancestors, fetch everything up to it in ranges
+            self.block_sync.start(peer, block.number)
+        # only blocks that joined the longest chain finalize transactions
+        self.on_chain_update(update)
+        if update.connected and self.curr_block is not None and \
+                self.curr_block.prev_block_hash != self.block_tree.tip.hash:
+            # the best tip moved, stop mining and build on top of it
+            self.mining_engine.cancel()
+            self.cancel_pending_task("mine_block")
+            self.curr_block = None
+        self.check_curr_block()
+        return update
 
     @message_wrapper(BlocksRequest)
     def on_blocks_request(self, peer: Peer, payload: BlocksRequest) -> None:
-        self.logger.info(f'Node {self.node_id} has the following blocks: {[block.number for block in self.blocks]}')
-        self.logger.info(
-            f'Node {self.node_id} received block request from {payload.start_block_number} to {payload.end_block_number}')
-        last_possible_block_number = min(payload.end_block_number + 1, self.blocks[-1].number)
-
-        for i in range(payload.start_block_number, last_possible_block_number):
-            self.ez_send(payload.sender, self.blocks[i])
+        self.logger.info('Node %s received block request from %s to %s', self.node_id, payload.start_block_number,
+                         payload.end_block_number)
+
+        # at most one sync range per request, packed into as few responses as fit under max_message_size
+        end = min(payload.end_block_number, payload.start_block_number + self.block_sync.range_size - 1)
+        batch, size, start = [], 0, payload.start_block_number
+        for number in range(payload.start_block_number, end + 1):
+            block = self.get_block_at(number)
+            if block is None:
+                break
+            size_bound = block_size(block)
+            if batch and size + size_bound > self.max_message_size:
+                self.ez_send(peer, BlocksResponse(start, number - 1, self.wire.encode_blocks(peer, batch)))
+                batch, size, start = [], 0, number
+            batch.append(block)
+            size += size_bound
+        if batch:
+            self.ez_send(peer, BlocksResponse(start, start + len(batch) - 1, self.wire.encode_blocks(peer, batch)))
+
+    @message_wrapper(BlocksResponse)
+    async def on_blocks_response(self, peer: Peer, payload: BlocksResponse) -> None:
+        blocks = self.decode_wire(peer, self.wire.decode_blocks, payload.blocks)
+        if blocks is not None:
+            await self.block_sync.on_blocks(peer, payload.start_block_number, payload.end_block_number, blocks)
+
+    @message_wrapper(HeadersRequest)
+    def on_headers_request(self, peer: Peer, payload: HeadersRequest) -> None:
+        headers = []
+        count = min(payload.count, self.block_sync.max_headers)
+        for number in range(payload.start_block_number, payload.start_block_number + count):
+            block = self.get_block_at(number)
+            if block is None:
+                break
+            headers.append(BlockHeader(block.number, block.hash, block.prev_block_hash))
+        self.ez_send(peer, HeadersResponse(payload.start_block_number, headers))
+
+    @message_wrapper(HeadersResponse)
+    def on_headers_response(self, peer: Peer, payload: HeadersResponse) -> None:
+        self.block_sync.on_headers(peer, payload.start_block_number, payload.headers)
+
+    @message_wrapper(Inventory)
+    def on_inventory(self, peer: Peer, payload: Inventory) -> None:
+        self.gossip.on_inventory(peer, payload.ttl, payload.tx_hashes, payload.block_hashes)
+
+    @message_wrapper(GetData)
+    def on_get_data(self, peer: Peer, payload: GetData) -> None:
+        self.gossip.on_get_data(peer, payload.tx_hashes, payload.block_hashes)
+
+    @message_wrapper(CompactBlock)
+    def on_compact_block(self, peer: Peer, payload: CompactBlock) -> None:
+        block = self.decode_wire(peer, self.wire.decode_header, payload.header)
+        if block is not None:
+            self.gossip.on_compact_block(peer, block, payload.tx_ids)
+
+    @message_wrapper(GetBlockTransactions)
+    def on_get_block_transactions(self, peer: Peer, payload: GetBlockTransactions) -> None:
+        self.gossip.on_get_block_txs(peer, bytes_to_hash(payload.block_hash), payload.tx_hashes)
+
+    @message_wrapper(BlockTransactions)
+    def on_block_transactions(self, peer: Peer, payload: BlockTransactions) -> None:
+        transactions = self.decode_wire(peer, self.wire.decode_transactions, payload.transactions)
+        if transactions is not None:
+            self.gossip.on_block_txs(peer, bytes_to_hash(payload.block_hash), transactions)
@@ -1,14 +1,18 @@
 from __future__ import annotations
 
 import random
+import time
 import typing
-from asyncio import Event
-from typing import Dict, List, Tuple, Callable
+from asyncio import Event, Future
+from typing import Any, Dict, Hashable, List, Optional, Tuple, Callable
 from ipv8.community import Community, CommunitySettings
 from ipv8.lazy_community import lazy_wrapper
 from ipv8.messaging.serialization import Payload
+from ipv8.peerdiscovery.network import PeerObserver
 from ipv8.types import Peer, LazyWrappedHandler, MessageHandlerFunction
 
+from profiling import CallProfiler, task_name
+
 DataclassPayload = typing.TypeVar('DataclassPayload')
 AnyPayload = typing.Union[Payload, DataclassPayload]
 
@@ -17,17 +21,66 @@ def message_wrapper(*payloads: type[AnyPayload]) -> Callable[[LazyWrappedHandler
     return lazy_wrapper(*payloads)
 
 
-class Blockchain(Community):
+class Blockchain(Community, PeerObserver):
     community_id = b"\x05" * 20
 
     def __init__(self, settings: CommunitySettings) -> None:
+        # wall and CPU time of every handler and task, including the ones the Community registers
+        self.profiler = CallProfiler()
         super().__init__(settings)
         self.event: Event = None  # type:ignore
         # Register the message handler for messages (with the identifier "1").
         self.nodes: Dict[int, Peer] = {}
-
-    def node_id_from_peer(self, peer: Peer):
-        return next((key for key, p in self.nodes.items() if p == peer), None)
+        # the reverse of nodes, keyed by peer.mid, change both through set_node and remove_node
+        self.node_ids: Dict[bytes, int] = {}
+        self.connections: List[Tuple[int, int]] = []
+        # neighbours in the order of connections, and for every neighbour the others, built when first used
+        self._neighbours: Optional[List[Tuple[int, Peer]]] = None
+        self._others: Dict[bytes, List[Tuple[int, Peer]]] = {}
+        # node id of every neighbour by its port, known from the topology
+        self.node_ports: Dict[int, int] = {}
+        # set once all neighbours are connected
+        self.ready = Event()
+        self.start_time = time.time()
+        self.ready_time: float = None  # type:ignore
+
+    def node_id_from_peer(self, peer: Peer) -> Optional[int]:
+        return self.node_ids.get(peer.mid)
+
+    def set_node(self, node_id: int, peer: Peer) -> None:
+        previous = self.nodes.get(node_id)
+        if previous is not None:
+            self.node_ids.pop(previous.mid, None)
+        self.nodes[node_id] = peer
+        self.node_ids[peer.mid] = node_id
+        self._neighbours = None
+        self._others.clear()
+
+    def remove_node(self, node_id: int) -> None:
+        peer = self.nodes.pop(node_id, None)
+        if peer is not None:
+            self.node_ids.pop(peer.mid, None)
+            self._neighbours = None
+            self._others.clear()
+
+    @property
+    def neighbours(self) -> List[Tuple[int, Peer]]:
+        """
+        (node id, peer) of the connected neighbours, in the order of the topology.
+        """
+        if self._neighbours is None:
+            order = {node_id: i for i, (node_id, _) in enumerate(self.connections)}
+            self._neighbours = sorted(self.nodes.items(), key=lambda item: order.get(item[0], len(order)))
+        return self._neighbours
+
+    def other_neighbours(self, peer: Peer) -> List[Tuple[int, Peer]]:
+        """
+        The neighbours except ``peer``, e.g. to pass a message on.
+        """
+        others = self._others.get(peer.mid)
+        if others is None:
+            others = self._others[peer.mid] = [item for item in self.neighbours if item[1] != peer]
+        return others
 
     async def started(
             self, node_id: int, connections: List[Tuple[int, int]], event: Event, use_localhost: bool = True
@@ -36,40 +89,55 @@ class Blockchain(Community):
         self.node_id = node_id
         self.connections = connections
         self.on_start_delay = random.uniform(1.0, 3.0)  # Seconds
+        self.node_ports = {port: neighbour for neighbour, port in connections}
         host_network = self._get_lan_address()[0]
         host_network_base = ".".join(host_network.split(".")[:3])
 
+        # neighbours are matched as they connect, instead of scanning all peers for every connection
+        self.network.add_peer_observer(self)
+        for peer in self.get_peers():
+            self.on_peer_added(peer)
+        self._check_ready()
+
         async def _ensure_nodes_connected() -> None:
-            # Make connections to known peers
+            # Make connections to known peers, again for those whose introduction got lost
             for node_id, conn in connections:
+                if node_id in self.nodes:
+                    continue
                 ip_address = f"{host_network_base}.{node_id + 10}"
                 if use_localhost:
                     ip_address = host_network
                 ad = (ip_address, conn)
                 self.walk_to(ad)
-            valid = False
-            conn_nodes = []
-
-            for node_id, node_port in self.connections:
-                conn_nodes = [
-                    p for p in self.get_peers() if p.address[1] == node_port
-                ]
-                if len(conn_nodes) == 0:
-                    return
-                valid = True
-                self.nodes[node_id] = conn_nodes[0]
-            if not valid:
-                return
-            self.cancel_pending_task("ensure_nodes_connected")
-            print(f'[Node {self.node_id}] Starting')
-            self.register_anonymous_task(
-                "delayed_start", self.on_start, delay=self.on_start_delay
+
+        if not self.ready.is_set():
+            self.register_task(
+                "ensure_nodes_connected", _ensure_nodes_connected, interval=.5, delay=0
             )
 
-        self.register_task(
-            "ensure_nodes_connected", _ensure_nodes_connected, interval=.5, delay=1
+    def on_peer_added(self, peer: Peer) -> None:
+        node_id = self.node_ports.get(peer.address[1])
+        if node_id is None:
+            return
+        self.set_node(node_id, peer)
+        self._check_ready()
+
+    def _check_ready(self) -> None:
+        if len(self.nodes) < len(self.node_ports) or self.ready.is_set():
+            return
+        self.ready_time = time.time() - self.start_time
+        self.ready.set()
+        self.cancel_pending_task("ensure_nodes_connected")
+        print(f'[Node {self.node_id}] Starting')
+        self.register_anonymous_task(
+            "delayed_start", self.on_start, delay=self.on_start_delay
         )
 
+    def on_peer_removed(self, peer: Peer) -> None:
+        node_id = self.node_ports.get(peer.address[1])
+        if node_id is not None and self.nodes.get(node_id) == peer:
+            self.remove_node(node_id)
+
     def on_start(self):
         pass
 
@@ -85,4 +153,9 @@ class Blockchain(Community):
         super().ez_send(peer, *payloads, **kwargs)
 
     def add_message_handler(self, msg_num: int | type[AnyPayload], callback: MessageHandlerFunction) -> None:
-        super().add_message_handler(msg_num, callback)
+        super().add_message_handler(msg_num, self.profiler.wrap(getattr(callback, '__name__', str(msg_num)), callback))
+
+    def register_task(self, name: Hashable, task: Callable | Future, *args: Any, **kwargs) -> Future:
+        if callable(task):
+            task = self.profiler.wrap(f'task {task_name(name)}', task)
+        return super().register_task(name, task, *args, **kwargs)
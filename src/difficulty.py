@@ -0,0 +1,91 @@
+from collections import deque
+from typing import Deque, Iterable, Optional, Sequence, Tuple
+
+MAX_TARGET = 2 ** 256 - 1
+
+
+def bits_to_target(bits: int) -> int:
+    """
+    Expand the compact form of a target: the top byte is the length of the target in bytes and
+    the low three bytes are its most significant bytes.
+    """
+    size = bits >> 24
+    mantissa = bits & 0x7fffff
+    if size <= 3:
+        return mantissa >> (8 * (3 - size))
+    return min(mantissa << (8 * (size - 3)), MAX_TARGET)
+
+
+def target_to_bits(target: int) -> int:
+    """
+    Compact form of ``target``, rounded down to the three most significant bytes.
+    """
+    target = max(1, min(target, MAX_TARGET))
+    size = (target.bit_length() + 7) // 8
+    mantissa = target >> (8 * (size - 3)) if size > 3 else target << (8 * (3 - size))
+    if mantissa & 0x800000:
+        # the high bit of the mantissa would read as a sign bit
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+
+def difficulty(target: int) -> float:
+    """
+    Expected number of hashes to find a block below ``target``.
+    """
+    return (MAX_TARGET + 1) / (target + 1)
+
+
+class Retarget:
+    """
+    Difficulty retargeting over a sliding window of the latest canonical blocks.
+
+    A ring buffer keeps the (time, target) of the last ``window`` blocks. The next target is the
+    average target of the window scaled by how long the window took compared to ``target_block_time``
+    per block, clamped to a factor ``max_adjust`` of the tip's target. It is computed once per tip and cached.
+    """
+
+    def __init__(self, initial_bits: int, target_block_time: float = 3, window: int = 16, max_adjust: int = 2) -> None:
+        self.initial_bits = initial_bits
+        self.target_block_time = target_block_time
+        self.window = window
+        self.max_adjust = max_adjust
+        self.blocks: Deque[Tuple[int, int]] = deque(maxlen=window)
+        self._next: Optional[int] = None
+
+    def push(self, block) -> None:
+        self.blocks.append((block.time, bits_to_target(block.bits)))
+        self._next = None
+
+    def reset(self, blocks: Iterable) -> None:
+        """
+        Refill the window from the newest canonical blocks, e.g. after a reorg.
+        """
+        self.blocks.clear()
+        for block in blocks:
+            self.push(block)
+        self._next = None
+
+    def next_target(self) -> int:
+        if self._next is None:
+            self._next = self.target_after(self.blocks)
+        return self._next
+
+    def next_bits(self) -> int:
+        return target_to_bits(self.next_target())
+
+    def target_after(self, window: Sequence[Tuple[int, int]]) -> int:
+        """
+        Target of the block that follows ``window``, the (time, target) of up to ``window`` blocks oldest first.
+        """
+        if len(window) < 2:
+            return window[-1][1] if window else bits_to_target(self.initial_bits)
+        window = list(window)
+        intervals = len(window) - 1
+        timespan = max(window[-1][0] - window[0][0], 0)
+        average = sum(target for _, target in window[1:]) // intervals
+        target = average * timespan * 1000 // int(intervals * self.target_block_time * 1000)
+        last = window[-1][1]
+        target = max(last // self.max_adjust, min(target, last * self.max_adjust))
+        return max(1, min(target, MAX_TARGET))
@@ -0,0 +1,36 @@
+import asyncio
+from typing import List, Tuple
+
+
+class EventBus:
+    """
+    Hands the node's events, ('transaction', tx) and ('block', block), to every subscriber's queue.
+
+    Publishing never blocks the node: queues are bounded and a subscriber that falls behind loses its
+    oldest events. Without subscribers publishing costs a length check.
+    """
+
+    def __init__(self, max_queue: int = 1000) -> None:
+        self.max_queue = max_queue
+        self.subscribers: List[asyncio.Queue] = []
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.subscribers)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(self.max_queue)
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        if queue in self.subscribers:
+            self.subscribers.remove(queue)
+
+    def publish(self, kind: str, item) -> None:
+        event: Tuple[str, object] = (kind, item)
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+                self.dropped += 1
+            queue.put_nowait(event)
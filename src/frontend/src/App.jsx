@@ -31,7 +31,8 @@ function App() {
 				if (!silent) toast.info('Transactions table refreshed!');
 
 				console.log(result);
-				setTxHistory(result.transactions.reverse());
+				// newest first, the event stream below keeps it up to date
+				setTxHistory(result.transactions);
 			})
 			.catch(error => {
 				if (!silent) toast.error('Some error occurred!');
@@ -42,6 +43,20 @@ function App() {
 	// On load get transactions
 	useEffect(() => getTransactions(9090, true), [getTransactions]);
 
+	// Stream new transactions and blocks of the chosen node instead of polling its history
+	useEffect(() => {
+		const events = new EventSource(`http://localhost:8000/events/${chosenTxHistoryNode}`);
+		events.addEventListener('transaction', event => {
+			const tx = JSON.parse(event.data);
+			setTxHistory(history => (history.some(({ hash_id }) => hash_id === tx.hash_id) ? history : [tx, ...history]));
+		});
+		events.addEventListener('block', event => {
+			const processed = new Set(JSON.parse(event.data).transactions);
+			setTxHistory(history => history.map(tx => (processed.has(tx.hash_id) ? { ...tx, status: 'processed' } : tx)));
+		});
+		return () => events.close();
+	}, [chosenTxHistoryNode]);
+
 	// Handle sending transaction
 	const handleTransaction = () => {
 		console.log(senderPeer, receiverPeer);
@@ -0,0 +1,242 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+
+from merkle_util import HASH_SIZE
+
+INV_TX = 1
+INV_BLOCK = 2
+
+
+def split_hashes(data: bytes) -> List[bytes]:
+    return [data[i:i + HASH_SIZE] for i in range(0, len(data) - len(data) % HASH_SIZE, HASH_SIZE)]
+
+
+@dataclass
+class InvRequest:
+    kind: int
+    ttl: int
+    peer: object = None
+    deadline: float = 0.0
+    # when the hash was first announced to us
+    announced: float = 0.0
+    # peers that announced the hash and can be asked when the current request times out
+    announcers: Deque = field(default_factory=deque)
+
+
+@dataclass
+class PartialBlock:
+    # the received header, its transactions are filled in once all of them are known
+    block: object
+    peer: object
+    transactions: List
+    missing: Dict[bytes, int]
+    deadline: float = 0.0
+    announced: float = 0.0
+
+
+class Gossip:
+    """
+    Inventory based relay: nodes announce the 32-byte hashes of new transactions and blocks and
+    peers fetch only the payloads they lack with a GetData request.
+
+    Every hash is announced and requested at most once per node thanks to the ``seen`` LRU.
+    Transactions travel ``ttl`` hops to ``fanout`` random peers per hop, ``None`` meaning all peers,
+    blocks go to ``block_fanout`` peers and are relayed as long as they are new. Blocks are sent as
+    compact blocks holding only the transaction ids, which hash the full transactions, the receiver
+    rebuilds them from its mempool, asks the sender for the transactions it does not have and checks
+    the result against the header's Merkle root. Requests that time out are retried with
+    another peer that announced the same hash.
+    Announcements made in the same event loop iteration share one Inventory message per peer.
+    """
+
+    def __init__(self, node, fanout: Optional[int] = 8, ttl: int = 3, block_fanout: Optional[int] = None,
+                 seen_size: int = 100_000, request_timeout: float = 2.0) -> None:
+        self.node = node
+        self.fanout = fanout
+        self.ttl = ttl
+        self.block_fanout = block_fanout
+        self.seen_size = seen_size
+        self.request_timeout = request_timeout
+        self.seen: Dict[bytes, None] = OrderedDict()
+        self.requests: Dict[bytes, InvRequest] = {}
+        self.partial: Dict[str, PartialBlock] = {}
+        self._queue: Dict[Tuple[object, int], Tuple[bytearray, bytearray]] = {}
+
+    def mark_seen(self, digest: bytes) -> bool:
+        """
+        Remember ``digest``, returns False if it was seen before.
+        """
+        if digest in self.seen:
+            self.seen.move_to_end(digest)
+            return False
+        self.seen[digest] = None
+        while len(self.seen) > self.seen_size:
+            self.seen.popitem(last=False)
+        return True
+
+    def pick_peers(self, fanout: Optional[int], exclude=None) -> List:
+        # the node's cached neighbour lists, nothing is rebuilt per announcement
+        neighbours = self.node.neighbours if exclude is None else self.node.other_neighbours(exclude)
+        peers = [peer for _, peer in neighbours]
+        if fanout is not None and len(peers) > fanout:
+            peers = random.sample(peers, fanout)
+        return peers
+
+    def announce_tx(self, tx, ttl: Optional[int] = None, exclude=None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        digest = bytes.fromhex(tx.tx_id)
+        self.mark_seen(digest)
+        if ttl < 1:
+            return
+        for peer in self.pick_peers(self.fanout, exclude):
+            self._queue_inv(peer, ttl, INV_TX, digest)
+
+    def announce_block(self, block, exclude=None) -> None:
+        digest = bytes.fromhex(block.hash)
+        self.mark_seen(digest)
+        for peer in self.pick_peers(self.block_fanout, exclude):
+            self._queue_inv(peer, 0, INV_BLOCK, digest)
+
+    def _queue_inv(self, peer, ttl: int, kind: int, digest: bytes) -> None:
+        if not self._queue:
+            asyncio.get_running_loop().call_soon(self.flush)
+        tx_hashes, block_hashes = self._queue.setdefault((peer, ttl), (bytearray(), bytearray()))
+        (tx_hashes if kind == INV_TX else block_hashes).extend(digest)
+
+    def flush(self) -> None:
+        queue, self._queue = self._queue, {}
+        for (peer, ttl), (tx_hashes, block_hashes) in queue.items():
+            self.node.ez_send(peer, self.node.create_inventory(ttl, bytes(tx_hashes), bytes(block_hashes)))
+
+    def on_inventory(self, peer, ttl: int, tx_hashes: bytes, block_hashes: bytes) -> None:
+        wanted = {INV_TX: bytearray(), INV_BLOCK: bytearray()}
+        for kind, data in ((INV_TX, tx_hashes), (INV_BLOCK, block_hashes)):
+            for digest in split_hashes(data):
+                request = self.requests.get(digest)
+                if request is not None:
+                    if peer != request.peer:
+                        request.announcers.append(peer)
+                    continue
+                if not self.mark_seen(digest) or self.known(kind, digest):
+                    continue
+                now = time.time()
+                self.requests[digest] = InvRequest(kind, ttl, peer, now + self.request_timeout, now)
+                wanted[kind].extend(digest)
+        if wanted[INV_TX] or wanted[INV_BLOCK]:
+            self.node.ez_send(peer, self.node.create_get_data(bytes(wanted[INV_TX]), bytes(wanted[INV_BLOCK])))
+            self.ensure_tick()
+
+    def known(self, kind: int, digest: bytes) -> bool:
+        if kind == INV_TX:
+            return digest.hex() in self.node.mempool
+        return digest.hex() in self.node.block_tree
+
+    def on_get_data(self, peer, tx_hashes: bytes, block_hashes: bytes) -> None:
+        transactions = [self.node.mempool.get(digest.hex()) for digest in split_hashes(tx_hashes)]
+        self.node.send_transactions(peer, [tx for tx in transactions if tx is not None])
+        for digest in split_hashes(block_hashes):
+            block = self.node.block_tree.get(digest.hex())
+            if block is not None:
+                self.node.ez_send(peer, self.node.create_compact_block(peer, block))
+
+    def received_tx(self, tx) -> Optional[int]:
+        """
+        Called for every incoming transaction, returns the TTL it was announced with if we asked for it.
+        """
+        digest = bytes.fromhex(tx.tx_id)
+        self.mark_seen(digest)
+        request = self.requests.pop(digest, None)
+        return request.ttl if request is not None else None
+
+    def on_compact_block(self, peer, block, tx_ids: bytes) -> None:
+        digest = bytes.fromhex(block.hash)
+        request = self.requests.pop(digest, None)
+        announced = request.announced if request is not None else time.time()
+        self.mark_seen(digest)
+        if block.hash in self.node.block_tree or block.hash in self.partial:
+            return
+        transactions, missing = [], {}
+        for i, tx_id in enumerate(split_hashes(tx_ids)):
+            tx = self.node.mempool.get(tx_id.hex())
+            if tx is None:
+                missing[tx_id] = i
+            transactions.append(tx)
+        if not missing:
+            self.node.register_anonymous_task("complete_block", self.complete, peer, block, transactions, announced)
+            return
+        self.partial[block.hash] = PartialBlock(block, peer, transactions, missing,
+                                                time.time() + self.request_timeout, announced)
+        self.node.ez_send(peer, self.node.create_get_block_transactions(block.hash, b''.join(missing)))
+        self.ensure_tick()
+
+    def on_get_block_txs(self, peer, block_hash: str, tx_hashes: bytes) -> None:
+        block = self.node.block_tree.get(block_hash)
+        if block is None:
+            return
+        wanted = set(split_hashes(tx_hashes))
+        transactions = [tx for tx in block.transactions if bytes.fromhex(tx.tx_id) in wanted]
+        self.node.ez_send(peer, self.node.create_block_transactions(peer, block_hash, transactions))
+
+    def on_block_txs(self, peer, block_hash: str, transactions: List) -> None:
+        partial = self.partial.get(block_hash)
+        if partial is None or partial.peer != peer:
+            return
+        for tx in transactions:
+            i = partial.missing.pop(bytes.fromhex(tx.tx_id), None)
+            if i is not None:
+                partial.transactions[i] = tx
+        if partial.missing:
+            return
+        del self.partial[block_hash]
+        self.node.register_anonymous_task("complete_block", self.complete, peer, partial.block,
+                                          partial.transactions, partial.announced)
+
+    async def complete(self, peer, block, transactions: List, announced: float) -> None:
+        block.transactions = transactions
+        block.merkle_tree = None
+        if block.get_merkle_tree().root != block.merkle_root:
+            # the ids the peer sent do not belong to the header, forget the block so it can be fetched again
+            self.node.metrics.blocks_invalid.inc()
+            self.seen.pop(bytes.fromhex(block.hash), None)
+            return
+        update = await self.node.process_block(peer, block)
+        if update is not None:
+            self.node.metrics.block_propagation_seconds.observe(time.time() - announced)
+            self.node.metrics.blocks_forwarded.inc()
+            self.announce_block(block, exclude=peer)
+
+    def ensure_tick(self) -> None:
+        if not self.node.is_pending_task_active("gossip_requests"):
+            self.node.register_task("gossip_requests", self.tick, interval=self.request_timeout,
+                                    delay=self.request_timeout)
+
+    def tick(self) -> None:
+        """
+        Ask the next announcer for payloads the previous one did not deliver in time.
+        """
+        now = time.time()
+        for digest, request in list(self.requests.items()):
+            if now <= request.deadline:
+                continue
+            if not request.announcers:
+                # forget it, a later announcement can fetch it again
+                del self.requests[digest]
+                self.seen.pop(digest, None)
+                continue
+            request.peer = request.announcers.popleft()
+            request.deadline = now + self.request_timeout
+            if request.kind == INV_TX:
+                self.node.ez_send(request.peer, self.node.create_get_data(digest, b''))
+            else:
+                self.node.ez_send(request.peer, self.node.create_get_data(b'', digest))
+        for block_hash, partial in list(self.partial.items()):
+            if now > partial.deadline:
+                # give up on it, the next announcement or a block sync fetches it again
+                del self.partial[block_hash]
+                self.seen.pop(bytes.fromhex(block_hash), None)
+        if not self.requests and not self.partial:
+            self.node.cancel_pending_task("gossip_requests")
@@ -0,0 +1,192 @@
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from amm import AMM, UNIT, Pool
+
+# in whole coins, the ledger keeps base units
+INITIAL_BALANCES = {'BTC': 100, 'ETH': 1000}
+INITIAL_POOLS = {('BTC', 'ETH'): (10_000, 100_000)}
+# coin a swap pays out for the coin it takes in
+SWAP_TARGET = {'BTC': 'ETH', 'ETH': 'BTC'}
+
+
+class Ledger:
+    """
+    Account balances built by applying every transaction once, when its block joins the longest chain.
+
+    Balances are kept in base units, transaction amounts are whole coins. Transfers are applied in
+    block order, swaps take their input in block order too and are paid out together at the end of
+    the block, at the AMM's clearing price for that block.
+
+    Each applied block leaves an undo record with the previous value of every balance it touched
+    and the pool reserves, so a reorg reverts the disconnected blocks newest first. Only the last
+    ``max_undo_depth`` blocks keep their undo record, and ``applied`` only the transactions of those
+    blocks: replays of older transactions are caught by their stale nonce.
+
+    An account belongs to the key of the first transaction that spends from it, every later transaction
+    from the account has to be signed by that key.
+    """
+
+    def __init__(self, initial_balances: Dict[str, int] = None, max_undo_depth: int = 100,
+                 pools: Dict[Tuple[str, str], Tuple[int, int]] = None) -> None:
+        self.initial_balances = {coin: amount * UNIT for coin, amount in (initial_balances or INITIAL_BALANCES).items()}
+        self.max_undo_depth = max_undo_depth
+        self.balances: Dict[int, Dict[str, int]] = {}
+        self.applied: Dict[str, str] = {}
+        self.owners: Dict[int, bytes] = {}
+        self.undo: Dict[str, Tuple[List[str], List[Tuple[int, str, int]], dict, List[int]]] = OrderedDict()
+        self.tip_hash = None
+        self.amm = AMM(Pool(coin_a, coin_b, reserve_a * UNIT, reserve_b * UNIT)
+                       for (coin_a, coin_b), (reserve_a, reserve_b) in (pools or INITIAL_POOLS).items())
+
+    def balance(self, account: int, coin: str) -> int:
+        account_balances = self.balances.get(account)
+        if account_balances is None:
+            return self.initial_balances.get(coin, 0)
+        return account_balances.get(coin, 0)
+
+    def account(self, account: int) -> Dict[str, int]:
+        balances = self.balances.get(account)
+        return dict(balances) if balances is not None else dict(self.initial_balances)
+
+    def _set(self, account: int, coin: str, value: int, changes: List[Tuple[int, str, int]]) -> None:
+        balances = self.balances.get(account)
+        if balances is None:
+            balances = self.balances[account] = dict(self.initial_balances)
+        changes.append((account, coin, balances.get(coin, 0)))
+        balances[coin] = value
+
+    def malformed(self, tx) -> bool:
+        if tx.coin not in self.initial_balances or tx.amount < 0:
+            return True
+        return tx.is_uniswap and self.amm.pool(tx.coin, SWAP_TARGET.get(tx.coin, '')) is None
+
+    def owns(self, tx) -> bool:
+        """
+        Whether the key that signed ``tx`` may spend from its sender account.
+        """
+        return self.owners.get(tx.sender, tx.public_key_bin) == tx.public_key_bin
+
+    def can_apply(self, tx) -> bool:
+        return tx.tx_id not in self.applied and not self.malformed(tx) and self.owns(tx) and \
+            tx.amount * UNIT <= self.balance(tx.sender, tx.coin)
+
+    def quote(self, coin: str, amount: int) -> int:
+        """
+        Base units of the other coin a swap of ``amount`` whole ``coin`` would get on its own, right now.
+        """
+        return self.amm.quote(coin, SWAP_TARGET.get(coin, ''), amount * UNIT)
+
+    def check_transaction(self, tx, scratch: dict) -> Optional[str]:
+        """
+        Check that ``tx`` can be applied after the changes in ``scratch``, balances by (account, coin) and
+        owners by account, and add its own changes to them. Returns why it cannot be applied, leaving
+        ``scratch`` as it was, or None.
+        """
+        if tx.tx_id in self.applied:
+            return f'transaction {tx.tx_id} is already in the chain'
+        if self.malformed(tx):
+            return f'transaction {tx.tx_id} is malformed'
+        if scratch.get(tx.sender, self.owners.get(tx.sender, tx.public_key_bin)) != tx.public_key_bin:
+            return f'transaction {tx.tx_id} is not signed by the owner of account {tx.sender}'
+        sender = (tx.sender, tx.coin)
+        balance = scratch.get(sender, self.balance(*sender))
+        if tx.amount * UNIT > balance:
+            return f'transaction {tx.tx_id} spends more than the balance of {tx.sender}'
+        scratch[sender] = balance - tx.amount * UNIT
+        scratch[tx.sender] = tx.public_key_bin
+        if not tx.is_uniswap:
+            # swap outputs are only paid at the end of the block
+            receiver = (tx.receiver, tx.coin)
+            scratch[receiver] = scratch.get(receiver, self.balance(*receiver)) + tx.amount * UNIT
+        return None
+
+    def check_block(self, block) -> Optional[str]:
+        """
+        Check that every transaction of ``block`` can be applied on top of the current state, in order,
+        without changing anything. Returns the reason of the first failure or None.
+        """
+        scratch = {}
+        for tx in block.transactions:
+            reason = self.check_transaction(tx, scratch)
+            if reason is not None:
+                return reason
+        return None
+
+    def apply_block(self, block, keep_undo: bool = True) -> List:
+        """
+        Apply the transactions of ``block`` and return the ones that were rejected.
+        """
+        applied, changes, rejected, swaps, bound = [], [], [], [], []
+        reserves = self.amm.snapshot()
+        for tx in block.transactions:
+            if not self.can_apply(tx):
+                rejected.append(tx)
+                continue
+            amount = tx.amount * UNIT
+            if tx.sender not in self.owners:
+                self.owners[tx.sender] = tx.public_key_bin
+                bound.append(tx.sender)
+            self._set(tx.sender, tx.coin, self.balance(tx.sender, tx.coin) - amount, changes)
+            if tx.is_uniswap:
+                swaps.append(tx)
+            else:
+                self._set(tx.receiver, tx.coin, self.balance(tx.receiver, tx.coin) + amount, changes)
+            if keep_undo:
+                self.applied[tx.tx_id] = block.hash
+            applied.append(tx.tx_id)
+        if swaps:
+            outputs = self.amm.settle([(tx.coin, SWAP_TARGET[tx.coin], tx.amount * UNIT) for tx in swaps])
+            for tx, amount in zip(swaps, outputs):
+                coin = SWAP_TARGET[tx.coin]
+                self._set(tx.receiver, coin, self.balance(tx.receiver, coin) + amount, changes)
+        if keep_undo:
+            self.undo[block.hash] = (applied, changes, reserves, bound)
+            while len(self.undo) > self.max_undo_depth:
+                _, (old, *_) = self.undo.popitem(last=False)
+                for tx_id in old:
+                    self.applied.pop(tx_id, None)
+        self.tip_hash = block.hash
+        return rejected
+
+    def revert_block(self, block) -> bool:
+        """
+        Undo ``block``, which has to be the last applied block. Returns False without an undo record.
+        """
+        record = self.undo.pop(block.hash, None)
+        if record is None:
+            return False
+        applied, changes, reserves, bound = record
+        for account, coin, value in reversed(changes):
+            self.balances[account][coin] = value
+        for account in bound:
+            del self.owners[account]
+        self.amm.restore(reserves)
+        for tx_id in applied:
+            self.applied.pop(tx_id, None)
+        self.tip_hash = block.prev_block_hash
+        return True
+
+    def snapshot(self) -> dict:
+        return {'tip': self.tip_hash, 'balances': {str(account): dict(b) for account, b in self.balances.items()},
+                'pools': self.amm.snapshot(),
+                'owners': {str(account): key.hex() for account, key in self.owners.items()}}
+
+    def restore(self, state: dict) -> None:
+        """
+        Load a snapshot, undo records do not survive it so reorgs below this point cannot be reverted.
+        """
+        self.balances = {int(account): dict(b) for account, b in state['balances'].items()}
+        self.tip_hash = state['tip']
+        self.amm.restore(state.get('pools', {}))
+        self.applied.clear()
+        self.owners = {int(account): bytes.fromhex(key) for account, key in state.get('owners', {}).items()}
+        self.undo.clear()
+
+    def replay(self, blocks: Sequence) -> None:
+        """
+        Apply a run of canonical blocks in bulk, e.g. on resync, keeping undo records for the newest ones only.
+        """
+        keep_from = len(blocks) - self.max_undo_depth
+        for i, block in enumerate(blocks):
+            self.apply_block(block, keep_undo=i >= keep_from)
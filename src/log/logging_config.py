@@ -1,9 +1,150 @@
+import atexit
+import json
 import logging
+import logging.handlers
+import os
+import queue
+from typing import Dict, Optional
 
-def setup_logging():
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        filename='./log/app.log',
-        filemode='w'
-    )
\ No newline at end of file
+LOG_DIR = './log'
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# log one in this many records of a high-frequency event, records pass the event with extra={'event': ...}
+SAMPLE_RATES = {'transaction': 100, 'gossip': 100}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the node id, event and sample rate of the record when it has them.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key in ('node', 'event', 'sampled'):
+            value = getattr(record, key, None)
+            if value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class NodeFileHandler(logging.Handler):
+    """
+    Writes the records of every node to its own node<id>.jsonl, rotated once it reaches ``max_bytes``.
+    Records without a node id are left to the other handlers.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, backup_count: int) -> None:
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.handlers: Dict[object, logging.Handler] = {}
+        self.formatter = JsonFormatter()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        node = getattr(record, 'node', None)
+        if node is None:
+            return
+        handler = self.handlers.get(node)
+        if handler is None:
+            handler = self.handlers[node] = logging.handlers.RotatingFileHandler(
+                os.path.join(self.directory, f'node{node}.jsonl'), maxBytes=self.max_bytes,
+                backupCount=self.backup_count, delay=True)
+            handler.setFormatter(self.formatter)
+        handler.handle(record)
+
+    def close(self) -> None:
+        for handler in self.handlers.values():
+            handler.close()
+        super().close()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through the first of every ``rates[event]`` records of a sampled event and marks it with the rate.
+    """
+
+    def __init__(self, rates: Dict[str, int]) -> None:
+        super().__init__()
+        self.rates = rates
+        self.counts: Dict[str, int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, 'event', None)
+        rate = self.rates.get(event, 1)
+        if rate <= 1 or getattr(record, 'sampled', None) is not None:
+            # sampled before, e.g. in the process that sent us the record
+            return True
+        count = self.counts.get(event, 0)
+        self.counts[event] = count + 1
+        if count % rate:
+            return False
+        record.sampled = rate
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the writer thread without formatting them, only the message arguments are merged
+    so that later changes to them do not show up in the log.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class NodeLogger(logging.LoggerAdapter):
+    """
+    Logger whose records carry the node id, they also end up in that node's JSON lines file.
+    Unlike LoggerAdapter it keeps the ``extra`` of the call, such as the sampled event.
+    """
+
+    def __init__(self, name: str, node_id) -> None:
+        super().__init__(logging.getLogger(name), {'node': node_id})
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs['extra']} if 'extra' in kwargs else self.extra
+        return msg, kwargs
+
+
+def setup_logging(level: int = logging.INFO, directory: str = LOG_DIR, text_format: str = TEXT_FORMAT,
+                  max_bytes: int = 10_000_000, backup_count: int = 3,
+                  sample_rates: Dict[str, int] = SAMPLE_RATES) -> logging.handlers.QueueListener:
+    """
+    Send all records through a queue to a writer thread, which writes them as text to app.log and as
+    JSON lines to a file per node. Calling it again keeps the first setup.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+    os.makedirs(directory, exist_ok=True)
+    text = logging.handlers.RotatingFileHandler(os.path.join(directory, 'app.log'), maxBytes=max_bytes,
+                                                backupCount=backup_count)
+    text.setFormatter(logging.Formatter(text_format))
+    nodes = NodeFileHandler(directory, max_bytes, backup_count)
+
+    handler = LazyQueueHandler(queue.SimpleQueue())
+    handler.addFilter(SamplingFilter(sample_rates))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(handler.queue, text, nodes, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
@@ -0,0 +1,198 @@
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+EVICT_OLDEST = 'oldest'
+EVICT_LOWEST_FEE = 'lowest_fee'
+
+
+class Mempool:
+    """
+    Pending and finalized transactions indexed by ``tx_id`` and by (sender key, nonce).
+
+    Pending transactions are kept in arrival order, so iterating the mempool yields them oldest first.
+    Adding, finalizing and evicting a transaction are O(1), except for lowest-fee eviction which pops a heap.
+    When more than ``capacity`` transactions are pending, the ``eviction`` policy picks the one to drop
+    and ``on_evict``, when given, is called with it.
+    Every transaction gets an arrival number, ``page`` walks them in that order from a cursor.
+    """
+
+    def __init__(self, capacity: int = 10_000, eviction: str = EVICT_OLDEST, max_finalized: int = 100_000,
+                 on_evict: Optional[Callable[[object], None]] = None) -> None:
+        if eviction not in (EVICT_OLDEST, EVICT_LOWEST_FEE):
+            raise ValueError(f'Unknown eviction policy {eviction}')
+        self.capacity = capacity
+        self.eviction = eviction
+        # finalized transactions are kept on disk with their blocks, only the newest ones stay here
+        self.max_finalized = max_finalized
+        self.on_evict = on_evict
+        self.pending: Dict[str, object] = OrderedDict()
+        self.finalized: Dict[str, object] = OrderedDict()
+        self.evicted = 0
+        self._keys: Dict[Tuple[bytes, int], str] = {}
+        self._seq: Dict[str, int] = {}
+        self._next_seq = 0
+        # arrival numbers in increasing order, the ones of dropped transactions are skipped lazily
+        self._order: List[int] = []
+        self._by_seq: Dict[int, str] = {}
+        self._fee_heap: List[Tuple[int, int, str]] = []
+
+    @staticmethod
+    def key(tx) -> Tuple[bytes, int]:
+        return tx.public_key_bin, tx.nonce
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def __iter__(self) -> Iterator:
+        return iter(self.pending.values())
+
+    def __contains__(self, tx_id: str) -> bool:
+        return tx_id in self.pending or tx_id in self.finalized
+
+    def contains(self, tx) -> bool:
+        """
+        Whether ``tx`` or another transaction with the same sender and nonce was already seen.
+        """
+        return tx.tx_id in self or self.key(tx) in self._keys
+
+    def get(self, tx_id: str):
+        return self.pending.get(tx_id) or self.finalized.get(tx_id)
+
+    def seq(self, tx_id: str) -> Optional[int]:
+        """
+        Arrival number of a transaction, increasing over the lifetime of the mempool.
+        """
+        return self._seq.get(tx_id)
+
+    def by_fee(self) -> List:
+        """
+        Pending transactions by highest fee first, ties broken by arrival order.
+        """
+        return sorted(self.pending.values(), key=lambda tx: (-tx.fee, self._seq[tx.tx_id]))
+
+    def add(self, tx) -> bool:
+        """
+        Add a new pending transaction, returns False for duplicates or if it got evicted right away.
+        """
+        if self.contains(tx):
+            return False
+        self._insert(tx)
+        self._trim()
+        return tx.tx_id in self.pending
+
+    def _trim(self) -> None:
+        while len(self.pending) > self.capacity:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop one pending transaction according to the eviction policy.
+        """
+        if not self.pending:
+            return None
+        if self.eviction == EVICT_OLDEST:
+            tx_id = next(iter(self.pending))
+        else:
+            tx_id = self._pop_lowest_fee()
+        self.evicted += 1
+        tx = self.remove(tx_id)
+        if self.on_evict is not None:
+            self.on_evict(tx)
+        return tx
+
+    def _pop_lowest_fee(self) -> str:
+        # entries of transactions that were removed, finalized or re-inserted since are skipped
+        while True:
+            _, seq, tx_id = heapq.heappop(self._fee_heap)
+            if self._by_seq.get(seq) == tx_id and tx_id in self.pending:
+                return tx_id
+
+    def remove(self, tx_id: str):
+        tx = self.pending.pop(tx_id, None)
+        if tx is not None:
+            self._keys.pop(self.key(tx), None)
+            self._drop_seq(tx_id)
+        return tx
+
+    def finalize(self, tx) -> None:
+        """
+        Move ``tx`` from pending to finalized, it does not have to be pending.
+        """
+        if tx.tx_id in self.finalized:
+            return
+        if self.pending.pop(tx.tx_id, None) is None:
+            self._assign_seq(tx.tx_id)
+        self.finalized[tx.tx_id] = tx
+        self._keys[self.key(tx)] = tx.tx_id
+        while len(self.finalized) > self.max_finalized:
+            tx_id, old = self.finalized.popitem(last=False)
+            self._keys.pop(self.key(old), None)
+            self._drop_seq(tx_id)
+
+    def unfinalize(self, tx) -> None:
+        """
+        Put a finalized transaction back to pending, for blocks that left the longest chain.
+        """
+        if self.finalized.pop(tx.tx_id, None) is None:
+            return
+        self._keys.pop(self.key(tx), None)
+        self._drop_seq(tx.tx_id)
+        self._insert(tx)
+        self._trim()
+
+    def _insert(self, tx) -> None:
+        self.pending[tx.tx_id] = tx
+        self._keys[self.key(tx)] = tx.tx_id
+        seq = self._assign_seq(tx.tx_id)
+        if self.eviction == EVICT_LOWEST_FEE:
+            heapq.heappush(self._fee_heap, (tx.fee, seq, tx.tx_id))
+            if len(self._fee_heap) > 2 * len(self.pending) + 64:
+                self._fee_heap = [(t.fee, self._seq[i], i) for i, t in self.pending.items()]
+                heapq.heapify(self._fee_heap)
+
+    def _assign_seq(self, tx_id: str) -> int:
+        seq = self._seq[tx_id] = self._next_seq
+        self._by_seq[seq] = tx_id
+        self._order.append(seq)
+        self._next_seq += 1
+        return seq
+
+    def _drop_seq(self, tx_id: str) -> None:
+        seq = self._seq.pop(tx_id, None)
+        if seq is None:
+            return
+        del self._by_seq[seq]
+        if len(self._order) > 2 * len(self._by_seq) + 64:
+            self._order = [seq for seq in self._order if seq in self._by_seq]
+
+    def page(self, cursor: Optional[int] = None, limit: int = 50, sender: Optional[int] = None,
+             receiver: Optional[int] = None, status: Optional[str] = None,
+             newest_first: bool = False) -> Tuple[List[Tuple[int, str, object]], Optional[int]]:
+        """
+        Up to ``limit`` (seq, status, tx) entries that arrived after ``cursor``, or before it when ``newest_first``,
+        where status is 'pending' or 'finalized'. Also returns the cursor of the next page, None on the last page.
+        """
+        entries = []
+        if newest_first:
+            start = len(self._order) if cursor is None else bisect_left(self._order, cursor)
+            indices = range(start - 1, -1, -1)
+        else:
+            start = 0 if cursor is None else bisect_right(self._order, cursor)
+            indices = range(start, len(self._order))
+        for i in indices:
+            seq = self._order[i]
+            tx_id = self._by_seq.get(seq)
+            if tx_id is None:
+                continue
+            tx = self.pending.get(tx_id)
+            tx_status = 'pending' if tx is not None else 'finalized'
+            tx = tx or self.finalized[tx_id]
+            if (sender is not None and tx.sender != sender) or (receiver is not None and tx.receiver != receiver) \
+                    or (status is not None and tx_status != status):
+                continue
+            entries.append((seq, tx_status, tx))
+            if len(entries) == limit:
+                return entries, seq
+        return entries, None
@@ -1,38 +1,166 @@
 import hashlib
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
+HASH_SIZE = 32
+EMPTY_ROOT = bytes(HASH_SIZE)
 
-def hash_pair(a, b):
-    return hashlib.sha256(a.encode() + b.encode()).hexdigest()
 
-def merkle_root(transactions):
-    if not transactions:
+def hash_pair(a: bytes, b: bytes) -> bytes:
+    return hashlib.sha256(a + b).digest()
+
+
+@dataclass(frozen=True)
+class MerkleProof:
+    index: int
+    leaf_count: int
+    # sibling hashes from the leaf level up to just below the root
+    siblings: Tuple[bytes, ...]
+
+
+@dataclass(frozen=True)
+class MerkleMultiProof:
+    indices: Tuple[int, ...]
+    leaf_count: int
+    # hashes the verifier cannot compute itself, in the order it needs them
+    hashes: Tuple[bytes, ...]
+
+
+class MerkleTree:
+    """
+    Merkle tree over 32-byte leaf digests, every level is one contiguous buffer of raw digests.
+
+    A level with an odd number of nodes pairs its last node with itself.
+    Siblings are adjacent in the buffer, so a parent is the hash of one 64-byte slice of its child level.
+    """
+
+    def __init__(self, leaves: Iterable[bytes]) -> None:
+        level = bytearray(b''.join(leaves))
+        if len(level) % HASH_SIZE:
+            raise ValueError(f'Merkle leaves have to be {HASH_SIZE} byte digests')
+        self.leaf_count = len(level) // HASH_SIZE
+        self.levels: List[bytearray] = [level]
+        while len(level) > HASH_SIZE:
+            level = self._parent_level(level)
+            self.levels.append(level)
+
+    @staticmethod
+    def _parent_level(level: bytearray) -> bytearray:
+        count = len(level) // HASH_SIZE
+        parents = bytearray(((count + 1) // 2) * HASH_SIZE)
+        view = memoryview(level)
+        pairs = count // 2
+        for i in range(pairs):
+            parents[i * HASH_SIZE:(i + 1) * HASH_SIZE] = hashlib.sha256(view[2 * i * HASH_SIZE:(2 * i + 2) * HASH_SIZE]).digest()
+        if count % 2:
+            last = bytes(view[(count - 1) * HASH_SIZE:])
+            parents[pairs * HASH_SIZE:] = hash_pair(last, last)
+        return parents
+
+    def __len__(self) -> int:
+        return self.leaf_count
+
+    @property
+    def root(self) -> bytes:
+        return bytes(self.levels[-1]) if self.leaf_count else EMPTY_ROOT
+
+    def node(self, depth: int, index: int) -> bytes:
+        level = self.levels[depth]
+        return bytes(level[index * HASH_SIZE:(index + 1) * HASH_SIZE])
+
+    def _sibling(self, depth: int, index: int) -> int:
+        sibling = index ^ 1
+        return sibling if sibling < len(self.levels[depth]) // HASH_SIZE else index
+
+    def proof(self, index: int) -> MerkleProof:
+        """
+        Inclusion proof of the leaf at ``index``, holding one sibling hash per level.
+        """
+        if not 0 <= index < self.leaf_count:
+            raise IndexError(index)
+        siblings = []
+        position = index
+        for depth in range(len(self.levels) - 1):
+            siblings.append(self.node(depth, self._sibling(depth, position)))
+            position //= 2
+        return MerkleProof(index=index, leaf_count=self.leaf_count, siblings=tuple(siblings))
+
+    def multiproof(self, indices: Iterable[int]) -> MerkleMultiProof:
+        """
+        One proof for several leaves, hashes shared by their paths are included only once.
+        """
+        leaves = sorted(set(indices))
+        if any(not 0 <= i < self.leaf_count for i in leaves):
+            raise IndexError(leaves)
+        hashes = []
+        known = leaves
+        for depth in range(len(self.levels) - 1):
+            known_set = set(known)
+            for i in known:
+                sibling = self._sibling(depth, i)
+                if sibling not in known_set:
+                    hashes.append(self.node(depth, sibling))
+            known = sorted({i // 2 for i in known})
+        return MerkleMultiProof(indices=tuple(leaves), leaf_count=self.leaf_count, hashes=tuple(hashes))
+
+
+def merkle_root(leaves: Sequence[bytes]) -> bytes:
+    return MerkleTree(leaves).root
+
+
+def merkle_proof(leaf: bytes, leaves: Sequence[bytes]) -> Optional[MerkleProof]:
+    """
+    Inclusion proof for ``leaf``, or None if it is not one of ``leaves``.
+    """
+    try:
+        index = list(leaves).index(leaf)
+    except ValueError:
         return None
-    if len(transactions) == 1:
-        return transactions[0]
-    if len(transactions) % 2 == 1:
-        transactions.append(transactions[-1])
-    new_level = []
-    for i in range(0, len(transactions), 2):
-        new_level.append(hash_pair(transactions[i], transactions[i+1]))
-    return merkle_root(new_level)
-
-def merkle_proof(transaction, block_transactions):
-    if transaction not in block_transactions:
+    return MerkleTree(leaves).proof(index)
+
+
+def proof_depth(leaf_count: int) -> int:
+    depth = 0
+    while leaf_count > 1:
+        leaf_count = (leaf_count + 1) // 2
+        depth += 1
+    return depth
+
+
+def verify_proof(leaf: bytes, proof: MerkleProof, root: bytes) -> bool:
+    """
+    Check an inclusion proof against a root without the other leaves.
+    """
+    if not 0 <= proof.index < proof.leaf_count or len(proof.siblings) != proof_depth(proof.leaf_count):
+        return False
+    digest = leaf
+    index = proof.index
+    for sibling in proof.siblings:
+        digest = hash_pair(digest, sibling) if index % 2 == 0 else hash_pair(sibling, digest)
+        index //= 2
+    return digest == root
+
+
+def verify_multiproof(leaves: Dict[int, bytes], proof: MerkleMultiProof, root: bytes) -> bool:
+    """
+    Check a multiproof, ``leaves`` maps every index in the proof to its leaf digest.
+    """
+    if sorted(leaves) != list(proof.indices) or any(not 0 <= i < proof.leaf_count for i in leaves):
+        return False
+    nodes = dict(leaves)
+    count = proof.leaf_count
+    hashes = iter(proof.hashes)
+    try:
+        while count > 1:
+            parents = {}
+            for i in sorted(nodes):
+                if i // 2 in parents:
+                    continue
+                sibling = i ^ 1 if (i ^ 1) < count else i
+                sibling_hash = nodes[sibling] if sibling in nodes else next(hashes)
+                parents[i // 2] = hash_pair(nodes[i], sibling_hash) if i % 2 == 0 else hash_pair(sibling_hash, nodes[i])
+            nodes = parents
+            count = (count + 1) // 2
+    except StopIteration:
         return False
-    if len(block_transactions) == 1:
-        return transaction == block_transactions[0]
-    if len(block_transactions) % 2 == 1:
-        block_transactions.append(block_transactions[-1])
-    new_level = []
-    index = block_transactions.index(transaction)
-    if index % 2 == 0:
-        sibling = block_transactions[index + 1]
-        new_transaction = hash_pair(transaction, sibling)
-    else:
-        sibling = block_transactions[index - 1]
-        new_transaction = hash_pair(sibling, transaction)
-    for i in range(0, len(block_transactions), 2):
-        if i != index and i+1 != index:
-            new_level.append(hash_pair(block_transactions[i], block_transactions[i+1]))
-    new_level.append(new_transaction)
-    return merkle_proof(new_transaction, new_level)
\ No newline at end of file
+    return next(hashes, None) is None and nodes.get(0) == root
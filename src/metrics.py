@@ -0,0 +1,219 @@
+import bisect
+import math
+import time
+from asyncio import iscoroutine
+from functools import wraps
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# seconds, from a cached lookup to a block that waited for its signatures
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+MINING_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+PROPAGATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(labels: Dict[str, object]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+               for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+class Counter:
+    kind = 'counter'
+    __slots__ = ('labels', 'value')
+
+    def __init__(self, labels: Dict[str, object]) -> None:
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def samples(self, name: str):
+        yield name, self.labels, self.value
+
+
+class Gauge:
+    """
+    A value that is set, or read from ``function`` when the metrics are collected.
+    """
+    kind = 'gauge'
+    __slots__ = ('labels', 'value', 'function')
+
+    def __init__(self, labels: Dict[str, object], function: Optional[Callable[[], float]] = None) -> None:
+        self.labels = labels
+        self.value = 0
+        self.function = function
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self, name: str):
+        yield name, self.labels, self.function() if self.function is not None else self.value
+
+
+class Histogram:
+    """
+    Counts per bucket, the cumulative counts Prometheus expects are only added up when collected.
+    """
+    kind = 'histogram'
+    __slots__ = ('labels', 'bounds', 'counts', 'sum')
+
+    def __init__(self, labels: Dict[str, object], bounds: Sequence[float]) -> None:
+        self.labels = labels
+        self.bounds = tuple(bounds)
+        # the last bucket is +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def samples(self, name: str):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', {**self.labels, 'le': format_value(bound)}, cumulative
+        yield f'{name}_sum', self.labels, self.sum
+        yield f'{name}_count', self.labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms that are created once and then updated in place. They are only
+    touched from the event loop, so an update is an attribute increment without locks. ``labels``
+    are added to every sample, e.g. the node id when several nodes share one /metrics endpoint.
+    """
+
+    def __init__(self, prefix: str = 'vadam_', **labels) -> None:
+        self.prefix = prefix
+        self.labels: Dict[str, object] = labels
+        # name -> (kind, help, metrics by their labels)
+        self.families: Dict[str, Tuple[str, str, Dict[tuple, object]]] = {}
+
+    def _get(self, cls, name: str, help_text: str, labels: Dict[str, object], *args):
+        name = self.prefix + name
+        kind, _, metrics = self.families.setdefault(name, (cls.kind, help_text, {}))
+        if kind != cls.kind:
+            raise ValueError(f'{name} is a {kind}, not a {cls.kind}')
+        key = tuple(sorted(labels.items()))
+        metric = metrics.get(key)
+        if metric is None:
+            metric = metrics[key] = cls(labels, *args)
+        return metric
+
+    def counter(self, name: str, help_text: str, **labels) -> Counter:
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str, function: Optional[Callable[[], float]] = None, **labels) -> Gauge:
+        return self._get(Gauge, name, help_text, labels, function)
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  **labels) -> Histogram:
+        return self._get(Histogram, name, help_text, labels, buckets)
+
+    def collect(self):
+        """
+        (name, kind, help, samples) of every family, a sample being (name, labels, value).
+        """
+        for name, (kind, help_text, metrics) in self.families.items():
+            samples = []
+            for metric in metrics.values():
+                samples.extend((sample, {**self.labels, **labels}, value)
+                               for sample, labels, value in metric.samples(name))
+            yield name, kind, help_text, samples
+
+
+def render(registries: Iterable[MetricsRegistry]) -> str:
+    """
+    The registries in the Prometheus text format, families with the same name are merged.
+    """
+    families: Dict[str, Tuple[str, str, List]] = {}
+    for registry in registries:
+        for name, kind, help_text, samples in registry.collect():
+            families.setdefault(name, (kind, help_text, []))[2].extend(samples)
+    lines = []
+    for name, (kind, help_text, samples) in families.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{sample}{format_labels(labels)} {format_value(value)}' for sample, labels, value in samples)
+    return '\n'.join(lines) + '\n'
+
+
+def timed(histogram: Histogram, callback: Callable) -> Callable:
+    """
+    ``callback`` recording how long every call takes in ``histogram``, until the coroutine it returns
+    finishes if it is async.
+    """
+    @wraps(callback)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = callback(*args, **kwargs)
+        if iscoroutine(result):
+            return _timed_coroutine(histogram, start, result)
+        histogram.observe(time.perf_counter() - start)
+        return result
+    return wrapper
+
+
+async def _timed_coroutine(histogram: Histogram, start: float, coroutine):
+    try:
+        return await coroutine
+    finally:
+        histogram.observe(time.perf_counter() - start)
+
+
+class NodeMetrics(MetricsRegistry):
+    """
+    The series of a BlockchainNode. Counters are bumped by the handlers, gauges read the node's state
+    only when the metrics are collected.
+    """
+
+    def __init__(self, node) -> None:
+        super().__init__()
+        self.node = node
+        self.transactions_received = self.counter('transactions_received_total', 'Transactions received from peers')
+        self.transactions_forwarded = self.counter('transactions_forwarded_total', 'Transactions passed on to peers')
+        self.transactions_duplicate = self.counter('transactions_duplicate_total', 'Transactions we already had')
+        self.transactions_invalid = self.counter('transactions_invalid_total', 'Transactions dropped as invalid')
+        self.blocks_received = self.counter('blocks_received_total', 'Blocks received from peers')
+        self.blocks_forwarded = self.counter('blocks_forwarded_total', 'Blocks passed on to peers')
+        self.blocks_duplicate = self.counter('blocks_duplicate_total', 'Blocks we already had')
+        self.blocks_invalid = self.counter('blocks_invalid_total', 'Blocks dropped as invalid')
+
+        self.gauge('mempool_size', 'Pending transactions', lambda: len(node.mempool))
+        self.gauge('chain_height', 'Blocks on the longest chain', lambda: node.block_tree.height)
+        self.gauge('fork_count', 'Tips of the block tree', lambda: node.block_tree.fork_count)
+        self.gauge('collisions', 'Transactions received more than once', lambda: node.collision_num)
+
+        self.mining_seconds = self.histogram('mining_seconds', 'Time to mine a block', MINING_BUCKETS)
+        self.block_propagation_seconds = self.histogram(
+            'block_propagation_seconds', 'Time from the first announcement of a block to accepting it',
+            PROPAGATION_BUCKETS)
+
+    def collect(self):
+        # the node id is only known once the node is started
+        node_id = getattr(self.node, 'node_id', None)
+        if node_id is not None:
+            self.labels['node'] = node_id
+        return super().collect()
+
+    def time_handler(self, callback: Callable) -> Callable:
+        histogram = self.histogram('handler_seconds', 'Time spent handling a message',
+                                   handler=getattr(callback, '__name__', 'unknown'))
+        return timed(histogram, callback)
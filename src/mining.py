@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from difficulty import MAX_TARGET
+
+
+def search_nonces(prefix: bytes, suffix: bytes, target_bytes: bytes, start: int, count: int) -> Optional[Tuple[int, bytes]]:
+    """
+    Scan ``count`` nonces starting at ``start`` and return the first (nonce, digest) below the target.
+
+    The fixed part of the header is hashed once and its state is copied for every nonce,
+    digests are compared as raw big-endian bytes so no hex conversion happens in the loop.
+    """
+    base = hashlib.sha256(prefix)
+    for nonce in range(start, start + count):
+        h = base.copy()
+        h.update(b'%d%s' % (nonce, suffix))
+        digest = h.digest()
+        if digest < target_bytes:
+            return nonce, digest
+    return None
+
+
+@dataclass
+class MiningJob:
+    number: int
+    prefix: bytes
+    suffix: bytes
+    target: int
+    start_nonce: int = 0
+    cancelled: bool = field(default=False, compare=False)
+
+    @property
+    def target_bytes(self) -> bytes:
+        return min(self.target, MAX_TARGET).to_bytes(32, 'big')
+
+
+@dataclass
+class MiningResult:
+    nonce: int
+    hash: str
+    hashes: int
+    seconds: float
+
+
+class MiningEngine:
+    """
+    Searches the nonce space of a MiningJob without blocking the event loop.
+
+    The nonce space is cut into chunks of ``chunk_size`` that are handed to ``workers``
+    executor slots at a time, a cancelled job stops as soon as the running chunks return.
+    This base engine uses the default thread executor, see ProcessPoolMiningEngine for multi-core mining.
+    """
+
+    def __init__(self, workers: int = 1, chunk_size: int = 20_000) -> None:
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.hashes = 0
+        self.seconds = 0.0
+        self.job: Optional[MiningJob] = None
+
+    @property
+    def hashrate(self) -> float:
+        """
+        Hashes per second over everything this engine has mined so far.
+        """
+        return self.hashes / self.seconds if self.seconds else 0.0
+
+    def executor(self) -> Optional[Executor]:
+        return None
+
+    def cancel(self) -> bool:
+        """
+        Cancel the running job, returns False if there was none.
+        """
+        if self.job is None or self.job.cancelled:
+            return False
+        self.job.cancelled = True
+        return True
+
+    def close(self) -> None:
+        """
+        Cancel the running job and release the executor, the engine is not used anymore.
+        """
+        self.cancel()
+
+    async def mine(self, job: MiningJob) -> Optional[MiningResult]:
+        """
+        Mine ``job`` and return the winning nonce, or None if the job got cancelled.
+        """
+        if self.job is not None:
+            self.job.cancelled = True
+        self.job = job
+        loop = asyncio.get_running_loop()
+        executor = self.executor()
+        target_bytes = job.target_bytes
+        next_nonce = job.start_nonce
+        pending: Dict[asyncio.Future, int] = {}
+        hashes = 0
+        started = time.perf_counter()
+        try:
+            while not job.cancelled:
+                while len(pending) < self.workers:
+                    future = loop.run_in_executor(executor, search_nonces, job.prefix, job.suffix, target_bytes,
+                                                  next_nonce, self.chunk_size)
+                    pending[future] = next_nonce
+                    next_nonce += self.chunk_size
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    start = pending.pop(future)
+                    found = future.result()
+                    if found is None:
+                        hashes += self.chunk_size
+                        continue
+                    nonce, digest = found
+                    hashes += nonce - start + 1
+                    if not job.cancelled:
+                        return MiningResult(nonce, digest.hex(), hashes, time.perf_counter() - started)
+            return None
+        finally:
+            for future in pending:
+                future.cancel()
+            self.hashes += hashes
+            self.seconds += time.perf_counter() - started
+            if self.job is job:
+                self.job = None
+
+
+_pools: Dict[int, ProcessPoolExecutor] = {}
+# number of engines using each pool, the last one to close shuts it down
+_pool_users: Dict[int, int] = {}
+
+
+class ProcessPoolMiningEngine(MiningEngine):
+    """
+    MiningEngine that spreads the nonce chunks over a process pool, shared by all nodes of this process.
+    """
+
+    def __init__(self, workers: Optional[int] = None, chunk_size: int = 50_000) -> None:
+        super().__init__(workers or os.cpu_count() or 1, chunk_size)
+        self.pool: Optional[ProcessPoolExecutor] = None
+
+    def executor(self) -> Executor:
+        if self.pool is None:
+            if self.workers not in _pools:
+                _pools[self.workers] = ProcessPoolExecutor(max_workers=self.workers)
+            self.pool = _pools[self.workers]
+            _pool_users[self.workers] = _pool_users.get(self.workers, 0) + 1
+        return self.pool
+
+    def close(self) -> None:
+        super().close()
+        if self.pool is None:
+            return
+        self.pool = None
+        _pool_users[self.workers] -= 1
+        if not _pool_users[self.workers]:
+            del _pool_users[self.workers]
+            _pools.pop(self.workers).shutdown(wait=False, cancel_futures=True)
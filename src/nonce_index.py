@@ -0,0 +1,120 @@
+from typing import Dict, List, Optional
+
+# nodes number their transactions from 1
+FIRST_NONCE = 1
+
+
+class NonceIndex:
+    """
+    Next expected nonce of every account, keyed by public key.
+
+    ``confirmed`` is the nonce after the highest one on the longest chain and ``ready`` the nonce after
+    the run of pending transactions that follows it without gaps. Only ready transactions go into blocks,
+    so every sender's transactions are mined in order. Transactions that arrive ahead of a gap wait in a
+    small buffer of at most ``max_gap`` nonces past ``ready`` and become ready once the gap is filled.
+    Stale nonces and nonces too far ahead are rejected with two dict lookups, before the signature is checked.
+    """
+
+    def __init__(self, max_gap: int = 32) -> None:
+        self.max_gap = max_gap
+        self.confirmed: Dict[bytes, int] = {}
+        self.ready: Dict[bytes, int] = {}
+        self.held: Dict[bytes, Dict[int, object]] = {}
+        self.rejected = 0
+
+    def next_nonce(self, public_key_bin: bytes) -> int:
+        """
+        Nonce the next transaction of the account should use.
+        """
+        return self.ready.get(public_key_bin, self.confirmed.get(public_key_bin, FIRST_NONCE))
+
+    def next_confirmed(self, public_key_bin: bytes) -> int:
+        """
+        Nonce the account's next transaction on the longest chain has to use.
+        """
+        return self.confirmed.get(public_key_bin, FIRST_NONCE)
+
+    def check(self, tx) -> Optional[str]:
+        """
+        Return why ``tx`` cannot be accepted, or None if its nonce is acceptable.
+        """
+        if tx.nonce < self.confirmed.get(tx.public_key_bin, FIRST_NONCE):
+            self.rejected += 1
+            return f'nonce {tx.nonce} is already used on the chain'
+        if tx.nonce >= self.next_nonce(tx.public_key_bin) + self.max_gap:
+            self.rejected += 1
+            return f'nonce {tx.nonce} is too far ahead of {self.next_nonce(tx.public_key_bin)}'
+        return None
+
+    def is_ready(self, tx) -> bool:
+        return tx.nonce < self.next_nonce(tx.public_key_bin)
+
+    def add(self, tx) -> List:
+        """
+        Record a pending transaction and return the ones that became ready, in nonce order.
+        """
+        expected = self.next_nonce(tx.public_key_bin)
+        if tx.nonce < expected:
+            # pending again after a reorg or evicted earlier
+            return [tx]
+        if tx.nonce > expected:
+            self.held.setdefault(tx.public_key_bin, {})[tx.nonce] = tx
+            return []
+        return [tx] + self._release(tx.public_key_bin, expected + 1)
+
+    def discard(self, tx) -> None:
+        """
+        Forget a held transaction that left the mempool, another one may take its nonce.
+        """
+        held = self.held.get(tx.public_key_bin)
+        if held is not None and getattr(held.get(tx.nonce), 'tx_id', None) == tx.tx_id:
+            del held[tx.nonce]
+            if not held:
+                del self.held[tx.public_key_bin]
+
+    def _release(self, public_key_bin: bytes, nonce: int) -> List:
+        held = self.held.get(public_key_bin, {})
+        released = []
+        while nonce in held:
+            released.append(held.pop(nonce))
+            nonce += 1
+        self.ready[public_key_bin] = nonce
+        if not held:
+            self.held.pop(public_key_bin, None)
+        return released
+
+    def confirm(self, block) -> List:
+        """
+        Advance the accounts of a block that joined the longest chain, returns the transactions this made ready.
+        """
+        released = []
+        for tx in block.transactions:
+            public_key_bin = tx.public_key_bin
+            if tx.nonce < self.confirmed.get(public_key_bin, FIRST_NONCE):
+                continue
+            self.confirmed[public_key_bin] = tx.nonce + 1
+            held = self.held.get(public_key_bin)
+            if held:
+                for nonce in [nonce for nonce in held if nonce <= tx.nonce]:
+                    del held[nonce]
+            if self.ready.get(public_key_bin, FIRST_NONCE) <= tx.nonce:
+                released.extend(self._release(public_key_bin, tx.nonce + 1))
+        return released
+
+    def revert(self, block) -> None:
+        """
+        Move the accounts of a block that left the longest chain back, its transactions are pending again.
+        """
+        for tx in block.transactions:
+            public_key_bin = tx.public_key_bin
+            self.ready[public_key_bin] = max(self.next_nonce(public_key_bin), tx.nonce + 1)
+            if tx.nonce < self.confirmed.get(public_key_bin, FIRST_NONCE):
+                self.confirmed[public_key_bin] = tx.nonce
+
+    def snapshot(self) -> dict:
+        return {public_key_bin.hex(): nonce for public_key_bin, nonce in self.confirmed.items()}
+
+    def restore(self, state: dict) -> None:
+        self.confirmed = {bytes.fromhex(public_key): nonce for public_key, nonce in state.items()}
+        self.ready.clear()
+        self.held.clear()
@@ -0,0 +1,183 @@
+import os
+import sys
+import threading
+import time
+import types
+from asyncio import iscoroutine, iscoroutinefunction
+from collections import Counter
+from functools import wraps
+from typing import Callable, Dict, List, Optional
+
+
+class CallStats:
+    __slots__ = ('calls', 'wall', 'cpu', 'max_wall')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+    def record(self, wall: float, cpu: float) -> None:
+        self.calls += 1
+        self.wall += wall
+        self.cpu += cpu
+        if wall > self.max_wall:
+            self.max_wall = wall
+
+    def view(self, name: str) -> dict:
+        return {'name': name, 'calls': self.calls, 'wall': self.wall, 'cpu': self.cpu,
+                'mean_wall': self.wall / self.calls if self.calls else 0.0, 'max_wall': self.max_wall}
+
+
+@types.coroutine
+def _steps(stats: CallStats, coroutine, wall: float, cpu: float):
+    # drives ``coroutine`` and only counts the CPU time of its own steps, not of the tasks that run
+    # while it waits
+    value, error = None, None
+    try:
+        while True:
+            step = time.thread_time()
+            try:
+                yielded = coroutine.send(value) if error is None else coroutine.throw(error)
+            except StopIteration as e:
+                return e.value
+            finally:
+                cpu += time.thread_time() - step
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+    finally:
+        stats.record(time.perf_counter() - wall, cpu)
+
+
+async def _profiled(stats: CallStats, coroutine, wall: float, cpu: float):
+    return await _steps(stats, coroutine, wall, cpu)
+
+
+class CallProfiler:
+    """
+    Wall and CPU time per message handler and task, by name. Wrapping costs two clock reads per call,
+    or per step of a coroutine, and the totals are kept from the start of the node.
+    """
+
+    def __init__(self) -> None:
+        self.stats: Dict[str, CallStats] = {}
+
+    def wrap(self, name: str, callback: Callable) -> Callable:
+        stats = self.stats.setdefault(name, CallStats())
+        if iscoroutinefunction(callback):
+            @wraps(callback)
+            async def async_wrapper(*args, **kwargs):
+                return await _steps(stats, callback(*args, **kwargs), time.perf_counter(), 0.0)
+            return async_wrapper
+
+        @wraps(callback)
+        def wrapper(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            result = callback(*args, **kwargs)
+            if iscoroutine(result):
+                # e.g. a message_wrapper around an async handler
+                return _profiled(stats, result, wall, time.thread_time() - cpu)
+            stats.record(time.perf_counter() - wall, time.thread_time() - cpu)
+            return result
+        return wrapper
+
+    def report(self) -> List[dict]:
+        """
+        The stats of every name that was called, the most wall time first.
+        """
+        views = [stats.view(name) for name, stats in self.stats.items() if stats.calls]
+        return sorted(views, key=lambda view: view['wall'], reverse=True)
+
+    def reset(self) -> None:
+        for name in self.stats:
+            self.stats[name] = CallStats()
+
+
+def task_name(name) -> str:
+    # anonymous tasks are named basename + ' ' + counter, their stats are kept under the basename
+    base, _, suffix = str(name).rpartition(' ')
+    return base if base and suffix.isdigit() else str(name)
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of one thread, the event loop's by default, every ``interval`` seconds from a
+    background thread, while it is started. The nodes of a process share the event loop, so the
+    samples cover all of them.
+
+    ``collapsed`` returns the samples as collapsed stacks, one ``frame;frame;frame count`` line per
+    stack, which flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, thread_id: Optional[int] = None, interval: float = 0.005, max_depth: int = 100) -> None:
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval = interval
+        self.max_depth = max_depth
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.started_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self._names: Dict[types.CodeType, str] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: Optional[float] = None) -> bool:
+        """
+        Start sampling from scratch, returns False if it was running already.
+        """
+        if self.running:
+            return False
+        if interval is not None:
+            self.interval = interval
+        self.stacks.clear()
+        self.samples = 0
+        self.started_at, self.stopped_at = time.time(), None
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self) -> bool:
+        if not self.running:
+            return False
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.stopped_at = time.time()
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.stacks[self.collapse(frame)] += 1
+            self.samples += 1
+
+    def frame_name(self, code: types.CodeType) -> str:
+        name = self._names.get(code)
+        if name is None:
+            name = self._names[code] = f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+        return name
+
+    def collapse(self, frame) -> str:
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            names.append(self.frame_name(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self) -> str:
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+    def status(self) -> dict:
+        end = self.stopped_at if self.stopped_at is not None else time.time()
+        return {'running': self.running, 'interval': self.interval, 'samples': self.samples,
+                'stacks': len(self.stacks), 'seconds': end - self.started_at if self.started_at else 0.0}
@@ -0,0 +1,200 @@
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from amm import UNIT
+from difficulty import difficulty
+
+# the API calls finalized transactions processed
+STATUS_NAMES = {'pending': 'pending', 'finalized': 'processed'}
+
+
+def transaction_view(tx, status: str, block=None) -> dict:
+    return {
+        "status": status,
+        "hash_id": tx.tx_id,
+        "sender": tx.sender,
+        "receiver": tx.receiver,
+        "coin": tx.coin,
+        "amount": tx.amount,
+        "is_swap": tx.is_uniswap,
+        "block_number": block.number if block is not None else None,
+    }
+
+
+class QueryCache:
+    """
+    Read side of the node for the web API, answers are built once and then served from a dict.
+
+    Every view is dropped when the tip moves, so chain views (balances, pools, latest blocks) are only
+    rebuilt after a block is appended or a reorg. Views with pending transactions are updated from the
+    node's transaction events instead of the mempool: a new or dropped transaction only drops the
+    history of its two accounts and the transaction pages. The per-account history of canonical
+    transactions is an index kept up to date from chain updates, keeping the newest ``max_history``
+    entries per account, and pending transactions are indexed per account as they arrive. Cached
+    views are plain dicts and lists that the consensus code never sees.
+    """
+
+    def __init__(self, node, max_history: int = 1000, max_blocks: int = 100) -> None:
+        self.node = node
+        self.max_history = max_history
+        self.max_blocks = max_blocks
+        self.history: Dict[int, Deque[Tuple[str, dict]]] = {}
+        # pending transactions by account in arrival order, the ones that left the mempool are skipped lazily
+        self.pending: Dict[int, Dict[str, dict]] = {}
+        self.hits = 0
+        self.misses = 0
+        self._tip: Optional[str] = None
+        self._chain_views: Dict[tuple, object] = {}
+        self._pending_views: Dict[tuple, object] = {}
+        self._pages: Dict[tuple, object] = {}
+
+    def _lookup(self, views: Dict[tuple, object], key: tuple):
+        tip = self.node.block_tree.tip
+        tip = tip.hash if tip is not None else None
+        if tip != self._tip:
+            self._tip = tip
+            self._chain_views.clear()
+            self._pending_views.clear()
+            self._pages.clear()
+        view = views.get(key)
+        if view is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return view
+
+    def on_transaction(self, tx) -> None:
+        """
+        Index a transaction that entered the mempool.
+        """
+        view = transaction_view(tx, 'pending')
+        for account in {tx.sender, tx.receiver}:
+            self.pending.setdefault(account, {})[tx.tx_id] = view
+            self._pending_views.pop(('history', account), None)
+        self._pages.clear()
+
+    def on_removed(self, transactions) -> None:
+        """
+        Forget pending transactions that were dropped from the mempool.
+        """
+        for tx in transactions:
+            self._unindex(tx)
+        self._pages.clear()
+
+    def _unindex(self, tx) -> None:
+        for account in {tx.sender, tx.receiver}:
+            entries = self.pending.get(account)
+            if entries is not None and entries.pop(tx.tx_id, None) is not None:
+                self._pending_views.pop(('history', account), None)
+                if not entries:
+                    del self.pending[account]
+
+    def on_chain_update(self, update) -> None:
+        for block in update.disconnected:
+            # disconnected blocks are the newest ones, their entries are at the end
+            for account in self._accounts(block):
+                entries = self.history.get(account)
+                while entries and entries[-1][0] == block.hash:
+                    entries.pop()
+            # their transactions went back to the mempool
+            for tx in block.transactions:
+                if tx.tx_id in self.node.mempool.pending:
+                    self.on_transaction(tx)
+        for block in update.connected:
+            self._index(block)
+            for tx in block.transactions:
+                self._unindex(tx)
+
+    def rebuild(self) -> None:
+        """
+        Index the canonical blocks in memory from scratch, e.g. after a restart.
+        """
+        self.history.clear()
+        self.pending.clear()
+        for block in self.node.block_tree.chain():
+            self._index(block)
+        for tx in self.node.mempool:
+            self.on_transaction(tx)
+
+    def _index(self, block) -> None:
+        for tx in block.transactions:
+            entry = (block.hash, transaction_view(tx, STATUS_NAMES['finalized'], block))
+            for account in {tx.sender, tx.receiver}:
+                entries = self.history.get(account)
+                if entries is None:
+                    entries = self.history[account] = deque(maxlen=self.max_history)
+                entries.append(entry)
+
+    @staticmethod
+    def _accounts(block) -> set:
+        return {account for tx in block.transactions for account in (tx.sender, tx.receiver)}
+
+    def account_history(self, account: int) -> List[dict]:
+        """
+        Pending and canonical transactions of ``account``, newest first.
+        """
+        view = self._lookup(self._pending_views, ('history', account))
+        if view is None:
+            entries = self.pending.get(account, {})
+            for tx_id in [tx_id for tx_id in entries if tx_id not in self.node.mempool.pending]:
+                # evicted from the mempool since it was indexed
+                del entries[tx_id]
+            pending = list(entries.values())
+            canonical = [entry for _, entry in self.history.get(account, ())]
+            view = self._pending_views[('history', account)] = pending[::-1] + canonical[::-1]
+        return view
+
+    def transactions(self, cursor: Optional[int] = None, limit: int = 50, sender: Optional[int] = None,
+                     receiver: Optional[int] = None, status: Optional[str] = None,
+                     newest_first: bool = False) -> Tuple[List[dict], Optional[int]]:
+        """
+        A page of the mempool's transactions, see ``Mempool.page``, and the cursor of the next page.
+        """
+        key = (cursor, limit, sender, receiver, status, newest_first)
+        view = self._lookup(self._pages, key)
+        if view is None:
+            entries, next_cursor = self.node.mempool.page(cursor, limit, sender, receiver, status, newest_first)
+            view = self._pages[key] = ([transaction_view(tx, STATUS_NAMES[tx_status]) for _, tx_status, tx in entries],
+                                       next_cursor)
+        return view
+
+    def balance(self, account: int) -> dict:
+        view = self._lookup(self._chain_views, ('balance', account))
+        if view is None:
+            units = self.node.ledger.account(account)
+            view = self._chain_views[('balance', account)] = {
+                "account": account,
+                "balances": {coin: amount / UNIT for coin, amount in units.items()},
+                "units": units,
+            }
+        return view
+
+    def pools(self) -> List[dict]:
+        view = self._lookup(self._chain_views, ('pools',))
+        if view is None:
+            view = self._chain_views[('pools',)] = [{
+                "pair": f'{pool.coin_a}/{pool.coin_b}',
+                "reserves": {pool.coin_a: pool.reserve_a / UNIT, pool.coin_b: pool.reserve_b / UNIT},
+                "price": pool.reserve_b / pool.reserve_a,
+                "fee": pool.fee,
+                "invariant": str(pool.invariant),
+            } for pool in self.node.ledger.amm.pools.values()]
+        return view
+
+    def latest_blocks(self, count: int) -> List[dict]:
+        """
+        Summaries of the newest ``count`` canonical blocks, newest first.
+        """
+        count = max(1, min(count, self.max_blocks))
+        view = self._lookup(self._chain_views, ('blocks', count))
+        if view is None:
+            tree = self.node.block_tree
+            view = self._chain_views[('blocks', count)] = [{
+                "number": block.number,
+                "hash": block.hash,
+                "prev_block_hash": block.prev_block_hash,
+                "time": block.time,
+                "difficulty": difficulty(block.get_target()),
+                "transactions": len(block.transactions),
+            } for block in reversed(list(tree.chain(max(0, len(tree.canonical) - count))))]
+        return view
@@ -0,0 +1,192 @@
+# Command to run a local network over several processes from console
+# cd src; python run_cluster.py --nodes 100 --workers 8 --topology sparse
+#
+# Every worker process runs its share of the nodes on its own event loop, so a busy node only slows
+# down the nodes of its own worker. All workers log to ./log/app.log through the parent process.
+# Ctrl+C or SIGTERM stops the workers and waits for them to close their nodes.
+
+import argparse
+import asyncio
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+
+from benchmark import TOPOLOGIES, build_topology
+from log.logging_config import SAMPLE_RATES, LazyQueueHandler, SamplingFilter, setup_logging
+
+# seconds a worker gets to close its nodes before it is killed
+STOP_TIMEOUT = 10
+LOG_FORMAT = '%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def allocate_ports(count: int, base_port: int) -> List[int]:
+    """
+    ``count`` UDP ports from ``base_port`` upwards, skipping the ones in use.
+    """
+    ports = []
+    port = base_port
+    while len(ports) < count:
+        if port > 65535:
+            raise RuntimeError(f'only {len(ports)} free UDP ports above {base_port}')
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            try:
+                sock.bind(('0.0.0.0', port))
+                ports.append(port)
+            except OSError:
+                pass
+        port += 1
+    return ports
+
+
+def assign_nodes(topology: List[List[int]], ports: List[int], workers: int) -> List[List[tuple]]:
+    """
+    Split the nodes over the workers in contiguous ranges, every node as (node id, port, connections)
+    with the connections as (node id, port) pairs.
+    """
+    nodes = [(i, ports[i], [(j, ports[j]) for j in connections]) for i, connections in enumerate(topology)]
+    size, rest = divmod(len(nodes), workers)
+    shares, start = [], 0
+    for worker in range(workers):
+        end = start + size + (worker < rest)
+        shares.append(nodes[start:end])
+        start = end
+    return [share for share in shares if share]
+
+
+def run_worker(worker_id: int, nodes: List[tuple], key_files: List[str], log_queue, report_queue,
+               stop_event, web_port: Optional[int], mining_workers: int) -> None:
+    # the parent handles the signals and tells the workers to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    handler = LazyQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(SAMPLE_RATES))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+    asyncio.run(worker_main(worker_id, nodes, key_files, report_queue, stop_event, web_port, mining_workers))
+
+
+async def worker_main(worker_id: int, nodes: List[tuple], key_files: List[str], report_queue, stop_event,
+                      web_port: Optional[int], mining_workers: int) -> None:
+    from mining import ProcessPoolMiningEngine
+    from run_local import create_node, wait_until_ready
+
+    logger = logging.getLogger('my_app')
+    start = time.time()
+    ipv8_instances = {}
+    for node_id, port, connections in nodes:
+        ipv8_instance = ipv8_instances[port] = create_node(node_id, port, connections, key_files[node_id],
+                                                          asyncio.Event())
+        # the workers share the cores for mining
+        ipv8_instance.overlays[0].mining_engine = ProcessPoolMiningEngine(mining_workers)
+    await asyncio.gather(*(ipv8_instance.start() for ipv8_instance in ipv8_instances.values()))
+    web_server = None
+    if web_port is not None:
+        from server import run_web_server
+        web_server = asyncio.ensure_future(run_web_server(ipv8_instances, port=web_port + worker_id))
+
+    overlays = [ipv8_instance.overlays[0] for ipv8_instance in ipv8_instances.values()]
+    message = await wait_until_ready(overlays, start)
+    logger.info(f'Worker {worker_id}: {message}')
+    report_queue.put((worker_id, all(overlay.ready.is_set() for overlay in overlays), time.time() - start))
+
+    await asyncio.get_running_loop().run_in_executor(None, stop_event.wait)
+    logger.info(f'Worker {worker_id} stops {len(ipv8_instances)} nodes')
+    if web_server is not None:
+        web_server.cancel()
+    await asyncio.gather(*(ipv8_instance.stop() for ipv8_instance in ipv8_instances.values()),
+                         return_exceptions=True)
+
+
+def run_cluster(num_nodes: int, workers: int, topology: str, seed: int, base_port: int,
+                web_port: Optional[int], ready_timeout: float) -> None:
+    from run_local import ensure_keys
+
+    start = time.time()
+    context = multiprocessing.get_context('spawn')
+    log_queue, report_queue, stop_event = context.Queue(), context.Queue(), context.Event()
+    # the parent writes what the workers log, with the handlers set up by setup_logging
+    setup_logging(text_format=LOG_FORMAT)
+    listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+    logger = logging.getLogger('my_app')
+
+    ports = allocate_ports(num_nodes, base_port)
+    shares = assign_nodes(build_topology(topology, num_nodes, seed), ports, workers)
+    key_files = ensure_keys(num_nodes)
+    mining_workers = max(1, (os.cpu_count() or 1) // len(shares))
+    processes = [context.Process(target=run_worker, name=f'worker{i}',
+                                 args=(i, share, key_files, log_queue, report_queue, stop_event, web_port,
+                                       mining_workers))
+                 for i, share in enumerate(shares)]
+
+    def request_stop(signum, frame) -> None:
+        # setting stop_event here could deadlock on its lock, unwind to the finally block instead
+        raise KeyboardInterrupt
+    previous = {signum: signal.signal(signum, request_stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        for process in processes:
+            process.start()
+        logger.info(f'Started {num_nodes} nodes on ports {ports[0]}-{ports[-1]} in {len(processes)} workers')
+
+        reports: Dict[int, Tuple[bool, float]] = {}
+        deadline = time.time() + ready_timeout
+        while len(reports) < len(processes) and time.time() < deadline:
+            try:
+                worker_id, ready, seconds = report_queue.get(timeout=0.5)
+                reports[worker_id] = (ready, seconds)
+            except queue.Empty:
+                if not all(process.is_alive() for process in processes):
+                    break
+        if len(reports) == len(processes) and all(ready for ready, _ in reports.values()):
+            message = f'All {num_nodes} nodes in {len(processes)} workers connected in {time.time() - start:.2f}s'
+        else:
+            message = f'{sum(ready for ready, _ in reports.values())} of {len(processes)} workers connected ' \
+                      f'after {time.time() - start:.2f}s'
+        logger.info(message)
+        print(message)
+
+        # run until we are told to stop or a worker dies
+        while True:
+            time.sleep(0.5)
+            dead = [process.name for process in processes if not process.is_alive()]
+            if dead:
+                logger.warning(f'{", ".join(dead)} exited, stopping the network')
+                break
+    except KeyboardInterrupt:
+        logger.info('Stopping the network')
+    finally:
+        stop_event.set()
+        for process in processes:
+            if process.pid is None:
+                continue
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning(f'{process.name} did not stop in {STOP_TIMEOUT}s, killing it')
+                process.kill()
+                process.join()
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+        logger.info(f'Stopped {len(processes)} workers')
+        listener.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run N blockchain nodes spread over worker processes')
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='sparse')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--base-port', type=int, default=9090, help='first UDP port, ports in use are skipped')
+    parser.add_argument('--web-port', type=int, default=None,
+                        help='serve the API of worker i on this port + i, disabled by default')
+    parser.add_argument('--ready-timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    run_cluster(args.nodes, max(1, args.workers), args.topology, args.seed, args.base_port, args.web_port,
+                args.ready_timeout)
@@ -2,11 +2,18 @@
 # Don't forget to pip install -r requirements.txt before running commands below
 # WINDOWS: source .venv/Scripts/activate; cd src; python run_local.py
 # MAC: source .venv/bin/activate; cd src; python3 run_local.py
+# Another topology: python run_local.py --nodes 20 --topology random-regular --degree 4 --seed 1
+# or one made by topology.py: python run_local.py --topology-file ../topologies/blockchain.yaml
 
-from asyncio import run
-import threading
+import argparse
+import os
+import statistics
+import time
+from asyncio import TimeoutError, ensure_future, gather, run, wait_for
+from typing import List, Optional, Tuple
 
 from ipv8.configuration import ConfigBuilder, default_bootstrap_defs
+from ipv8.keyvault.crypto import default_eccrypto
 from ipv8.util import run_forever, create_event_with_signals
 from ipv8_service import IPv8
 
@@ -14,19 +21,68 @@ from blockchain import BlockchainNode
 from server import run_web_server
 
 from log.logging_config import *
-from utilities.generate_topology import generate_ring_topology, generate_topology
+import topology as topologies
 
 # Create logger
-setup_logging()
 logger = logging.getLogger('my_app')
 
-async def start_communities(peer_num, use_localhost=True) -> None:
+# give up waiting for the overlays to connect after this many seconds, the nodes keep trying
+READY_TIMEOUT = 60
+
+
+def ensure_keys(peer_num) -> List[str]:
+    """
+    Key files of the nodes, the missing ones are generated up front so IPv8 only has to load them.
+    """
+    paths = [f"ec{i}.pem" for i in range(peer_num)]
+    for path in paths:
+        if not os.path.isfile(path):
+            with open(path, 'wb') as f:
+                f.write(default_eccrypto.generate_key("medium").key_to_bin())
+    return paths
+
+
+def create_node(node_id: int, port: int, connections: List[Tuple[int, int]], key_file: str, event,
+                use_localhost: bool = True) -> IPv8:
+    """
+    An unstarted IPv8 instance running one BlockchainNode, ``connections`` are (node id, port) pairs.
+    """
+    builder = ConfigBuilder().clear_keys().clear_overlays()
+    builder.add_key("my peer", "medium", key_file)
+    builder.set_port(port)
+    builder.add_overlay("blockchain_community","my peer",[],default_bootstrap_defs,{},[("started", node_id, connections, event, use_localhost)])
+    return IPv8(builder.finalize(), extra_communities={'blockchain_community': BlockchainNode})
+
+
+async def wait_until_ready(overlays, start: float, timeout: float = READY_TIMEOUT) -> str:
+    """
+    Wait for the overlays to connect to all their neighbours and describe how long that took.
+    """
+    try:
+        await wait_for(gather(*(overlay.ready.wait() for overlay in overlays)), timeout)
+    except TimeoutError:
+        waiting = [overlay.node_id for overlay in overlays if not overlay.ready.is_set()]
+        return f'Nodes {waiting} are not connected after {timeout}s'
+    ready_times = [overlay.ready_time for overlay in overlays]
+    return (f'All {len(overlays)} nodes connected in {time.time() - start:.2f}s, node median '
+            f'{statistics.median(ready_times):.2f}s, slowest {max(ready_times):.2f}s')
+
+
+async def start_communities(peer_num, use_localhost=True, topology: Optional[List[List[int]]] = None) -> None:
+    """
+    Run ``peer_num`` nodes, connected by ``topology`` or by a ring with random chords up to degree 5.
+    """
     logger.info('Community started')
+    start = time.time()
     base_port = 9090
     ipv8_instances = {}
 
-    topology = generate_topology(generate_ring_topology(peer_num), 5)
-    logger.info(f'topology : {topology}')
+    if topology is None:
+        topology = topologies.generate('ring-chords', peer_num, min(5, peer_num - 1))
+    elif len(topology) != peer_num:
+        raise ValueError(f'the topology has {len(topology)} nodes, not {peer_num}')
+    logger.info(f'topology: {topologies.describe(topology)}')
+    key_files = ensure_keys(peer_num)
 
     for i in range(0, peer_num):
         event = create_event_with_signals()
@@ -35,22 +91,38 @@ async def start_communities(peer_num, use_localhost=True) -> None:
         connections = topology[i]
         connections_updated = [(x, base_port + x) for x in connections]
 
-        builder = ConfigBuilder().clear_keys().clear_overlays()
-        builder.add_key("my peer", "medium", f"ec{i}.pem")
-        builder.set_port(node_port)
-        builder.add_overlay("blockchain_community","my peer",[],default_bootstrap_defs,{},[("started", i, connections_updated, event, use_localhost)])
+        ipv8_instances[node_port] = create_node(i, node_port, connections_updated, key_files[i], event, use_localhost)
 
-        ipv8_instance = IPv8(builder.finalize(), extra_communities={'blockchain_community': BlockchainNode})
-        await ipv8_instance.start()
+    # open all endpoints at once, every node then connects to its neighbours by itself
+    await gather(*(ipv8_instance.start() for ipv8_instance in ipv8_instances.values()))
+    logger.info(f'{peer_num} nodes running on ports {base_port}-{base_port + peer_num - 1}, '
+                f'started in {time.time() - start:.2f}s')
 
-        logger.info(f'Node running on port {node_port}')
-        ipv8_instances[node_port] = ipv8_instance
-        print(ipv8_instance)
+    message = await wait_until_ready([ipv8_instance.overlays[0] for ipv8_instance in ipv8_instances.values()], start)
+    logger.info(message)
+    print(message)
 
-    fastapi_thread = threading.Thread(target=lambda: run_web_server(ipv8_instances))
-    fastapi_thread.start()
+    # the web server shares the event loop with the nodes
+    web_server = ensure_future(run_web_server(ipv8_instances))
 
     await run_forever()
+    logger.info(f'Stopping the web server and {peer_num} nodes')
+    web_server.cancel()
+    await gather(web_server, *(ipv8_instance.stop() for ipv8_instance in ipv8_instances.values()),
+                 return_exceptions=True)
 
 if __name__ == "__main__":
-    run(start_communities(3))
+    parser = argparse.ArgumentParser(description='Run N blockchain nodes and the web server on this machine')
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--topology', choices=topologies.FAMILIES, default='ring-chords')
+    parser.add_argument('--degree', type=int, default=5, help='lowered to the number of nodes - 1')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--topology-file', type=str, default=None, help='a .yaml or .bin file from topology.py')
+    args = parser.parse_args()
+
+    setup_logging()
+    if args.topology_file:
+        topology = topologies.load(args.topology_file)
+    else:
+        topology = topologies.generate(args.topology, args.nodes, min(args.degree, args.nodes - 1), args.seed)
+    run(start_communities(len(topology), topology=topology))
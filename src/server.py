@@ -1,10 +1,22 @@
-from fastapi import FastAPI, HTTPException
+import asyncio
+import errno
+import json
+import socket
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
-from log.logging_config import setup_logging
 import logging
 from pydantic import BaseModel
 
+from amm import UNIT
+from ledger import SWAP_TARGET
+from metrics import CONTENT_TYPE, render
+from profiling import SamplingProfiler
+from query_cache import STATUS_NAMES, transaction_view
+
 class TransactionBodySend(BaseModel):
     node_id: int
     peer_id: int
@@ -16,40 +28,93 @@ class TransactionBodySwap(BaseModel):
     amount: int
 
 # Create logger
-setup_logging()
 logger = logging.getLogger('my_app')
 
 # Create web server
 app = FastAPI()
 
+# the API runs on the IPv8 event loop, so handlers can read the nodes' state directly
+def get_node(node_port: int):
+    ipv8_instance = app.ipv8_instances.get(node_port)
+    if ipv8_instance is None:
+        raise HTTPException(status_code=404, detail=f"No node on port {node_port}")
+    return ipv8_instance.overlays[0]
+
 @app.get("/get-transactions/{node_port}")
-async def get_transactions(node_port: int):
+async def get_transactions(node_port: int, cursor: Optional[int] = None, limit: int = 100,
+                           sender: Optional[int] = None, receiver: Optional[int] = None,
+                           status: Optional[str] = None, order: str = 'desc'):
     logger.info('Received API requst to GET Transactions...')
 
-    ipv8_instance = app.ipv8_instances.get(node_port)
-    pending_transactions = ipv8_instance.overlays[0].pending_txs
-    finalized_transactions = ipv8_instance.overlays[0].finalized_txs
-    transactions = []
-
-    for tx in pending_transactions:
-        transactions.append({
-            "status": "pending",
-            "hash_id": tx.tx_id,
-            "amount": tx.amount,
-            "sender": tx.sender,
-            "receiver": tx.receiver
-        })
-
-    for tx in finalized_transactions:
-        transactions.append({
-            "status": "processed",
-            "hash_id": tx.tx_id,
-            "amount": tx.amount,
-            "sender": tx.sender,
-            "receiver": tx.receiver
-        })
-    
-    return {"status": "OK", "transactions": transactions}
+    if status is not None and status not in STATUS_NAMES.values():
+        raise HTTPException(status_code=400, detail=f"Unknown status {status}")
+    transactions, next_cursor = get_node(node_port).queries.transactions(
+        cursor, max(1, min(limit, 1000)), sender, receiver,
+        next((k for k, v in STATUS_NAMES.items() if v == status), None), newest_first=order == 'desc')
+
+    return {"status": "OK", "transactions": transactions, "next_cursor": next_cursor}
+
+@app.get("/accounts/{node_port}/{account}")
+async def get_account(node_port: int, account: int):
+    return {"status": "OK", **get_node(node_port).queries.balance(account)}
+
+@app.get("/accounts/{node_port}/{account}/history")
+async def get_account_history(node_port: int, account: int, limit: int = 100):
+    history = get_node(node_port).queries.account_history(account)
+    return {"status": "OK", "account": account, "transactions": history[:max(1, limit)]}
+
+@app.get("/pools/{node_port}")
+async def get_pools(node_port: int):
+    return {"status": "OK", "pools": get_node(node_port).queries.pools()}
+
+@app.get("/blocks/{node_port}")
+async def get_blocks(node_port: int, limit: int = 20):
+    return {"status": "OK", "blocks": get_node(node_port).queries.latest_blocks(limit)}
+
+@app.get("/events/{node_port}")
+async def stream_events(node_port: int, request: Request):
+    # server-sent events with the node's new transactions and canonical blocks
+    events = get_node(node_port).events
+
+    async def stream():
+        queue = events.subscribe()
+        try:
+            while not await request.is_disconnected():
+                try:
+                    kind, item = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                if kind == 'transaction':
+                    data = transaction_view(item, 'pending')
+                else:
+                    data = {"number": item.number, "hash": item.hash,
+                            "transactions": [tx.tx_id for tx in item.transactions]}
+                yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            events.unsubscribe(queue)
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.get("/get-transaction-proof/{node_port}/{tx_id}")
+async def get_transaction_proof(node_port: int, tx_id: str):
+    logger.info('Received API requst to GET Transaction proof...')
+
+    block, proof = get_node(node_port).get_transaction_proof(tx_id)
+    if block is None:
+        raise HTTPException(status_code=404, detail="Transaction is not in a block yet")
+
+    return {
+        "status": "OK",
+        "hash_id": tx_id,
+        "block_number": block.number,
+        "block_hash": block.hash,
+        "merkle_root": block.merkle_root.hex(),
+        "index": proof.index,
+        "leaf_count": proof.leaf_count,
+        "siblings": [sibling.hex() for sibling in proof.siblings]
+    }
 
 @app.post("/send-transaction")
 async def send_message(data: TransactionBodySend):
@@ -58,39 +123,100 @@ async def send_message(data: TransactionBodySend):
     # Todo: Error handling if node_id and peer_id are valid
 
     # Sending transaction
-    ipv8_instance = app.ipv8_instances.get(data.node_id).overlays[0]
+    ipv8_instance = get_node(data.node_id)
     ipv8_instance.send_web_transaction(data.peer_id, int(data.amount))
 
     # JSON response
     return {"status": "sent", "node_id": data.node_id, "peer_id": data.peer_id, "amount": data.amount}
 
+@app.get('/quote/{node_port}')
+async def quote(node_port: int, coin: str, amount: int):
+    # what a swap would pay out at the current reserves, nothing is changed
+    ipv8_instance = get_node(node_port)
+    if coin not in SWAP_TARGET:
+        raise HTTPException(status_code=400, detail=f"No pool for {coin}")
+    amount_out = ipv8_instance.ledger.quote(coin, amount)
+
+    return {"status": "OK", "coin": coin, "amount": amount, "coin_out": SWAP_TARGET[coin],
+            "amount_out": amount_out / UNIT, "pools": ipv8_instance.ledger.amm.snapshot()}
+
 @app.post('/swap-currency')
 async def swap_currency(data: TransactionBodySwap):
+    if data.coin not in SWAP_TARGET:
+        raise HTTPException(status_code=400, detail=f"No pool for {data.coin}")
+
     # Sending transaction
-    ipv8_instance = app.ipv8_instances.get(data.node_id).overlays[0]
+    ipv8_instance = get_node(data.node_id)
     ipv8_instance.web_uniswap_transaction(data.coin, int(data.amount))
 
     # JSON response
     return {"status": "sent", "node_id": data.node_id, "coin": data.coin, "amount": data.amount}
 
-# Host static files
-app.mount("/", StaticFiles(directory="frontend/build", html=True), name="static")
+@app.get('/metrics')
+async def metrics():
+    # every node of this process, told apart by the node label
+    registries = [ipv8_instance.overlays[0].metrics for ipv8_instance in app.ipv8_instances.values()]
+    return Response(render(registries), media_type=CONTENT_TYPE)
+
+@app.get('/metrics/{node_port}')
+async def node_metrics(node_port: int):
+    return Response(render([get_node(node_port).metrics]), media_type=CONTENT_TYPE)
+
+@app.get('/profile/calls/{node_port}')
+async def profile_calls(node_port: int, limit: int = 50):
+    # wall and CPU time per handler and task since the node started
+    return {"status": "OK", "calls": get_node(node_port).profiler.report()[:max(1, limit)]}
+
+# the nodes of this process share the event loop, the sampler profiles all of them
+@app.post('/profile/start')
+async def start_profile(interval: float = 0.005):
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="The interval has to be between 0.001 and 1 seconds")
+    started = app.sampler.start(interval)
+    return {"status": "started" if started else "running", **app.sampler.status()}
+
+@app.post('/profile/stop')
+async def stop_profile():
+    app.sampler.stop()
+    return {"status": "stopped", **app.sampler.status()}
+
+@app.get('/profile/collapsed')
+async def collapsed_profile():
+    # collapsed stacks for flamegraph.pl or speedscope, also while the sampler runs
+    return PlainTextResponse(app.sampler.collapsed(),
+                             headers={'Content-Disposition': 'attachment; filename="profile.collapsed"'})
 
-def run_web_server(ipv8_instances):
-    app.ipv8_instances = ipv8_instances
-    port = 8000
+# Host static files
+# check_dir=False lets the API run without a frontend build
+app.mount("/", StaticFiles(directory="frontend/build", html=True, check_dir=False), name="static")
 
+def bind_socket(host: str, port: int) -> socket.socket:
+    # takes the first free port from ``port`` on
     while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
             logger.info(f'Trying to start web server on port {port}...')
-            uvicorn.run(app, host="127.0.0.1", port=port)
-            break  # If the server starts successfully, break the loop
+            sock.bind((host, port))
+            return sock
         except OSError as e:
-            if e.errno == 98:  # Error code for address already in use
-                logger.warning(f"Port {port} is already in use. Trying the next one...")
-                port += 1
-            else:
-                raise  # Reraises any other exception
-
-if __name__ == "__main__":
-    run_web_server()
+            sock.close()
+            if e.errno != errno.EADDRINUSE:
+                raise
+            logger.warning(f"Port {port} is already in use. Trying the next one...")
+            port += 1
+
+async def run_web_server(ipv8_instances, host: str = "127.0.0.1", port: int = 8000) -> None:
+    """
+    Serve the API on the running event loop, next to the IPv8 instances, until the server is stopped.
+    """
+    app.ipv8_instances = ipv8_instances
+    # samples the thread of the event loop we run on
+    app.sampler = SamplingProfiler()
+    sock = bind_socket(host, port)
+    logger.info(f'Web server listening on {host}:{sock.getsockname()[1]}')
+    try:
+        # log_config=None keeps our logging setup
+        await uvicorn.Server(uvicorn.Config(app, log_config=None)).serve(sockets=[sock])
+    finally:
+        app.sampler.stop()
@@ -0,0 +1,151 @@
+import json
+import mmap
+import os
+import struct
+from typing import Callable, Dict, List, Optional, Tuple
+
+LOG_FILE = 'blocks.log'
+HASH_INDEX_FILE = 'blocks.idx'
+HEIGHT_INDEX_FILE = 'heights.idx'
+SNAPSHOT_FILE = 'snapshot.json'
+
+RECORD_HEADER = struct.Struct('>I')
+# raw block hash, offset of the record in blocks.log
+HASH_ENTRY = struct.Struct('>32sQ')
+# offset in blocks.log of the canonical block at each depth
+HEIGHT_ENTRY = struct.Struct('>Q')
+
+
+class BlockStore:
+    """
+    Append-only on-disk block log with memory-mapped indexes, one directory per node.
+
+    ``blocks.log`` holds every stored block as a length-prefixed binary record,
+    ``blocks.idx`` maps raw block hashes to log offsets and ``heights.idx`` holds the log offset of
+    the canonical block at every depth. Both indexes are fixed-width so they are read through mmap,
+    the hash index is only loaded into a dict on the first lookup by hash.
+    ``snapshot.json`` keeps the latest state snapshot so a restart only replays the blocks after it.
+    """
+
+    def __init__(self, path: str, encode: Callable[[object], bytes], decode: Callable[[bytes], object]) -> None:
+        self.path = path
+        self.encode = encode
+        self.decode = decode
+        os.makedirs(path, exist_ok=True)
+        self._files = {name: open(os.path.join(path, name), 'a+b')
+                       for name in (LOG_FILE, HASH_INDEX_FILE, HEIGHT_INDEX_FILE)}
+        self._maps: Dict[str, mmap.mmap] = {}
+        self._offsets: Optional[Dict[bytes, int]] = None
+
+    def close(self) -> None:
+        for m in self._maps.values():
+            m.close()
+        self._maps.clear()
+        for f in self._files.values():
+            f.close()
+
+    def _size(self, name: str) -> int:
+        return os.fstat(self._files[name].fileno()).st_size
+
+    def _view(self, name: str) -> Optional[mmap.mmap]:
+        # remap when the file grew since it was last mapped
+        size = self._size(name)
+        view = self._maps.get(name)
+        if view is not None and len(view) >= size:
+            return view
+        if view is not None:
+            view.close()
+            del self._maps[name]
+        if size == 0:
+            return None
+        view = self._maps[name] = mmap.mmap(self._files[name].fileno(), 0, access=mmap.ACCESS_READ)
+        return view
+
+    def _append(self, name: str, data: bytes) -> int:
+        f = self._files[name]
+        offset = self._size(name)
+        f.write(data)
+        f.flush()
+        return offset
+
+    @property
+    def height(self) -> int:
+        """
+        Length of the stored canonical chain.
+        """
+        return self._size(HEIGHT_INDEX_FILE) // HEIGHT_ENTRY.size
+
+    def offsets(self) -> Dict[bytes, int]:
+        if self._offsets is None:
+            view = self._view(HASH_INDEX_FILE)
+            self._offsets = dict(HASH_ENTRY.iter_unpack(view)) if view is not None else {}
+        return self._offsets
+
+    def __contains__(self, block_hash: str) -> bool:
+        return bytes.fromhex(block_hash) in self.offsets()
+
+    def append(self, block) -> int:
+        """
+        Store ``block`` unless it is already stored, returns the offset of its record.
+        """
+        key = bytes.fromhex(block.hash)
+        offsets = self.offsets()
+        if key in offsets:
+            return offsets[key]
+        data = self.encode(block)
+        offset = self._append(LOG_FILE, RECORD_HEADER.pack(len(data)) + data)
+        self._append(HASH_INDEX_FILE, HASH_ENTRY.pack(key, offset))
+        offsets[key] = offset
+        return offset
+
+    def _read(self, offset: int):
+        view = self._view(LOG_FILE)
+        length, = RECORD_HEADER.unpack_from(view, offset)
+        start = offset + RECORD_HEADER.size
+        return self.decode(view[start:start + length])
+
+    def get(self, block_hash: str):
+        offset = self.offsets().get(bytes.fromhex(block_hash))
+        return self._read(offset) if offset is not None else None
+
+    def block_at_depth(self, depth: int):
+        if not 0 <= depth < self.height:
+            return None
+        offset, = HEIGHT_ENTRY.unpack_from(self._view(HEIGHT_INDEX_FILE), depth * HEIGHT_ENTRY.size)
+        return self._read(offset)
+
+    def chain(self, start: int, end: Optional[int] = None) -> List:
+        end = self.height if end is None else min(end, self.height)
+        return [self.block_at_depth(depth) for depth in range(max(start, 0), end)]
+
+    def set_chain(self, depth: int, blocks: List) -> None:
+        """
+        Make ``blocks`` the canonical chain from ``depth`` on, dropping whatever was canonical above it.
+        """
+        f = self._files[HEIGHT_INDEX_FILE]
+        if self.height > depth:
+            view = self._maps.pop(HEIGHT_INDEX_FILE, None)
+            if view is not None:
+                view.close()
+            f.truncate(depth * HEIGHT_ENTRY.size)
+        entries = b''.join(HEIGHT_ENTRY.pack(self.append(block)) for block in blocks)
+        self._append(HEIGHT_INDEX_FILE, entries)
+
+    def save_snapshot(self, depth: int, state: dict) -> None:
+        """
+        Atomically replace the state snapshot, ``state`` is the state after the first ``depth`` canonical blocks.
+        """
+        tmp = os.path.join(self.path, SNAPSHOT_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'depth': depth, 'state': state}, f)
+        os.replace(tmp, os.path.join(self.path, SNAPSHOT_FILE))
+
+    def load_snapshot(self) -> Tuple[int, Optional[dict]]:
+        try:
+            with open(os.path.join(self.path, SNAPSHOT_FILE)) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return 0, None
+        if snapshot['depth'] > self.height:
+            return 0, None
+        return snapshot['depth'], snapshot['state']
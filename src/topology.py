@@ -0,0 +1,367 @@
+# Command to generate a topology from console
+# cd src; python topology.py random-regular --nodes 10000 --degree 8 --seed 42 --output topologies/rr10k.bin
+#
+# Topologies are adjacency lists: topology[i] holds the sorted neighbours of node i. They are saved as
+# YAML, a node id mapping to its neighbours like the files in /topologies, or in a compact binary file
+# when the file name ends in .bin.
+
+import argparse
+import random
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from wire import write_uint
+
+FAMILIES = ('ring', 'ring-chords', 'random-regular', 'small-world', 'scale-free')
+BINARY_MAGIC = b'VTOP\x01'
+# tries to rewire an edge that would be a self-loop or a duplicate, and to match all stubs, before giving up
+MAX_SWAP_ATTEMPTS = 1000
+MAX_MATCH_ATTEMPTS = 10
+
+
+def _add_edge(adjacency: List[Set[int]], u: int, v: int) -> None:
+    adjacency[u].add(v)
+    adjacency[v].add(u)
+
+
+def _match_stubs(adjacency: List[Set[int]], stubs: List[int], rng: random.Random) -> None:
+    """
+    Connect the stubs, a node id for every missing edge, in random pairs. A pair that would be a
+    self-loop or a duplicate edge is swapped with one of the edges made here: (u, v) and (x, y)
+    become (u, x) and (v, y), which keeps every degree. If that fails all pairs are drawn again.
+    """
+    for _ in range(MAX_MATCH_ATTEMPTS):
+        rng.shuffle(stubs)
+        edges: List[Tuple[int, int]] = []
+        conflicts = []
+        for i in range(0, len(stubs) - 1, 2):
+            u, v = stubs[i], stubs[i + 1]
+            if u != v and v not in adjacency[u]:
+                _add_edge(adjacency, u, v)
+                edges.append((u, v))
+            else:
+                conflicts.append((u, v))
+        if all(_swap_in(adjacency, edges, u, v, rng) for u, v in conflicts):
+            return
+        for u, v in edges:
+            adjacency[u].discard(v)
+            adjacency[v].discard(u)
+    raise RuntimeError(f'could not connect {len(stubs)} stubs, the degree is too high for this topology')
+
+
+def _swap_in(adjacency: List[Set[int]], edges: List[Tuple[int, int]], u: int, v: int, rng: random.Random) -> bool:
+    for _ in range(MAX_SWAP_ATTEMPTS if edges else 0):
+        index = rng.randrange(len(edges))
+        x, y = edges[index] if rng.random() < 0.5 else edges[index][::-1]
+        if u == x or v == y or x in adjacency[u] or y in adjacency[v] or (u == y and v == x):
+            continue
+        adjacency[x].discard(y)
+        adjacency[y].discard(x)
+        _add_edge(adjacency, u, x)
+        _add_edge(adjacency, v, y)
+        edges[index] = (u, x)
+        edges.append((v, y))
+        return True
+    return False
+
+
+def _check_degree(num_nodes: int, degree: int) -> None:
+    if num_nodes < 2:
+        raise ValueError('a topology needs at least 2 nodes')
+    if not 1 <= degree < num_nodes:
+        raise ValueError(f'the degree has to be between 1 and {num_nodes - 1}, not {degree}')
+
+
+def ring(num_nodes: int) -> List[Set[int]]:
+    adjacency = [set() for _ in range(num_nodes)]
+    for i in range(num_nodes):
+        if (i + 1) % num_nodes != i:
+            _add_edge(adjacency, i, (i + 1) % num_nodes)
+    return adjacency
+
+
+def ring_chords(num_nodes: int, degree: int, rng: random.Random) -> List[Set[int]]:
+    """
+    A ring with random chords until every node has ``degree`` neighbours. When num_nodes * degree is
+    odd one random node gets one more.
+    """
+    _check_degree(num_nodes, degree)
+    adjacency = ring(num_nodes)
+    if degree > (num_nodes - 1) // 2:
+        # pick the pairs that stay unconnected instead, none of them on the ring
+        missing = [set(neighbours) for neighbours in adjacency]
+        stubs = [i for i in range(num_nodes) for _ in range(num_nodes - 1 - max(degree, len(adjacency[i])))]
+        if len(stubs) % 2:
+            stubs.pop(rng.randrange(len(stubs)))
+        _match_stubs(missing, stubs, rng)
+        return [set(range(num_nodes)) - (missing[i] - adjacency[i]) - {i} for i in range(num_nodes)]
+    stubs = [i for i in range(num_nodes) for _ in range(degree - len(adjacency[i]))]
+    if len(stubs) % 2:
+        stubs.append(rng.randrange(num_nodes))
+    _match_stubs(adjacency, stubs, rng)
+    return adjacency
+
+
+def random_regular(num_nodes: int, degree: int, rng: random.Random) -> List[Set[int]]:
+    """
+    Every node has exactly ``degree`` neighbours, picked at random.
+    """
+    _check_degree(num_nodes, degree)
+    if num_nodes * degree % 2:
+        raise ValueError(f'no {degree}-regular graph has {num_nodes} nodes, num_nodes * degree has to be even')
+    if degree > (num_nodes - 1) // 2:
+        # dense graphs are the complement of a sparse one, random pairs would mostly collide
+        sparse = random_regular(num_nodes, num_nodes - 1 - degree, rng) if degree < num_nodes - 1 else \
+            [set() for _ in range(num_nodes)]
+        return [set(range(num_nodes)) - sparse[i] - {i} for i in range(num_nodes)]
+    adjacency = [set() for _ in range(num_nodes)]
+    _match_stubs(adjacency, [i for i in range(num_nodes) for _ in range(degree)], rng)
+    return adjacency
+
+
+def small_world(num_nodes: int, degree: int, rng: random.Random, rewire: float = 0.1) -> List[Set[int]]:
+    """
+    Watts-Strogatz: every node is connected to its ``degree`` nearest nodes on a ring, after which
+    every edge is moved to a random node with probability ``rewire``. The average degree stays
+    ``degree``, rounded down to an even number.
+    """
+    _check_degree(num_nodes, degree)
+    half = max(1, degree // 2)
+    adjacency = [set() for _ in range(num_nodes)]
+    for i in range(num_nodes):
+        for step in range(1, half + 1):
+            if (i + step) % num_nodes != i:
+                _add_edge(adjacency, i, (i + step) % num_nodes)
+    for step in range(1, half + 1):
+        for i in range(num_nodes):
+            j = (i + step) % num_nodes
+            if rng.random() >= rewire or j not in adjacency[i] or len(adjacency[i]) >= num_nodes - 1:
+                continue
+            # keep the node that would be left without neighbours
+            if len(adjacency[j]) == 1:
+                continue
+            target = rng.randrange(num_nodes)
+            while target == i or target in adjacency[i]:
+                target = rng.randrange(num_nodes)
+            adjacency[i].discard(j)
+            adjacency[j].discard(i)
+            _add_edge(adjacency, i, target)
+    return adjacency
+
+
+def scale_free(num_nodes: int, degree: int, rng: random.Random, max_degree: Optional[int] = None) -> List[Set[int]]:
+    """
+    Barabasi-Albert: nodes join one by one and connect to ``degree`` existing nodes, picked with a
+    probability proportional to their degree, so the minimum degree is ``degree``. Nodes that reached
+    ``max_degree`` are skipped.
+    """
+    _check_degree(num_nodes, degree)
+    if max_degree is not None and max_degree < 2 * degree:
+        raise ValueError(f'max_degree has to be at least {2 * degree}')
+    # the first nodes form a clique
+    adjacency = [set() for _ in range(num_nodes)]
+    for i in range(degree + 1):
+        for j in range(i + 1, degree + 1):
+            _add_edge(adjacency, i, j)
+    # every node once per edge end, a uniform pick from it is proportional to the degree
+    ends = [i for i in range(degree + 1) for _ in range(degree)]
+    for node in range(degree + 1, num_nodes):
+        targets: Set[int] = set()
+        for _ in range(MAX_SWAP_ATTEMPTS):
+            target = ends[rng.randrange(len(ends))]
+            if max_degree is None or len(adjacency[target]) < max_degree:
+                targets.add(target)
+                if len(targets) == degree:
+                    break
+        else:
+            raise RuntimeError(f'node {node} found no {degree} nodes below max_degree {max_degree}')
+        for target in targets:
+            _add_edge(adjacency, node, target)
+            ends.append(target)
+        ends.extend([node] * degree)
+    return adjacency
+
+
+def generate(family: str, num_nodes: int, degree: int = 4, seed: Optional[int] = None,
+             **options) -> List[List[int]]:
+    """
+    A connected topology of the given family as sorted adjacency lists, the same for the same seed.
+    Random families are drawn again when the result is not connected.
+    """
+    rng = random.Random(seed)
+    for _ in range(MAX_MATCH_ATTEMPTS):
+        topology = _generate(family, num_nodes, degree, rng, **options)
+        if is_connected(topology):
+            return topology
+    raise RuntimeError(f'no connected {family} topology with {num_nodes} nodes of degree {degree} '
+                       f'after {MAX_MATCH_ATTEMPTS} tries')
+
+
+def _generate(family: str, num_nodes: int, degree: int, rng: random.Random, **options) -> List[List[int]]:
+    if family == 'ring':
+        adjacency = ring(num_nodes)
+    elif family == 'ring-chords':
+        adjacency = ring_chords(num_nodes, degree, rng)
+    elif family == 'random-regular':
+        adjacency = random_regular(num_nodes, degree, rng)
+    elif family == 'small-world':
+        adjacency = small_world(num_nodes, degree, rng, **options)
+    elif family == 'scale-free':
+        adjacency = scale_free(num_nodes, degree, rng, **options)
+    else:
+        raise ValueError(f'Unknown topology family {family}, choose from {", ".join(FAMILIES)}')
+    return [sorted(neighbours) for neighbours in adjacency]
+
+
+def bfs(topology: List[List[int]], source: int) -> Tuple[int, int, int]:
+    """
+    (farthest node, its distance, number of nodes reached) from ``source``.
+    """
+    distance = [-1] * len(topology)
+    distance[source] = 0
+    frontier, depth, reached, farthest = [source], 0, 1, source
+    while frontier:
+        next_frontier = []
+        for node in frontier:
+            for neighbour in topology[node]:
+                if distance[neighbour] < 0:
+                    distance[neighbour] = depth + 1
+                    next_frontier.append(neighbour)
+        if not next_frontier:
+            break
+        depth += 1
+        reached += len(next_frontier)
+        farthest = next_frontier[0]
+        frontier = next_frontier
+    return farthest, depth, reached
+
+
+def is_connected(topology: List[List[int]]) -> bool:
+    return not topology or bfs(topology, 0)[2] == len(topology)
+
+
+def estimate_diameter(topology: List[List[int]], sweeps: int = 2, seed: Optional[int] = None) -> int:
+    """
+    Lower bound of the diameter by double sweeps: a BFS from a random node, then one from the
+    farthest node it found. It is exact for trees and rings and usually for random graphs, and
+    takes a few BFS instead of one per node.
+    """
+    rng = random.Random(seed)
+    diameter = 0
+    for _ in range(sweeps):
+        farthest, _, _ = bfs(topology, rng.randrange(len(topology)))
+        _, eccentricity, _ = bfs(topology, farthest)
+        diameter = max(diameter, eccentricity)
+    return diameter
+
+
+def describe(topology: List[List[int]]) -> dict:
+    degrees = [len(neighbours) for neighbours in topology]
+    connected = is_connected(topology)
+    return {
+        'nodes': len(topology),
+        'edges': sum(degrees) // 2,
+        'min_degree': min(degrees),
+        'max_degree': max(degrees),
+        'mean_degree': sum(degrees) / len(topology),
+        'connected': connected,
+        'diameter': estimate_diameter(topology) if connected else None,
+    }
+
+
+def write_yaml(topology: Iterable[List[int]], path: str) -> None:
+    # written node by node, the same layout as yaml.safe_dump of a dict of lists
+    with open(path, 'w') as f:
+        for node, neighbours in enumerate(topology):
+            if neighbours:
+                f.write(f'{node}:\n' + ''.join(f'- {neighbour}\n' for neighbour in neighbours))
+            else:
+                f.write(f'{node}: []\n')
+
+
+def write_binary(topology: List[List[int]], path: str) -> None:
+    """
+    Varints: the number of nodes, then for every node how many of its neighbours have a higher id and
+    the gaps between them. Every edge is stored once.
+    """
+    with open(path, 'wb') as f:
+        out = bytearray(BINARY_MAGIC)
+        write_uint(out, len(topology))
+        for node, neighbours in enumerate(topology):
+            higher = [neighbour for neighbour in neighbours if neighbour > node]
+            write_uint(out, len(higher))
+            previous = node
+            for neighbour in higher:
+                write_uint(out, neighbour - previous)
+                previous = neighbour
+            if len(out) > 1 << 16:
+                f.write(out)
+                out.clear()
+        f.write(out)
+
+
+def read_binary(path: str) -> List[List[int]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(BINARY_MAGIC):
+        raise ValueError(f'{path} is not a binary topology file')
+    offset = len(BINARY_MAGIC)
+
+    def read_uint() -> int:
+        nonlocal offset
+        value = shift = 0
+        while True:
+            if offset >= len(data):
+                raise ValueError(f'{path} is truncated')
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    topology: List[List[int]] = [[] for _ in range(read_uint())]
+    for node in range(len(topology)):
+        neighbour = node
+        for _ in range(read_uint()):
+            neighbour += read_uint()
+            topology[node].append(neighbour)
+            topology[neighbour].append(node)
+    # the lower neighbours were added first, so the lists are sorted
+    return topology
+
+
+def save(topology: List[List[int]], path: str) -> None:
+    if path.endswith('.bin'):
+        write_binary(topology, path)
+    else:
+        write_yaml(topology, path)
+
+
+def load(path: str) -> List[List[int]]:
+    if path.endswith('.bin'):
+        return read_binary(path)
+    import yaml
+    with open(path) as f:
+        connections: Dict[int, List[int]] = yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+    topology: List[List[int]] = [[] for _ in range(max(connections) + 1)]
+    for node, neighbours in connections.items():
+        topology[node] = sorted(neighbours or [])
+    return topology
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a network topology and check its connectivity')
+    parser.add_argument('family', choices=FAMILIES)
+    parser.add_argument('--nodes', type=int, default=100)
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default=None, help='a .yaml or .bin file')
+    args = parser.parse_args()
+
+    start = time.time()
+    topology = generate(args.family, args.nodes, args.degree, args.seed)
+    print(f'Generated in {time.time() - start:.2f}s: {describe(topology)}')
+    if args.output:
+        save(topology, args.output)
+        print(f'Output written to {args.output}')
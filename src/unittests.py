@@ -1,33 +1,1109 @@
 import unittest
+from collections import deque
+from types import SimpleNamespace
 
-from blockchain import Transaction, Block
+from ipv8.keyvault.crypto import default_eccrypto
+from ipv8.test.mocking.ipv8 import MockIPv8
+
+from amm import AMM, UNIT, Pool
+from benchmark import TOPOLOGIES, build_topology
+from block_builder import SELECT_FEE, BlockBuilder
+from block_sync import BlockSync
+from gossip import Gossip
+from block_tree import GENESIS_HASH, BlockTree, ChainUpdate
+from blockchain import BlockchainNode, BlockHeader, Transaction, Block
+from da_types import Blockchain
+from difficulty import Retarget, bits_to_target, target_to_bits
+from ledger import Ledger
+from log.logging_config import JsonFormatter, NodeLogger, SamplingFilter
+from mempool import EVICT_LOWEST_FEE, Mempool
+from mining import MiningEngine, MiningJob, ProcessPoolMiningEngine, search_nonces
+from nonce_index import NonceIndex
+from profiling import CallProfiler, SamplingProfiler, task_name
+from query_cache import QueryCache
+from validation import BlockValidator
+from verification import SignatureVerifier
+from topology import FAMILIES, describe, estimate_diameter, generate, is_connected, load, save
+from wire import UnknownKeyError, WireCodec
+from merkle_util import MerkleTree, verify_proof, verify_multiproof
+from metrics import MetricsRegistry, NodeMetrics, render, timed
 import hashlib
 import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
 
 
 class TestTransaction(unittest.TestCase):
-    def test_transaction_id(self):
-        transaction = Transaction(sender=1, receiver=2, amount=100, public_key_bin=b'public_key', signature=b'signature')
-        self.assertEqual(hashlib.sha256(f'{transaction.sender}{transaction.receiver}{transaction.amount}{transaction.nonce}'.encode()).hexdigest(), hashlib.sha256('121001'.encode()).hexdigest())
+    def test_signing_bytes(self):
+        transaction = Transaction(sender=1, receiver=2, is_uniswap=False, coin='ETH', amount=100,
+                                  public_key_bin=b'public_key', signature=b'signature', tx_id='', nonce=1)
+        signing_bytes = transaction.get_signing_bytes()
+        transaction.signature, transaction.ttl = b'other', 1
+        self.assertEqual(signing_bytes, transaction.get_signing_bytes())
+        self.assertEqual(transaction.signature, b'other')
+        transaction.amount = 101
+        self.assertNotEqual(signing_bytes, transaction.get_signing_bytes())
+
+
+class TestWire(unittest.TestCase):
+    def make_transaction(self, key, nonce, amount=5):
+        tx = Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=amount, public_key_bin=key,
+                         signature=b'sig' * 20, tx_id='', nonce=nonce, ttl=2)
+        tx.tx_id = tx.compute_tx_id()
+        return tx
+
+    def test_round_trip(self):
+        alice, bob = SimpleNamespace(mid=b'alice'), SimpleNamespace(mid=b'bob')
+        sender, receiver = WireCodec(Transaction, Block), WireCodec(Transaction, Block)
+        txs = [self.make_transaction(b'k' * 74, nonce) for nonce in range(1, 4)] + \
+              [self.make_transaction(b'q' * 74, 1, amount=-3)]
+        block = Block(number=2, prev_block_time=10, prev_block_hash=GENESIS_HASH, bits=target_to_bits(2 ** 248),
+                      transactions=txs, time=12, hash='ab' * 32, nonce=7, merkle_root=b'r' * 32, miner=b'm' * 74)
+
+        first = sender.encode_blocks(bob, [block])
+        decoded, = receiver.decode_blocks(alice, first)
+        self.assertEqual(decoded, block)
+        self.assertEqual([tx.tx_id for tx in decoded.transactions], [tx.tx_id for tx in txs])
+        self.assertEqual(decoded.get_encoded_header(), block.get_encoded_header())
+        # each key is sent in full once and referenced by its index afterwards
+        self.assertEqual(first.count(b'k' * 74), 1)
+
+        # a later message references the keys by hash
+        second = sender.encode_transactions(bob, txs)
+        self.assertNotIn(b'k' * 74, second)
+        self.assertLess(len(second), len(first))
+        self.assertEqual(receiver.decode_transactions(alice, second), txs)
+
+        with self.assertRaises(UnknownKeyError) as error:
+            WireCodec(Transaction, Block).decode_transactions(alice, second)
+        self.assertEqual(len(error.exception.key_hashes), 2)
+        sender.forget(bob, error.exception.key_hashes)
+        self.assertIn(b'k' * 74, sender.encode_transactions(bob, txs))
+
+        with self.assertRaises(ValueError):
+            receiver.decode_blocks(alice, first[:-1])
 
 
 class TestBlock(unittest.TestCase):
     def setUp(self):
-        self.block = Block(number=1, prev_block_time=1625097600, prev_block_hash='0', difficulty=1, puzzle_target=2, transactions=[])
+        self.block = Block(number=1, prev_block_time=1625097600, prev_block_hash='0',
+                           bits=target_to_bits(2 ** 248), transactions=[], time=1625097600, hash='0', nonce=0)
+        self.transaction = Transaction(sender=1, receiver=2, is_uniswap=False, coin='ETH', amount=50,
+                                       public_key_bin=b'key', signature=b'sig',
+                                       tx_id=hashlib.sha256(b'key1').hexdigest(), nonce=1)
 
     def test_add_transaction(self):
-        transaction = Transaction(sender=1, receiver=2, amount=50, public_key_bin=b'key', signature=b'sig')
-        self.block.add_transaction(transaction)
-        self.assertIn(transaction, self.block.transactions)
+        self.block.add_transaction(self.transaction)
+        self.assertIn(self.transaction, self.block.transactions)
+
+    def test_merkle_root_covers_content(self):
+        self.transaction.tx_id = self.transaction.compute_tx_id()
+        self.block.add_transaction(self.transaction)
+        root = self.block.compute_merkle_root()
+        changes = {'sender': 3, 'receiver': 3, 'is_uniswap': True, 'coin': 'BTC', 'amount': 90,
+                   'public_key_bin': b'other', 'signature': b'other', 'nonce': 2, 'fee': 1}
+        for name, value in changes.items():
+            tx = Transaction(**{**{field: getattr(self.transaction, field) for field in changes}, 'tx_id': '',
+                                name: value})
+            tx.tx_id = tx.compute_tx_id()
+            self.block.transactions = [tx]
+            self.assertNotEqual(self.block.compute_merkle_root(), root, name)
 
     def test_mine_block(self):
         asyncio.run(self.async_test_mine_block())
 
     async def async_test_mine_block(self):
-        transaction = Transaction(sender=1, receiver=2, amount=50, public_key_bin=b'key', signature=b'sig')
-        self.block.add_transaction(transaction)
-        mined_hash = await self.block.mine()
-        self.assertTrue(int(mined_hash, 16) < self.block.puzzle_target)
+        self.block.add_transaction(self.transaction)
+        self.block.merkle_root = self.block.compute_merkle_root()
+        prefix, suffix = self.block.get_hashing_parts(b'key')
+        target = self.block.get_target()
+        result = await MiningEngine().mine(MiningJob(self.block.number, prefix, suffix, target))
+        self.block.nonce = result.nonce
+        mined_hash = hashlib.sha256(self.block.get_hashing_value(b'key').encode()).hexdigest()
+        self.assertEqual(mined_hash, result.hash)
+        self.assertTrue(int(mined_hash, 16) < target)
+
+    def test_close_process_pool(self):
+        asyncio.run(self.async_test_close_process_pool())
+
+    async def async_test_close_process_pool(self):
+        prefix, suffix = self.block.get_hashing_parts(b'key')
+        engines = [ProcessPoolMiningEngine(1, chunk_size=1000) for _ in range(2)]
+        for engine in engines:
+            self.assertIsNotNone(await engine.mine(MiningJob(1, prefix, suffix, 2 ** 250)))
+        pool = engines[0].pool
+        self.assertIs(engines[1].pool, pool)
+        # the pool is shared, it only shuts down with the last engine
+        engines[0].close()
+        pool.submit(int).result()
+        engines[1].close()
+        self.assertRaises(RuntimeError, pool.submit, int)
+
+
+class TestLedger(unittest.TestCase):
+    def transaction(self, sender, receiver, coin, amount, nonce):
+        return Transaction(sender=sender, receiver=receiver, is_uniswap=False, coin=coin, amount=amount,
+                           public_key_bin=b'key', signature=b'', tx_id=str(nonce), nonce=nonce)
+
+    def test_check_block(self):
+        ledger = Ledger()
+        block = Block(1, 0, '0', 0, [self.transaction(1, 2, 'BTC', 60, 1), self.transaction(2, 3, 'BTC', 150, 2)],
+                      0, 'a', 0)
+        self.assertIsNone(ledger.check_block(block))
+        block.transactions.append(self.transaction(1, 3, 'BTC', 60, 3))
+        self.assertIsNotNone(ledger.check_block(block))
+        block.transactions.pop()
+        ledger.apply_block(block)
+        self.assertEqual(ledger.balance(2, 'BTC'), 10 * UNIT)
+        self.assertIsNotNone(ledger.check_block(block))
+
+    def test_undo_depth(self):
+        ledger = Ledger(max_undo_depth=1)
+        blocks = [Block(nonce, 0, '0', 0, [self.transaction(1, 2, 'BTC', 1, nonce)], 0, str(nonce), 0)
+                  for nonce in (1, 2)]
+        for block in blocks:
+            ledger.apply_block(block)
+        # only the blocks that can still be reverted list their transactions
+        self.assertEqual((list(ledger.undo), ledger.applied), (['2'], {'2': '2'}))
+        self.assertNotIn('applied', ledger.snapshot())
+        self.assertTrue(ledger.revert_block(blocks[1]))
+        self.assertEqual((ledger.applied, ledger.balance(2, 'BTC')), ({}, 101 * UNIT))
+
+
+class TestAMM(unittest.TestCase):
+    def test_batch_settlement(self):
+        amm = AMM([Pool('ETH', 'BTC', 100_000 * UNIT, 10_000 * UNIT, fee=0)])
+        quote = amm.quote('BTC', 'ETH', 10 * UNIT)
+        self.assertEqual(amm.pool('ETH', 'BTC').reserve_a, 10_000 * UNIT)
+        self.assertEqual(amm.settle([('BTC', 'ETH', 10 * UNIT)]), [quote])
+        invariant = amm.pool('BTC', 'ETH').invariant
+        outputs = amm.settle([('BTC', 'ETH', 10 * UNIT), ('ETH', 'BTC', 50 * UNIT), ('BTC', 'ETH', 20 * UNIT)])
+        # one price for every swap of the block
+        self.assertAlmostEqual(outputs[0] * 2, outputs[2], delta=1)
+        self.assertAlmostEqual(outputs[0] / (10 * UNIT), 50 * UNIT / outputs[1], places=6)
+        self.assertGreaterEqual(amm.pool('BTC', 'ETH').invariant, invariant)
+
+    def test_ledger_swaps(self):
+        ledger = Ledger()
+        swap = Transaction(sender=1, receiver=1, is_uniswap=True, coin='BTC', amount=10, public_key_bin=b'key',
+                           signature=b'', tx_id='1', nonce=1)
+        quote = ledger.quote('BTC', 10)
+        block = Block(1, 0, '0', 0, [swap], 0, 'a', 0)
+        ledger.apply_block(block)
+        self.assertEqual(ledger.account(1), {'BTC': 90 * UNIT, 'ETH': 1000 * UNIT + quote})
+        ledger.revert_block(block)
+        self.assertEqual(ledger.quote('BTC', 10), quote)
+
+
+class TestMempool(unittest.TestCase):
+    def test_page(self):
+        mempool = Mempool()
+        txs = [Transaction(sender=i % 2, receiver=2, is_uniswap=False, coin='BTC', amount=1, public_key_bin=b'key',
+                           signature=b'', tx_id=str(i), nonce=i) for i in range(5)]
+        for tx in txs:
+            mempool.add(tx)
+        mempool.finalize(txs[1])
+        entries, cursor = mempool.page(limit=2)
+        self.assertEqual([tx.nonce for _, _, tx in entries], [0, 1])
+        entries, cursor = mempool.page(cursor, limit=10)
+        self.assertEqual(([tx.nonce for _, _, tx in entries], cursor), ([2, 3, 4], None))
+        entries, _ = mempool.page(sender=1, newest_first=True)
+        self.assertEqual([(status, tx.nonce) for _, status, tx in entries], [('pending', 3), ('finalized', 1)])
+
+    def test_eviction(self):
+        txs = [Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=1, public_key_bin=b'key',
+                           signature=b'', tx_id=str(i), nonce=i, fee=fee) for i, fee in enumerate((3, 1, 2, 5))]
+        oldest = Mempool(capacity=2)
+        for tx in txs[:3]:
+            oldest.add(tx)
+        self.assertEqual(list(oldest.pending), ['1', '2'])
+
+        lowest_fee = Mempool(capacity=2, eviction=EVICT_LOWEST_FEE)
+        for tx in txs[:3]:
+            lowest_fee.add(tx)
+        self.assertEqual(list(lowest_fee.pending), ['0', '2'])
+        # finalized transactions leave stale heap entries behind
+        lowest_fee.finalize(txs[2])
+        lowest_fee.add(txs[1])
+        self.assertTrue(lowest_fee.add(txs[3]))
+        self.assertEqual(list(lowest_fee.pending), ['0', '3'])
+        self.assertEqual(lowest_fee.evicted, 2)
+
+        evicted = []
+        bounded = Mempool(capacity=2, on_evict=evicted.append)
+        for tx in txs[:2]:
+            bounded.finalize(tx)
+        for tx in txs[2:]:
+            bounded.add(tx)
+        # transactions of a disconnected block count against the capacity as well
+        bounded.unfinalize(txs[0])
+        self.assertEqual((len(bounded), evicted), (2, [txs[2]]))
+
+
+class TestBlockTree(unittest.TestCase):
+    def block(self, parent, block_hash, bits=target_to_bits(2 ** 255)):
+        return Block(parent.number + 1 if parent else 1, 0, parent.hash if parent else GENESIS_HASH, bits, [], 0,
+                     block_hash, 0)
+
+    def test_reorg(self):
+        tree = BlockTree()
+        a1 = self.block(None, 'a1')
+        a2 = self.block(a1, 'a2')
+        self.assertEqual(tree.insert(a1).connected, [a1])
+        tree.insert(a2)
+        b2 = self.block(a1, 'b2')
+        b3 = self.block(b2, 'b3')
+        # as much work as the best tip is not enough to switch
+        update = tree.insert(b2)
+        self.assertEqual((update.added, update.connected, tree.tip, tree.fork_count), (True, [], a2, 2))
+
+        update = tree.insert(b3)
+        # undo newest first, then apply oldest first
+        self.assertEqual((update.disconnected, update.connected), ([a2], [b2, b3]))
+        self.assertEqual((tree.tip, tree.height), (b3, 3))
+        self.assertEqual([tree.block_at(number) for number in (1, 2, 3, 4)], [a1, b2, b3, None])
+        self.assertFalse(tree.is_canonical('a2'))
+
+        # the most work wins, not the longest chain
+        heavy = self.block(a2, 'heavy', bits=target_to_bits(2 ** 250))
+        update = tree.insert(heavy)
+        self.assertEqual((update.disconnected, update.connected), ([b3, b2], [a2, heavy]))
+        self.assertEqual(list(tree.chain()), [a1, a2, heavy])
+
+    def test_orphans(self):
+        tree = BlockTree()
+        a1 = self.block(None, 'a1')
+        a2 = self.block(a1, 'a2')
+        a3 = self.block(a2, 'a3')
+        update = tree.insert(a3)
+        self.assertTrue(update.orphan)
+        self.assertEqual((tree.missing_parents(), tree.height), (['a2'], 0))
+        tree.insert(a1)
+        # the parent shows up and the orphan connects with it
+        update = tree.insert(a2)
+        self.assertEqual((update.connected, tree.orphan_count, tree.missing_parents()), ([a2, a3], 0, []))
+        self.assertEqual(tree.insert(a3), ChainUpdate())
+
+        anchored = BlockTree()
+        anchored.anchor(a2)
+        anchored.insert(a3)
+        # the height is the tip's block number, also when older blocks are not loaded
+        self.assertEqual((anchored.height, anchored.block_at(1), anchored.block_at(3)), (3, None, a3))
+
+
+    def test_prune(self):
+        tree = BlockTree()
+        chain = [self.block(None, 'a1')]
+        for number in range(2, 6):
+            chain.append(self.block(chain[-1], f'a{number}'))
+        for block in chain:
+            tree.insert(block)
+        tree.insert(self.block(chain[0], 'b2'))
+        fork = self.block(chain[3], 'b5')
+        tree.insert(fork)
+        # the fork below the new anchor goes with the old blocks, the recent one stays
+        self.assertEqual(tree.prune(3), 3)
+        self.assertEqual((len(tree), tree.fork_count, tree.height), (4, 2, 5))
+        self.assertEqual([tree.block_at(number) for number in (2, 3, 5)], [None, chain[2], chain[4]])
+        self.assertIsNone(tree.nodes['a3'].parent)
+        update = tree.insert(self.block(fork, 'b6'))
+        self.assertEqual((update.disconnected, tree.tip.hash), ([chain[4]], 'b6'))
+        self.assertEqual(tree.prune(3), 1)
+        self.assertEqual([block.hash for block in tree.chain()], ['a4', 'b5', 'b6'])
+
+
+class StubNode:
+    # what BlockSync and Gossip use of a node, messages are recorded as tuples instead of being sent
+    def __init__(self, peers):
+        self.peers = peers
+        self.block_tree = BlockTree()
+        self.mempool = Mempool()
+        self.metrics = NodeMetrics(self)
+        self.store = None
+        self.node_id = 0
+        self.sent = []
+        self.tasks = set()
+        self.anonymous_tasks = []
+
+    def get_peers(self):
+        return self.peers
+
+    @property
+    def neighbours(self):
+        return list(enumerate(self.peers))
+
+    def other_neighbours(self, peer):
+        return [(node_id, other) for node_id, other in self.neighbours if other != peer]
+
+    def ez_send(self, peer, message):
+        self.sent.append((peer, message))
+
+    def create_headers_request(self, start, count):
+        return 'headers', start, count
+
+    def create_blocks_request(self, node_id, start, end):
+        return 'blocks', start, end
+
+    def create_inventory(self, ttl, tx_hashes, block_hashes):
+        return 'inventory', ttl, tx_hashes, block_hashes
+
+    def create_get_data(self, tx_hashes, block_hashes):
+        return 'get_data', tx_hashes, block_hashes
+
+    def create_get_block_transactions(self, block_hash, tx_hashes):
+        return 'get_block_transactions', block_hash, tx_hashes
+
+    def create_block_transactions(self, peer, block_hash, transactions):
+        return 'block_transactions', block_hash, transactions
+
+    def send_transactions(self, peer, transactions):
+        self.sent.append((peer, ('transactions', transactions)))
+
+    def register_anonymous_task(self, name, callback, *args):
+        self.anonymous_tasks.append(callback(*args))
+
+    def register_task(self, name, *args, **kwargs):
+        self.tasks.add(name)
+
+    def is_pending_task_active(self, name):
+        return name in self.tasks
+
+    def cancel_pending_task(self, name):
+        self.tasks.discard(name)
+
+    async def process_block(self, peer, block):
+        return self.block_tree.insert(block)
+
+
+class TestBlockSync(unittest.TestCase):
+    def test_sync(self):
+        asyncio.run(self.async_test_sync())
+
+    async def async_test_sync(self):
+        chain = [Block(1, 0, GENESIS_HASH, target_to_bits(2 ** 255), [], 0, 'h1', 0)]
+        for number in range(2, 4):
+            chain.append(Block(number, 0, chain[-1].hash, target_to_bits(2 ** 255), [], 0, f'h{number}', 0))
+        headers = [BlockHeader(block.number, block.hash, block.prev_block_hash) for block in chain]
+        node = StubNode(['a', 'b'])
+        sync = BlockSync(node, range_size=2)
+
+        sync.start('a', 3)
+        self.assertEqual(node.sent, [('a', ('headers', 1, 3))])
+        self.assertTrue(sync.syncing)
+        # headers only count from the peer they were asked from
+        sync.on_headers('b', 1, headers)
+        self.assertFalse(sync.queue or sync.in_flight)
+        sync.on_headers('a', 1, headers)
+        self.assertEqual(node.sent[1:], [('a', ('blocks', 1, 2)), ('b', ('blocks', 3, 3))])
+
+        # a block that does not match its header is not processed
+        forged = Block(3, 0, 'h2', target_to_bits(2 ** 255), [], 0, 'forged', 0)
+        await sync.on_blocks('b', 3, 3, [forged])
+        await sync.on_blocks('a', 1, 2, chain[:2])
+        self.assertNotIn('forged', node.block_tree)
+        self.assertEqual(node.block_tree.tip, chain[1])
+        # the missing block is looked up again
+        self.assertEqual(node.sent[-1], ('a', ('headers', 3, 1)))
+        sync.on_headers('a', 3, headers[2:])
+        self.assertEqual(node.sent[-1], ('a', ('blocks', 3, 3)))
+
+        # an unanswered range goes to another peer
+        sync.in_flight[3].deadline = 0
+        sync.tick()
+        self.assertEqual(node.sent[-1], ('b', ('blocks', 3, 3)))
+        await sync.on_blocks('b', 3, 3, chain[2:])
+        self.assertEqual((node.block_tree.tip, sync.syncing, node.tasks), (chain[2], False, set()))
+
+    def test_fork(self):
+        node = StubNode(['a'])
+        node.block_tree.insert(Block(1, 0, GENESIS_HASH, target_to_bits(2 ** 255), [], 0, 'h1', 0))
+        sync = BlockSync(node, range_size=2)
+        sync.start('a', 4)
+        self.assertEqual(node.sent, [('a', ('headers', 2, 3))])
+        # the peer's chain does not build on our tip, ask for headers further back
+        sync.on_headers('a', 2, [BlockHeader(2, 'f2', 'f1'), BlockHeader(3, 'f3', 'f2')])
+        self.assertEqual(node.sent[-1], ('a', ('headers', 1, 4)))
+        self.assertFalse(sync.queue or sync.in_flight)
+
+
+class TestGossip(unittest.TestCase):
+    def transaction(self, nonce):
+        tx = Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=1, public_key_bin=b'key',
+                         signature=b'', tx_id='', nonce=nonce)
+        tx.tx_id = tx.compute_tx_id()
+        return tx
+
+    def test_inventory(self):
+        asyncio.run(self.async_test_inventory())
+
+    async def async_test_inventory(self):
+        node = StubNode(['a', 'b'])
+        gossip = Gossip(node)
+        known, new, late = self.transaction(1), self.transaction(2), self.transaction(3)
+        node.mempool.add(known)
+        digests = [bytes.fromhex(tx.tx_id) for tx in (known, new, late)]
+
+        # only what we lack is requested, and only from the first peer that announced it
+        gossip.on_inventory('a', 2, digests[0] + digests[1], b'')
+        self.assertEqual(node.sent, [('a', ('get_data', digests[1], b''))])
+        gossip.on_inventory('b', 2, digests[1], b'')
+        gossip.on_inventory('a', 2, digests[1], b'')
+        self.assertEqual((len(node.sent), list(gossip.requests[digests[1]].announcers)), (1, ['b']))
+        self.assertEqual(gossip.received_tx(new), 2)
+        gossip.on_inventory('b', 2, digests[1], b'')
+        self.assertEqual(len(node.sent), 1)
+
+        # an unanswered request goes to the next announcer
+        gossip.on_inventory('a', 1, digests[2], b'')
+        gossip.on_inventory('b', 1, digests[2], b'')
+        gossip.requests[digests[2]].deadline = 0
+        gossip.tick()
+        self.assertEqual(node.sent[-1], ('b', ('get_data', digests[2], b'')))
+
+        # announcements of one event loop iteration share a message per peer
+        node.sent.clear()
+        gossip.announce_tx(self.transaction(4), exclude='b')
+        gossip.announce_tx(self.transaction(5), exclude='b')
+        await asyncio.sleep(0)
+        self.assertEqual(node.sent, [('a', ('inventory', 3, bytes.fromhex(self.transaction(4).tx_id) +
+                                            bytes.fromhex(self.transaction(5).tx_id), b''))])
+
+    def test_compact_block(self):
+        asyncio.run(self.async_test_compact_block())
+
+    async def async_test_compact_block(self):
+        sender, receiver = StubNode(['b']), StubNode(['a', 'c'])
+        known, unknown = self.transaction(1), self.transaction(2)
+        block = Block(1, 0, GENESIS_HASH, target_to_bits(2 ** 255), [known, unknown], 0, 'ab' * 32, 0)
+        block.merkle_root = block.compute_merkle_root()
+        sender.block_tree.insert(block)
+        receiver.mempool.add(known)
+        header = Block(1, 0, GENESIS_HASH, target_to_bits(2 ** 255), [], 0, 'ab' * 32, 0, block.merkle_root)
+        tx_ids = b''.join(bytes.fromhex(tx.tx_id) for tx in block.transactions)
+
+        gossip = Gossip(receiver)
+        gossip.on_compact_block('a', header, tx_ids)
+        # the receiver has one of the transactions and asks the sender for the other
+        request = ('get_block_transactions', block.hash, bytes.fromhex(unknown.tx_id))
+        self.assertEqual(receiver.sent, [('a', request)])
+        Gossip(sender).on_get_block_txs('b', block.hash, request[2])
+        self.assertEqual(sender.sent, [('b', ('block_transactions', block.hash, [unknown]))])
+
+        gossip.on_block_txs('c', block.hash, [unknown])
+        self.assertEqual(receiver.anonymous_tasks, [])
+        gossip.on_block_txs('a', block.hash, [unknown])
+        await receiver.anonymous_tasks.pop()
+        self.assertEqual(receiver.block_tree.tip.transactions, [known, unknown])
+        await asyncio.sleep(0)
+        # and relays it to everyone but the sender
+        self.assertEqual(receiver.sent[-1], ('c', ('inventory', 0, b'', bytes.fromhex(block.hash))))
+
+        # a block whose transactions are all in the mempool is rebuilt right away
+        pending = self.transaction(3)
+        receiver.mempool.add(pending)
+        child = Block(2, 0, block.hash, target_to_bits(2 ** 255), [pending], 0, 'cd' * 32, 0)
+        child.merkle_root = child.compute_merkle_root()
+        child.transactions = []
+        sent = len(receiver.sent)
+        # ids that do not add up to the header's Merkle root are dropped before the block is processed
+        gossip.on_compact_block('a', child, bytes.fromhex(known.tx_id))
+        self.assertEqual(len(receiver.sent), sent)
+        await receiver.anonymous_tasks.pop()
+        self.assertEqual((receiver.block_tree.tip, receiver.metrics.blocks_invalid.value), (block, 1))
+        gossip.on_compact_block('a', child, bytes.fromhex(pending.tx_id))
+        await receiver.anonymous_tasks.pop()
+        self.assertEqual((receiver.block_tree.tip, child.transactions), (child, [pending]))
+
+
+class TestQueryCache(unittest.TestCase):
+    def test_views(self):
+        node = SimpleNamespace(block_tree=BlockTree(), ledger=Ledger(), mempool=Mempool())
+        queries = QueryCache(node)
+        tx = Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=5, public_key_bin=b'key',
+                         signature=b'', tx_id='1', nonce=1)
+        node.mempool.add(tx)
+        queries.on_transaction(tx)
+        self.assertEqual([entry['status'] for entry in queries.account_history(2)], ['pending'])
+        balance = queries.balance(1)
+        self.assertIs(queries.balance(1), balance)
+        # new transactions only touch the views of their accounts and the pages
+        history = queries.account_history(1)
+        page, _ = queries.transactions(newest_first=True)
+        other = Transaction(sender=3, receiver=4, is_uniswap=False, coin='BTC', amount=5, public_key_bin=b'other',
+                            signature=b'', tx_id='2', nonce=1)
+        node.mempool.add(other)
+        queries.on_transaction(other)
+        self.assertIs(queries.account_history(1), history)
+        self.assertIs(queries.balance(1), balance)
+        self.assertEqual([entry['hash_id'] for entry in queries.transactions(newest_first=True)[0]], ['2', '1'])
+        self.assertEqual([entry['hash_id'] for entry in page], ['1'])
+        node.mempool.remove(other.tx_id)
+        queries.on_removed([other])
+        self.assertEqual(queries.account_history(3), [])
+
+        block = Block(1, 0, GENESIS_HASH, target_to_bits(2 ** 255), [tx], 0, 'a', 0)
+        update = node.block_tree.insert(block)
+        node.ledger.apply_block(block)
+        node.mempool.finalize(tx)
+        queries.on_chain_update(update)
+        self.assertEqual(queries.balance(1)['balances']['BTC'], 95)
+        self.assertEqual([entry['block_number'] for entry in queries.account_history(2)], [1])
+        self.assertEqual([b['hash'] for b in queries.latest_blocks(5)], ['a'])
+        self.assertEqual(queries.transactions()[0][0]['status'], 'processed')
+        node.block_tree.remove(block.hash)
+        node.mempool.unfinalize(tx)
+        queries.on_chain_update(ChainUpdate(disconnected=[block]))
+        self.assertEqual(queries.history[2], deque())
+        self.assertEqual([entry['status'] for entry in queries.account_history(2)], ['pending'])
+
+
+class TestBlockBuilder(unittest.TestCase):
+    def transaction(self, key, nonce, fee=0):
+        return Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=1, public_key_bin=key,
+                           signature=b'', tx_id=f'{key.hex()}{nonce}', nonce=nonce, fee=fee)
+
+    def test_fee_selection(self):
+        builder = BlockBuilder(Mempool(), lambda tx: 1, max_transactions=2, selection=SELECT_FEE)
+        self.assertTrue(builder.add(self.transaction(b'a', 1, fee=1)))
+        self.assertTrue(builder.add(self.transaction(b'b', 1, fee=3)))
+        self.assertTrue(builder.full)
+        self.assertFalse(builder.add(self.transaction(b'c', 1, fee=1)))
+        self.assertTrue(builder.add(self.transaction(b'c', 2, fee=2)))
+        self.assertEqual(sorted(tx.fee for tx in builder.take()), [2, 3])
+
+    def test_nonce_order(self):
+        mempool = Mempool()
+        for tx in (self.transaction(b'a', 2), self.transaction(b'b', 1), self.transaction(b'a', 1)):
+            mempool.add(tx)
+        builder = BlockBuilder(mempool, lambda tx: 1)
+        builder.fill()
+        self.assertEqual([(tx.public_key_bin, tx.nonce) for tx in builder.take()],
+                         [(b'a', 1), (b'b', 1), (b'a', 2)])
+        block = Block(1, 0, '0', 0, builder.take()[:2], 0, 'a', 0)
+        for tx in block.transactions:
+            mempool.finalize(tx)
+        builder.on_block(block)
+        self.assertEqual([tx.nonce for tx in builder.take()], [2])
+
+    def test_nonce_gap(self):
+        builder = BlockBuilder(Mempool(), lambda tx: 1, first_nonce=lambda public_key_bin: 2)
+        for tx in (self.transaction(b'a', 4), self.transaction(b'a', 1), self.transaction(b'a', 2),
+                   self.transaction(b'b', 2)):
+            builder.add(tx)
+        # a block only gets the run that follows the confirmed nonce
+        self.assertEqual([(tx.public_key_bin, tx.nonce) for tx in builder.take()], [(b'a', 2), (b'b', 2)])
+
+
+class TestNonceIndex(unittest.TestCase):
+    def transaction(self, nonce):
+        return Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=1, public_key_bin=b'key',
+                           signature=b'', tx_id=str(nonce), nonce=nonce)
+
+    def test_gap(self):
+        index = NonceIndex(max_gap=4)
+        self.assertEqual(index.add(self.transaction(2)), [])
+        self.assertFalse(index.is_ready(self.transaction(2)))
+        self.assertEqual([tx.nonce for tx in index.add(self.transaction(1))], [1, 2])
+        self.assertEqual(index.next_nonce(b'key'), 3)
+        self.assertIsNone(index.check(self.transaction(6)))
+        self.assertIsNotNone(index.check(self.transaction(7)))
+
+    def test_confirm_and_revert(self):
+        index = NonceIndex()
+        index.add(self.transaction(3))
+        block = Block(1, 0, '0', 0, [self.transaction(1), self.transaction(2)], 0, 'a', 0)
+        self.assertEqual([tx.nonce for tx in index.confirm(block)], [3])
+        self.assertIsNotNone(index.check(self.transaction(2)))
+        index.revert(block)
+        self.assertIsNone(index.check(self.transaction(2)))
+        self.assertTrue(index.is_ready(self.transaction(2)))
+
+    def test_discard(self):
+        index = NonceIndex()
+        held = self.transaction(2)
+        index.add(held)
+        index.discard(self.transaction(1))
+        self.assertEqual(index.held, {b'key': {2: held}})
+        index.discard(held)
+        self.assertEqual(index.held, {})
+        self.assertEqual([tx.nonce for tx in index.add(self.transaction(1))], [1])
+
+    def test_held_transaction(self):
+        asyncio.run(self.async_test_held_transaction())
+
+    async def async_test_held_transaction(self):
+        ipv8 = MockIPv8("curve25519", BlockchainNode)
+        node = ipv8.overlay
+        node.node_id = 0
+        try:
+            held = self.transaction(2)
+            node.add_transaction(held)
+            self.assertNotIn(held.tx_id, node.builder)
+            block = Block(1, 0, GENESIS_HASH, node.retarget.initial_bits, [self.transaction(1)], 1, 'ab' * 32, 0)
+            node.apply_chain_update(node.append_block(block))
+            # the block confirmed the missing nonce, the held transaction is minable right away
+            self.assertIn(held.tx_id, node.builder)
+        finally:
+            await ipv8.stop()
+
+
+class TestDifficulty(unittest.TestCase):
+    def test_compact_bits(self):
+        for target in (1, 0x7fffff, 0x800000, 2 ** 243, 2 ** 200 + 12345, 2 ** 256 - 1):
+            bits = target_to_bits(target)
+            self.assertLessEqual(bits_to_target(bits), target)
+            self.assertEqual(target_to_bits(bits_to_target(bits)), bits)
+        self.assertEqual(bits_to_target(0x1d00ffff), 0xffff * 256 ** 26)
+
+    def test_retarget(self):
+        bits = target_to_bits(2 ** 240)
+        retarget = Retarget(bits, target_block_time=3, window=4, max_adjust=2)
+        self.assertEqual(retarget.next_bits(), bits)
+        for t in (0, 6, 12, 18):
+            retarget.push(Block(1, 0, '0', bits, [], t, '0', 0))
+        # blocks took twice as long as wanted
+        self.assertEqual(retarget.next_target(), 2 ** 241)
+        retarget.reset(Block(1, 0, '0', bits, [], 0, '0', 0) for _ in range(4))
+        self.assertEqual(retarget.next_target(), 2 ** 239)
+
+
+class TestSignatureVerifier(unittest.TestCase):
+    def test_batches(self):
+        asyncio.run(self.async_test_batches())
+
+    async def async_test_batches(self):
+        # one worker finishes the batches in order, which the cache contents below depend on
+        verifier = SignatureVerifier(default_eccrypto, verified_cache_size=3, batch_size=4, workers=1)
+        key = default_eccrypto.generate_key('curve25519')
+        items = [(key.pub().key_to_bin(), b'message %d' % i, default_eccrypto.create_signature(key, b'message %d' % i))
+                 for i in range(5)]
+        # a valid signature, but of another message
+        tampered = (items[2][0], items[2][1], items[3][2])
+        batches = []
+        verify_batch = verifier._verify_batch
+
+        def record(batch):
+            batches.append((len(batch), threading.get_ident()))
+            return verify_batch(batch)
+        verifier._verify_batch = record
+
+        results = await verifier.verify_many(items[:2] + [tampered] + items[2:])
+        self.assertEqual(results, [True, True, False, True, True, True])
+        self.assertEqual([size for size, _ in batches], [4, 2])
+        self.assertNotIn(threading.get_ident(), [thread for _, thread in batches])
+        self.assertEqual(verifier.key_from_public_bin.cache_info().currsize, 1)
+
+        # only valid pairs are remembered, the least recently used ones are dropped
+        self.assertEqual(len(verifier.verified), 3)
+        self.assertTrue(await verifier.verify(*items[2]))
+        self.assertEqual((verifier.cache_hits, verifier.verifications), (1, 6))
+        self.assertFalse(await verifier.verify(*tampered))
+        self.assertTrue(verifier.verify_now(*items[0]))
+        self.assertEqual((verifier.cache_hits, verifier.verifications), (1, 8))
+        self.assertNotIn(verifier.digest(*items[3][1:]), verifier.verified)
+        self.assertIn(verifier.digest(*items[2][1:]), verifier.verified)
+
+
+class TestBlockValidator(unittest.TestCase):
+    def setUp(self):
+        self.bits = target_to_bits(2 ** 254)
+        self.key = default_eccrypto.generate_key('curve25519')
+        self.node = SimpleNamespace(block_tree=BlockTree(), ledger=Ledger(), nonces=NonceIndex(),
+                                    retarget=Retarget(self.bits), verifier=SignatureVerifier(default_eccrypto))
+        self.node.ledger.tip_hash = GENESIS_HASH
+        self.validator = BlockValidator(self.node)
+
+    def transaction(self, nonce, amount=5):
+        tx = Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=amount,
+                         public_key_bin=self.key.pub().key_to_bin(), signature=b'', tx_id='', nonce=nonce)
+        tx.signature = default_eccrypto.create_signature(self.key, tx.get_signing_bytes())
+        tx.tx_id = tx.compute_tx_id()
+        return tx
+
+    def block(self, parent=None, transactions=(), **fields):
+        start = parent.time if parent else int(time.time()) - 60
+        block = Block(number=parent.number + 1 if parent else 1, prev_block_time=start,
+                      prev_block_hash=parent.hash if parent else GENESIS_HASH, bits=self.bits,
+                      transactions=list(transactions), time=start + 1, hash='', nonce=0, miner=b'miner')
+        block.merkle_root = block.compute_merkle_root()
+        for name, value in fields.items():
+            setattr(block, name, value)
+        prefix, suffix = block.get_hashing_parts(block.miner)
+        block.nonce, digest = search_nonces(prefix, suffix, block.get_target().to_bytes(32, 'big'), 0, 10_000)
+        block.hash = digest.hex()
+        return block
+
+    def validate(self, block):
+        return asyncio.run(self.validator.validate(block))
+
+    def test_time(self):
+        parent = self.block()
+        self.node.block_tree.insert(parent)
+        self.assertIsNone(self.validate(self.block(parent)))
+        self.assertIn('median time', self.validate(self.block(parent, time=parent.time)))
+        self.assertIn('parent time', self.validate(self.block(parent, prev_block_time=parent.time - 1)))
+        self.assertIn('future', self.validate(self.block(parent, time=int(time.time()) + 3600)))
+        # the times are part of the proof of work
+        block = self.block(parent)
+        block.time += 1
+        self.assertIn('does not match', self.validate(block))
+
+    def test_stages(self):
+        self.assertIsNone(self.validate(self.block(transactions=[self.transaction(1), self.transaction(2)])))
+        block = self.block()
+        block.nonce += 1
+        self.assertIn('hash does not match', self.validate(block))
+        self.assertIn('target bits', self.validate(self.block(bits=target_to_bits(2 ** 253))))
+        self.assertIn('merkle root', self.validate(self.block(transactions=[self.transaction(1)],
+                                                               merkle_root=b'r' * 32)))
+        tampered = self.transaction(1)
+        tampered.signature = bytes([tampered.signature[0] ^ 1]) + tampered.signature[1:]
+        tampered.tx_id = tampered.compute_tx_id()
+        self.assertIn('invalid signature', self.validate(self.block(transactions=[tampered, self.transaction(2)])))
+        self.assertIn('spends more', self.validate(self.block(transactions=[self.transaction(1, amount=101)])))
+        # the ids commit to the content, a transaction cannot be swapped for another one under the same id
+        block = self.block(transactions=[self.transaction(1)])
+        forged = self.transaction(1, amount=90)
+        forged.tx_id = block.transactions[0].tx_id
+        block.transactions[0] = forged
+        self.assertIn('does not match its content', self.validate(block))
+        self.assertIn('expected 1', self.validate(self.block(transactions=[self.transaction(2)])))
+        self.assertIn('expected 2', self.validate(self.block(transactions=[self.transaction(1), self.transaction(3)])))
+
+        first = self.block(transactions=[self.transaction(1)])
+        self.node.block_tree.insert(first)
+        self.node.ledger.apply_block(first)
+        self.node.nonces.confirm(first)
+        self.assertIn('already in the chain', self.validate(self.block(first, transactions=[self.transaction(1)])))
+        self.assertIsNone(self.validate(self.block(first, transactions=[self.transaction(2)])))
+
+    def test_foreign_sender(self):
+        other = default_eccrypto.generate_key('curve25519')
+        foreign = Transaction(sender=1, receiver=3, is_uniswap=False, coin='BTC', amount=5,
+                              public_key_bin=other.pub().key_to_bin(), signature=b'', tx_id='', nonce=1)
+        foreign.signature = default_eccrypto.create_signature(other, foreign.get_signing_bytes())
+        foreign.tx_id = foreign.compute_tx_id()
+        # the first transaction binds account 1 to our key, inside the block and once it is applied
+        self.assertIn('owner', self.validate(self.block(transactions=[self.transaction(1), foreign])))
+        first = self.block(transactions=[self.transaction(1)])
+        self.node.block_tree.insert(first)
+        self.node.ledger.apply_block(first)
+        self.node.nonces.confirm(first)
+        self.assertIn('owner', self.validate(self.block(first, transactions=[foreign])))
+        self.assertFalse(self.node.ledger.can_apply(foreign))
+        self.node.ledger.revert_block(first)
+        self.assertTrue(self.node.ledger.can_apply(foreign))
+
+    def test_select(self):
+        other = default_eccrypto.generate_key('curve25519')
+        gap = Transaction(sender=3, receiver=2, is_uniswap=False, coin='BTC', amount=1,
+                          public_key_bin=other.pub().key_to_bin(), signature=b'', tx_id='gap', nonce=2)
+        transactions = [self.transaction(1, amount=60), gap, self.transaction(2, amount=60), self.transaction(3)]
+        selected, invalid = self.validator.select(transactions)
+        # the overspend can never be mined, the sender's next transaction waits for a replacement
+        self.assertEqual(selected, transactions[:1])
+        self.assertEqual(invalid, transactions[2:3])
+
+    def test_mine_invalid_block(self):
+        asyncio.run(self.async_test_mine_invalid_block())
+
+    async def async_test_mine_invalid_block(self):
+        ipv8 = MockIPv8("curve25519", BlockchainNode)
+        node = ipv8.overlay
+        node.node_id, node.retarget = 0, Retarget(self.bits)
+        try:
+            # the template was taken before a block spent the balance, the mined block is invalid
+            overspend = self.transaction(1, amount=101)
+            node.mempool.add(overspend)
+            node.builder.transactions[overspend.tx_id] = overspend
+            node.builder.sizes[overspend.tx_id] = 0
+            node.select_transactions = node.builder.take
+            self.assertIsNone(await node.mine())
+            self.assertIsNone(node.block_tree.tip)
+            self.assertNotIn(overspend.tx_id, node.mempool)
+            self.assertNotIn(overspend.tx_id, node.builder)
+            self.assertIsNotNone(await node.mine())
+        finally:
+            await ipv8.stop()
+
+    def test_overspend_does_not_stall(self):
+        asyncio.run(self.async_test_overspend_does_not_stall())
+
+    async def async_test_overspend_does_not_stall(self):
+        ipv8 = MockIPv8("curve25519", BlockchainNode)
+        node = ipv8.overlay
+        node.node_id, node.retarget = 0, Retarget(self.bits)
+        try:
+            key = default_eccrypto.generate_key('curve25519')
+            overspend = Transaction(sender=3, receiver=2, is_uniswap=False, coin='ETH', amount=5000,
+                                    public_key_bin=key.pub().key_to_bin(), signature=b'', tx_id='', nonce=1)
+            overspend.signature = default_eccrypto.create_signature(key, overspend.get_signing_bytes())
+            overspend.tx_id = overspend.compute_tx_id()
+            node.add_transaction(overspend)
+            self.assertNotIn(overspend.tx_id, node.builder)
+            # two transactions the balance covers one at a time but not together
+            first, second = self.transaction(1, amount=60), self.transaction(2, amount=60)
+            for tx in (first, second):
+                node.add_transaction(tx)
+            self.assertIsNotNone(await node.mine())
+            self.assertEqual(node.block_tree.tip.number, 1)
+            self.assertEqual(node.block_tree.tip.transactions, [first])
+            self.assertNotIn(second.tx_id, node.mempool)
+            self.assertIsNotNone(await node.mine())
+            self.assertEqual(node.block_tree.tip.number, 2)
+        finally:
+            await ipv8.stop()
+
+    def test_invalid_fork(self):
+        asyncio.run(self.async_test_invalid_fork())
+
+    async def async_test_invalid_fork(self):
+        ipv8 = MockIPv8("curve25519", BlockchainNode)
+        node = ipv8.overlay
+        node.node_id, node.retarget = 0, Retarget(self.bits)
+        try:
+            ours = self.block()
+            node.on_chain_update(node.append_block(ours))
+            # a heavier fork whose second block overspends, it only gets checked when it becomes canonical
+            fork = self.block(miner=b'other')
+            node.on_chain_update(node.append_block(fork))
+            self.assertEqual(node.block_tree.tip, ours)
+            invalid = self.block(fork, transactions=[self.transaction(1, amount=101)])
+            update = node.apply_chain_update(node.append_block(invalid))
+            self.assertEqual((update.disconnected, update.connected, update.invalid), ([ours], [fork], [invalid]))
+            self.assertNotIn(invalid.hash, node.block_tree)
+            self.assertEqual((node.block_tree.tip, node.ledger.tip_hash), (fork, fork.hash))
+            self.assertEqual(node.ledger.balance(1, 'BTC'), 100 * UNIT)
+        finally:
+            await ipv8.stop()
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render(self):
+        registry = MetricsRegistry(node=3)
+        registry.counter('received_total', 'Received').inc(2)
+        self.assertIs(registry.counter('received_total', 'Received'), registry.counter('received_total', 'Received'))
+        registry.gauge('size', 'Size', lambda: 7)
+        histogram = registry.histogram('seconds', 'Seconds', (0.1, 1.0), handler='on_block')
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value)
+        lines = render([registry, MetricsRegistry(node=4)]).splitlines()
+        self.assertIn('# TYPE vadam_received_total counter', lines)
+        self.assertIn('vadam_received_total{node="3"} 2', lines)
+        self.assertIn('vadam_size{node="3"} 7', lines)
+        self.assertIn('vadam_seconds_bucket{node="3",handler="on_block",le="0.1"} 2', lines)
+        self.assertIn('vadam_seconds_bucket{node="3",handler="on_block",le="+Inf"} 4', lines)
+        self.assertIn('vadam_seconds_count{node="3",handler="on_block"} 4', lines)
+        with self.assertRaises(ValueError):
+            registry.gauge('received_total', 'Received')
+
+    def test_timed_coroutine(self):
+        histogram = MetricsRegistry().histogram('seconds', 'Seconds')
+
+        async def handler(value):
+            return value
+
+        self.assertEqual(asyncio.run(timed(histogram, handler)(5)), 5)
+        self.assertEqual(timed(histogram, len)('abc'), 3)
+        self.assertEqual(histogram.count, 2)
+
+
+class TestProfiling(unittest.TestCase):
+    def test_call_profiler(self):
+        profiler = CallProfiler()
+
+        async def handler(value):
+            await asyncio.sleep(0.01)
+            return value
+
+        self.assertEqual(asyncio.run(profiler.wrap('handler', handler)(5)), 5)
+        self.assertEqual(profiler.wrap('len', len)('abc'), 3)
+        self.assertEqual(asyncio.run(profiler.wrap('lazy', lambda: handler(6))()), 6)
+        report = {view['name']: view for view in profiler.report()}
+        self.assertEqual(report['handler']['calls'], 1)
+        self.assertGreaterEqual(report['handler']['wall'], 0.01)
+        # the sleep is wall time, not CPU time
+        self.assertLess(report['handler']['cpu'], report['handler']['wall'])
+        self.assertEqual(report['lazy']['calls'], 1)
+        self.assertEqual((task_name('complete_block 12'), task_name('mine_block')), ('complete_block', 'mine_block'))
+
+    def test_sampler(self):
+        sampler = SamplingProfiler(interval=0.001)
+        self.assertTrue(sampler.start())
+        self.assertFalse(sampler.start())
+        deadline = time.time() + 0.05
+        while time.time() < deadline:
+            sum(range(1000))
+        self.assertTrue(sampler.stop())
+        self.assertGreater(sampler.samples, 0)
+        stack, count = sampler.collapsed().splitlines()[0].rsplit(' ', 1)
+        self.assertIn('test_sampler (unittests.py:', stack)
+        self.assertGreater(int(count), 0)
+
+
+class TestPeerIndex(unittest.TestCase):
+    def test_peer_index(self):
+        asyncio.run(self.async_test_peer_index())
+
+    async def async_test_peer_index(self):
+        nodes = [MockIPv8("curve25519", Blockchain) for _ in range(3)]
+        overlay, first, second = nodes[0].overlay, nodes[1].my_peer, nodes[2].my_peer
+        overlay.connections = [(2, 9092), (1, 9091)]
+        overlay.set_node(1, first)
+        overlay.set_node(2, second)
+        self.assertEqual(overlay.node_id_from_peer(second), 2)
+        # neighbours follow the topology, not the order they connected in
+        self.assertEqual([node_id for node_id, _ in overlay.neighbours], [2, 1])
+        self.assertEqual(overlay.other_neighbours(second), [(1, first)])
+
+        overlay.remove_node(1)
+        self.assertIsNone(overlay.node_id_from_peer(first))
+        self.assertEqual(overlay.other_neighbours(second), [])
+        for node in nodes:
+            await node.stop()
+
+
+class TestLogging(unittest.TestCase):
+    def make_record(self, **extra):
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'tx %s', (7,), None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_sampling(self):
+        sampler = SamplingFilter({'transaction': 3})
+        passed = [sampler.filter(self.make_record(event='transaction')) for _ in range(7)]
+        self.assertEqual(passed, [True, False, False, True, False, False, True])
+        self.assertTrue(all(sampler.filter(self.make_record()) for _ in range(3)))
+        # a record sampled by a worker process is not sampled again
+        self.assertTrue(sampler.filter(self.make_record(event='transaction', sampled=3)))
+
+    def test_node_logger(self):
+        logger = NodeLogger('test', 4)
+        _, kwargs = logger.process('tx', {'extra': {'event': 'transaction'}})
+        self.assertEqual(kwargs['extra'], {'node': 4, 'event': 'transaction'})
+        entry = json.loads(JsonFormatter().format(self.make_record(**kwargs['extra'])))
+        self.assertEqual((entry['message'], entry['node'], entry['event']), ('tx 7', 4, 'transaction'))
+
+
+class TestTopology(unittest.TestCase):
+    def test_build_topology(self):
+        for kind in TOPOLOGIES:
+            topology = build_topology(kind, 10, seed=1)
+            self.assertEqual(topology, build_topology(kind, 10, seed=1))
+            for i, connections in enumerate(topology):
+                self.assertNotIn(i, connections)
+                self.assertTrue(all(i in topology[j] for j in connections))
+        self.assertTrue(all(len(c) == 2 for c in build_topology('ring', 10, seed=1)))
+
+    def test_families(self):
+        for family in FAMILIES:
+            topology = generate(family, 200, 4, seed=3)
+            self.assertEqual(topology, generate(family, 200, 4, seed=3))
+            self.assertTrue(is_connected(topology))
+            for i, connections in enumerate(topology):
+                self.assertNotIn(i, connections)
+                self.assertTrue(all(i in topology[j] for j in connections))
+        self.assertTrue(all(len(c) == 4 for c in generate('random-regular', 200, 4, seed=3)))
+        self.assertTrue(all(len(c) >= 5 for c in generate('ring-chords', 9, 5, seed=3)))
+        # dense graphs are built from their complement
+        self.assertTrue(all(len(c) == 8 for c in generate('random-regular', 10, 8, seed=3)))
+        with self.assertRaises(ValueError):
+            generate('random-regular', 9, 3)
+        with self.assertRaisesRegex(ValueError, 'between 1 and 9'):
+            generate('scale-free', 10, 0)
+
+    def test_diameter(self):
+        self.assertEqual(estimate_diameter(generate('ring', 10)), 5)
+        self.assertFalse(is_connected([[1], [0], [3], [2]]))
+        self.assertIsNone(describe([[1], [0], [3], [2]])['diameter'])
+
+    def test_save_load(self):
+        topology = generate('scale-free', 100, 2, seed=3)
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ('topology.yaml', 'topology.bin'):
+                save(topology, os.path.join(directory, name))
+                self.assertEqual(load(os.path.join(directory, name)), topology)
+
+
+class TestBlockStore(unittest.TestCase):
+    def test_restart(self):
+        asyncio.run(self.async_test_restart())
+
+    async def async_test_restart(self):
+        txs = [Transaction(sender=1, receiver=2, is_uniswap=False, coin='BTC', amount=5, public_key_bin=b'key',
+                           signature=b'', tx_id=str(nonce), nonce=nonce) for nonce in range(1, 4)]
+        blocks, prev_block_hash = [], GENESIS_HASH
+        for number, tx in enumerate(txs, 1):
+            blocks.append(Block(number, number - 1, prev_block_hash, target_to_bits(2 ** 255), [tx], number,
+                                f'{number:064x}', 0))
+            prev_block_hash = blocks[-1].hash
+
+        with tempfile.TemporaryDirectory() as path:
+            ipv8 = MockIPv8("curve25519", BlockchainNode)
+            node = ipv8.overlay
+            node.node_id = 0
+            node.open_store(path)
+            for block in blocks:
+                node.store.set_chain(node.store.height, [block])
+                node.ledger.apply_block(block)
+                node.nonces.confirm(block)
+                if block.number == 2:
+                    node.save_snapshot()
+            await ipv8.stop()
+
+            ipv8 = MockIPv8("curve25519", BlockchainNode)
+            node = ipv8.overlay
+            node.node_id, node.restore_depth = 0, 1
+            node.open_store(path)
+            try:
+                self.assertEqual(node.block_tree.height, 3)
+                self.assertEqual(node.get_block_at(1).hash, blocks[0].hash)
+                self.assertEqual(node.ledger.balance(2, 'BTC'), 115 * UNIT)
+                # the snapshot does not list old transactions, their nonces reject a replay
+                self.assertNotIn('1', node.ledger.applied)
+                replay = Block(4, 3, blocks[-1].hash, target_to_bits(2 ** 255), [txs[0]], 4, f'{4:064x}', 0)
+                self.assertIn('expected 4', node.validator.check_state(replay))
+            finally:
+                await ipv8.stop()
+
+    def test_prune(self):
+        asyncio.run(self.async_test_prune())
+
+    async def async_test_prune(self):
+        with tempfile.TemporaryDirectory() as path:
+            ipv8 = MockIPv8("curve25519", BlockchainNode)
+            node = ipv8.overlay
+            node.node_id, node.restore_depth = 0, 2
+            node.retarget = Retarget(target_to_bits(2 ** 254))
+            node.open_store(path)
+            try:
+                mined = [await node.mine() for _ in range(5)]
+                # the tree keeps the newest blocks only, older ones are read from disk
+                self.assertLess(len(node.block_tree), 4)
+                self.assertEqual(node.block_tree.height, 5)
+                self.assertEqual([node.get_block_at(number).hash for number in range(1, 6)], mined)
+            finally:
+                await ipv8.stop()
+
+
+class TestMerkleTree(unittest.TestCase):
+    def setUp(self):
+        self.leaves = [hashlib.sha256(str(i).encode()).digest() for i in range(7)]
+        self.tree = MerkleTree(self.leaves)
+
+    def test_proof(self):
+        for i, leaf in enumerate(self.leaves):
+            self.assertTrue(verify_proof(leaf, self.tree.proof(i), self.tree.root))
+        self.assertFalse(verify_proof(self.leaves[1], self.tree.proof(0), self.tree.root))
+
+    def test_multiproof(self):
+        proof = self.tree.multiproof([0, 1, 5])
+        self.assertTrue(verify_multiproof({i: self.leaves[i] for i in (0, 1, 5)}, proof, self.tree.root))
+        self.assertFalse(verify_multiproof({0: self.leaves[0], 1: self.leaves[2], 5: self.leaves[5]}, proof, self.tree.root))
 
 
 # class TestBlockchainNode(unittest.TestCase):
@@ -3,6 +3,8 @@ import copy
 
 import yaml
 
+import topology
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         prog='Scale the docker-compose file',
@@ -12,6 +14,9 @@ if __name__ == '__main__':
     parser.add_argument('topology_file', type=str, nargs='?', default='topologies/ring.yaml')
     parser.add_argument('algorithm', type=str, nargs='?', default='echo')
     parser.add_argument('template_file', type=str, nargs='?', default='docker-compose.template.yml')
+    parser.add_argument('--family', choices=topology.FAMILIES, default='ring-chords')
+    parser.add_argument('--degree', type=int, default=4, help='use num_nodes - 1 for a full mesh')
+    parser.add_argument('--seed', type=int, default=42)
     args = parser.parse_args()
 
     with open(args.template_file, 'r') as f:
@@ -22,9 +27,7 @@ if __name__ == '__main__':
 
         nodes = {}
         baseport = 9090
-        connections = {}
 
-        # Create a ring topology
         for i in range(args.num_nodes):
             n = copy.deepcopy(node)
             n['ports'] = [f'{baseport + i}:{baseport + i}']
@@ -34,14 +37,13 @@ if __name__ == '__main__':
             n['environment']['ALGORITHM'] = args.algorithm
             nodes[f'node{i}'] = n
 
-            connections[i] = [j for j in range(args.num_nodes) if j != i]
-
         content['services'] = nodes
 
         with open('docker-compose.yml', 'w') as f2:
             yaml.safe_dump(content, f2)
             print(f'Output written to docker-compose.yml')
 
-        with open(args.topology_file, 'w') as f3:
-            yaml.safe_dump(connections, f3)
-            print(f'Output written to {args.topology_file}')
+        # written node by node, a .bin file name gives the compact binary format
+        connections = topology.generate(args.family, args.num_nodes, min(args.degree, args.num_nodes - 1), args.seed)
+        topology.save(connections, args.topology_file)
+        print(f'Output written to {args.topology_file}: {topology.describe(connections)}')
@@ -0,0 +1,168 @@
+import asyncio
+import hashlib
+import time
+from typing import List, Optional, Tuple
+
+from block_tree import GENESIS_HASH
+from difficulty import MAX_TARGET, target_to_bits
+
+# seconds a block's time may be ahead of our clock
+MAX_FUTURE_TIME = 60
+
+
+class BlockValidator:
+    """
+    Checks a received block in stages, cheapest first, and stops at the first failure:
+
+    1. header: the hash is the miner's proof of work and stays below the block's target, and the
+       block's time is not more than ``MAX_FUTURE_TIME`` ahead of our clock
+    2. parent: the block extends a known block, is newer than the median time of the blocks before
+       it and uses the target that block's chain asks for
+    3. Merkle root and transaction ids, no transaction twice
+    4. balances, account owners and replays against the ledger and every sender's nonces, which have
+       to follow the sender's last nonce on the chain without gaps, when the block extends our best tip
+    5. signatures, verified in parallel on the verifier's worker pool and cached
+
+    Blocks whose parent is unknown pass stages 1, 3 and 5 only and fork blocks skip stage 4, the node
+    runs ``check_connected`` on them when they join the longest chain.
+    """
+
+    def __init__(self, node) -> None:
+        self.node = node
+        self.rejected = 0
+
+    async def validate(self, block) -> Optional[str]:
+        """
+        Return why ``block`` is invalid, or None if it passed every stage.
+        """
+        reason = self.check_header(block) or self.check_parent(block) or self.check_transactions(block)
+        if reason is None and block.prev_block_hash == self.node.ledger.tip_hash:
+            reason = self.check_state(block)
+        if reason is None:
+            # leave the event loop to other messages before the expensive part
+            await asyncio.sleep(0)
+            reason = await self.check_signatures(block)
+        if reason is not None:
+            self.rejected += 1
+        return reason
+
+    def check_header(self, block) -> Optional[str]:
+        target = block.get_target()
+        if not 0 < target <= MAX_TARGET:
+            return f'invalid target bits {block.bits:#x}'
+        if block.time > time.time() + MAX_FUTURE_TIME:
+            return f'block {block.number} is dated {block.time - time.time():.0f}s in the future'
+        digest = hashlib.sha256(block.get_hashing_value(block.miner).encode()).hexdigest()
+        if digest != block.hash:
+            return 'hash does not match the header'
+        if int(digest, 16) >= target:
+            return 'hash does not meet the target'
+        return None
+
+    def check_parent(self, block) -> Optional[str]:
+        if block.prev_block_hash == GENESIS_HASH:
+            if block.number != 1:
+                return f'block {block.number} claims to follow the genesis'
+            window = []
+        else:
+            parent = self.node.block_tree.nodes.get(block.prev_block_hash)
+            if parent is None:
+                # orphan, checked again once the parent shows up
+                return None
+            if block.number != parent.block.number + 1:
+                return f'block {block.number} does not follow block {parent.block.number}'
+            if block.prev_block_time != parent.block.time:
+                return f'block {block.number} has the wrong parent time {block.prev_block_time}'
+            median = self.node.block_tree.median_time(parent.hash)
+            if block.time <= median:
+                return f'block {block.number} is dated {block.time}, not after the median time {median}'
+            window = self.retarget_window(parent)
+            if window is None:
+                return None
+        expected = target_to_bits(self.node.retarget.target_after(window))
+        if block.bits != expected:
+            return f'block {block.number} has target bits {block.bits:#x}, expected {expected:#x}'
+        return None
+
+    def retarget_window(self, parent) -> Optional[list]:
+        """
+        (time, target) of the blocks up to ``parent`` the retarget window covers, or None if part of
+        the window is older than the blocks kept in memory.
+        """
+        size = self.node.retarget.window
+        blocks = []
+        node = parent
+        while node is not None and len(blocks) < size:
+            blocks.append(node.block)
+            node = node.parent
+        if len(blocks) < size and blocks[-1].prev_block_hash != GENESIS_HASH:
+            return None
+        return [(block.time, block.get_target()) for block in reversed(blocks)]
+
+    def check_transactions(self, block) -> Optional[str]:
+        seen = set()
+        for tx in block.transactions:
+            if tx.tx_id in seen:
+                return f'transaction {tx.tx_id} appears twice'
+            if tx.tx_id != tx.compute_tx_id():
+                return f'transaction {tx.tx_id} does not match its content'
+            seen.add(tx.tx_id)
+        if block.merkle_root != block.get_merkle_tree().root:
+            return 'merkle root does not match the transactions'
+        return None
+
+    def check_nonces(self, block) -> Optional[str]:
+        expected = {}
+        for tx in block.transactions:
+            nonce = expected.get(tx.public_key_bin)
+            if nonce is None:
+                nonce = self.node.nonces.next_confirmed(tx.public_key_bin)
+            if tx.nonce != nonce:
+                return f'transaction {tx.tx_id} has nonce {tx.nonce}, expected {nonce}'
+            expected[tx.public_key_bin] = nonce + 1
+        return None
+
+    def select(self, transactions) -> Tuple[List, List]:
+        """
+        Split ``transactions`` into the ones a block on top of our tip can hold, in order, and the ones that
+        can never get into the chain from here: stale nonces, replays, malformed ones and overspends. A
+        sender's transactions after a nonce gap or an invalid one are in neither list, they have to wait.
+        """
+        selected, invalid = [], []
+        scratch, expected, blocked = {}, {}, set()
+        for tx in transactions:
+            key = tx.public_key_bin
+            if key in blocked:
+                continue
+            nonce = expected.get(key)
+            if nonce is None:
+                nonce = self.node.nonces.next_confirmed(key)
+            if tx.nonce != nonce or self.node.ledger.check_transaction(tx, scratch) is not None:
+                if tx.nonce <= nonce:
+                    invalid.append(tx)
+                blocked.add(key)
+                continue
+            expected[key] = nonce + 1
+            selected.append(tx)
+        return selected, invalid
+
+    def check_state(self, block) -> Optional[str]:
+        """
+        Check every transaction of ``block`` against the ledger and the nonces, both have to be at its parent.
+        """
+        return self.node.ledger.check_block(block) or self.check_nonces(block)
+
+    def check_connected(self, block) -> Optional[str]:
+        """
+        Check a block that joins the longest chain, for fork blocks and orphans this is the first time
+        their state, and for orphans their parent, is known. The ledger and the nonces have to be at its parent.
+        """
+        return self.check_parent(block) or self.check_state(block)
+
+    async def check_signatures(self, block) -> Optional[str]:
+        results = await self.node.verifier.verify_many(
+            [(tx.public_key_bin, tx.get_signing_bytes(), tx.signature) for tx in block.transactions])
+        for tx, valid in zip(block.transactions, results):
+            if not valid:
+                return f'transaction {tx.tx_id} has an invalid signature'
+        return None
@@ -0,0 +1,111 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, List, Sequence, Tuple
+
+_executors: Dict[int, ThreadPoolExecutor] = {}
+
+
+class SignatureVerifier:
+    """
+    Verifies signatures in batches on a worker pool and remembers what it already verified.
+
+    Parsed public keys are kept in an LRU keyed by ``public_key_bin`` and every valid
+    (message, signature) pair is remembered, so a transaction that shows up again in a block is not verified twice.
+    Requests made in the same event loop iteration are handed to the pool as one batch.
+    """
+
+    def __init__(self, crypto, key_cache_size: int = 1024, verified_cache_size: int = 100_000,
+                 batch_size: int = 64, workers: int = 2) -> None:
+        self.crypto = crypto
+        self.key_from_public_bin = lru_cache(maxsize=key_cache_size)(crypto.key_from_public_bin)
+        self.verified_cache_size = verified_cache_size
+        self.verified: Dict[bytes, None] = OrderedDict()
+        self.batch_size = batch_size
+        self.workers = workers
+        self.cache_hits = 0
+        self.verifications = 0
+        self._queue: List[Tuple[bytes, bytes, bytes, bytes]] = []
+        self._in_flight: Dict[bytes, asyncio.Future] = {}
+
+    @staticmethod
+    def digest(data: bytes, signature: bytes) -> bytes:
+        return hashlib.sha256(data + signature).digest()
+
+    def executor(self) -> ThreadPoolExecutor:
+        if self.workers not in _executors:
+            _executors[self.workers] = ThreadPoolExecutor(max_workers=self.workers,
+                                                          thread_name_prefix='signature-verifier')
+        return _executors[self.workers]
+
+    def is_valid(self, public_key_bin: bytes, data: bytes, signature: bytes) -> bool:
+        try:
+            public_key = self.key_from_public_bin(public_key_bin)
+            return bool(self.crypto.is_valid_signature(public_key, data, signature))
+        except Exception:
+            return False
+
+    def verify_now(self, public_key_bin: bytes, data: bytes, signature: bytes) -> bool:
+        """
+        Verify on the calling thread, still using and filling the caches.
+        """
+        digest = self.digest(data, signature)
+        if self._cached(digest):
+            return True
+        valid = self.is_valid(public_key_bin, data, signature)
+        self._done(digest, valid)
+        return valid
+
+    async def verify(self, public_key_bin: bytes, data: bytes, signature: bytes) -> bool:
+        digest = self.digest(data, signature)
+        if self._cached(digest):
+            return True
+        future = self._in_flight.get(digest)
+        if future is None:
+            future = self._in_flight[digest] = asyncio.get_running_loop().create_future()
+            self._queue.append((digest, public_key_bin, data, signature))
+            if len(self._queue) >= self.batch_size:
+                self._flush()
+            elif len(self._queue) == 1:
+                asyncio.get_running_loop().call_soon(self._flush)
+        return await asyncio.shield(future)
+
+    async def verify_many(self, items: Sequence[Tuple[bytes, bytes, bytes]]) -> List[bool]:
+        """
+        Verify (public_key_bin, data, signature) triples, they end up in as few batches as possible.
+        """
+        return list(await asyncio.gather(*(self.verify(*item) for item in items)))
+
+    def _cached(self, digest: bytes) -> bool:
+        if digest in self.verified:
+            self.verified.move_to_end(digest)
+            self.cache_hits += 1
+            return True
+        return False
+
+    def _done(self, digest: bytes, valid: bool) -> None:
+        self.verifications += 1
+        if valid:
+            self.verified[digest] = None
+            while len(self.verified) > self.verified_cache_size:
+                self.verified.popitem(last=False)
+
+    def _flush(self) -> None:
+        if not self._queue:
+            return
+        batch, self._queue = self._queue, []
+        future = asyncio.wrap_future(self.executor().submit(self._verify_batch, batch))
+        future.add_done_callback(lambda f: self._resolve(batch, f))
+
+    def _verify_batch(self, batch: List[Tuple[bytes, bytes, bytes, bytes]]) -> List[bool]:
+        return [self.is_valid(public_key_bin, data, signature) for _, public_key_bin, data, signature in batch]
+
+    def _resolve(self, batch: List[Tuple[bytes, bytes, bytes, bytes]], result: asyncio.Future) -> None:
+        results = result.result() if not result.cancelled() and result.exception() is None else [False] * len(batch)
+        for (digest, _, _, _), valid in zip(batch, results):
+            self._done(digest, valid)
+            future = self._in_flight.pop(digest, None)
+            if future is not None and not future.done():
+                future.set_result(valid)
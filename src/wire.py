@@ -0,0 +1,327 @@
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set
+
+from block_tree import GENESIS_HASH
+from merkle_util import HASH_SIZE
+
+# keys are referenced by the first bytes of their sha256 once the peer knows them
+KEY_HASH_SIZE = 8
+# key references: a full key, the hash of a key the receiver knows, or 2 + the index of a key used earlier
+# in the same message
+KEY_FULL = 0
+KEY_HASH = 1
+KEY_INDEX = 2
+
+
+class UnknownKeyError(ValueError):
+    """
+    A message references public keys by a hash we do not have the key for.
+    """
+
+    def __init__(self, key_hashes: List[bytes]) -> None:
+        super().__init__(f'{len(key_hashes)} unknown key references')
+        self.key_hashes = key_hashes
+
+
+def key_hash(public_key_bin: bytes) -> bytes:
+    return hashlib.sha256(public_key_bin).digest()[:KEY_HASH_SIZE]
+
+
+def hash_to_bytes(value: str) -> bytes:
+    # the genesis hash is not a sha256, it travels as 32 zero bytes
+    return bytes(HASH_SIZE) if value == GENESIS_HASH else bytes.fromhex(value)
+
+
+def bytes_to_hash(value: bytes) -> str:
+    return GENESIS_HASH if value == bytes(HASH_SIZE) else value.hex()
+
+
+def write_uint(out: bytearray, value: int) -> None:
+    if value < 0:
+        raise ValueError(f'cannot encode {value} as an unsigned varint')
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def write_int(out: bytearray, value: int) -> None:
+    # zigzag, small negative numbers stay short
+    write_uint(out, value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def write_bytes(out: bytearray, value: bytes) -> None:
+    write_uint(out, len(value))
+    out.extend(value)
+
+
+def encode_transaction_fields(tx) -> bytes:
+    """
+    The fields of a transaction that its signature covers, besides its public key.
+    The tx_id is left out, it is a hash of these fields, the key and the signature.
+    """
+    out = bytearray()
+    out.append(1 if tx.is_uniswap else 0)
+    write_int(out, tx.sender)
+    write_int(out, tx.receiver)
+    write_int(out, tx.amount)
+    write_int(out, tx.nonce)
+    write_int(out, tx.fee)
+    write_bytes(out, tx.coin.encode())
+    return bytes(out)
+
+
+def transaction_size(tx) -> int:
+    """
+    Upper bound of the encoded size of a transaction, with its full key.
+    """
+    return len(tx.get_encoded_fields()) + len(tx.public_key_bin) + len(tx.signature) + 8
+
+
+def encode_header(block) -> bytes:
+    out = bytearray()
+    write_uint(out, block.number)
+    write_int(out, block.prev_block_time)
+    out.extend(hash_to_bytes(block.prev_block_hash))
+    write_uint(out, block.bits)
+    write_int(out, block.time)
+    out.extend(hash_to_bytes(block.hash))
+    write_uint(out, block.nonce)
+    write_bytes(out, block.merkle_root)
+    return bytes(out)
+
+
+def block_size(block) -> int:
+    """
+    Upper bound of the encoded size of a block, with full keys.
+    """
+    return len(block.get_encoded_header()) + len(block.miner) + 8 + sum(map(transaction_size, block.transactions))
+
+
+class WireCodec:
+    """
+    Compact encoding of transactions and blocks: varint integers, raw 32-byte hashes and public keys
+    sent at most once per message.
+
+    A key the peer is known to have, because it sent it to us or we sent it to the peer, is replaced by
+    an 8-byte hash. The keys of all peers are kept in one LRU of ``max_keys`` entries and the keys every
+    peer knows in a set that is cleared when it grows past ``max_keys``. A receiver that evicted a key
+    raises ``UnknownKeyError`` and reports the hashes with a MissingKeys message, after which the keys
+    are sent in full to it again.
+    """
+
+    def __init__(self, transaction_cls, block_cls, max_keys: int = 10_000) -> None:
+        self.transaction_cls = transaction_cls
+        self.block_cls = block_cls
+        self.max_keys = max_keys
+        self.keys: Dict[bytes, bytes] = OrderedDict()
+        self.peer_keys: Dict[bytes, Set[bytes]] = {}
+
+    def learn(self, public_key_bin: bytes) -> bytes:
+        digest = key_hash(public_key_bin)
+        if digest in self.keys:
+            self.keys.move_to_end(digest)
+        else:
+            self.keys[digest] = public_key_bin
+            while len(self.keys) > self.max_keys:
+                self.keys.popitem(last=False)
+        return digest
+
+    def lookup(self, digest: bytes) -> Optional[bytes]:
+        public_key_bin = self.keys.get(digest)
+        if public_key_bin is not None:
+            self.keys.move_to_end(digest)
+        return public_key_bin
+
+    def known_by(self, peer) -> Set[bytes]:
+        known = self.peer_keys.setdefault(peer.mid, set())
+        if len(known) > self.max_keys:
+            known.clear()
+        return known
+
+    def forget(self, peer, key_hashes: List[bytes]) -> None:
+        self.known_by(peer).difference_update(key_hashes)
+
+    def writer(self, peer) -> 'WireWriter':
+        return WireWriter(self, peer)
+
+    def reader(self, peer, data: bytes) -> 'WireReader':
+        return WireReader(self, peer, data)
+
+    def encode_transactions(self, peer, transactions) -> bytes:
+        writer = self.writer(peer)
+        for tx in transactions:
+            writer.add_transaction(tx)
+        return writer.getvalue()
+
+    def decode_transactions(self, peer, data: bytes) -> List:
+        reader = self.reader(peer, data)
+        transactions = []
+        while not reader.at_end():
+            transactions.append(reader.read_transaction())
+        reader.finish()
+        return transactions
+
+    def decode_header(self, peer, data: bytes):
+        reader = self.reader(peer, data)
+        block = reader.read_header()
+        reader.finish()
+        return block
+
+    def encode_blocks(self, peer, blocks) -> bytes:
+        writer = self.writer(peer)
+        for block in blocks:
+            writer.add_block(block)
+        return writer.getvalue()
+
+    def decode_blocks(self, peer, data: bytes) -> List:
+        reader = self.reader(peer, data)
+        blocks = []
+        while not reader.at_end():
+            blocks.append(reader.read_block())
+        reader.finish()
+        return blocks
+
+
+class WireWriter:
+    def __init__(self, codec: WireCodec, peer) -> None:
+        self.codec = codec
+        self.known = codec.known_by(peer)
+        self.indexes: Dict[bytes, int] = {}
+        self.out = bytearray()
+
+    def __len__(self) -> int:
+        return len(self.out)
+
+    def getvalue(self) -> bytes:
+        return bytes(self.out)
+
+    def add_key(self, public_key_bin: bytes) -> None:
+        index = self.indexes.get(public_key_bin)
+        if index is not None:
+            write_uint(self.out, KEY_INDEX + index)
+            return
+        self.indexes[public_key_bin] = len(self.indexes)
+        digest = self.codec.learn(public_key_bin)
+        if digest in self.known:
+            write_uint(self.out, KEY_HASH)
+            self.out.extend(digest)
+        else:
+            write_uint(self.out, KEY_FULL)
+            write_bytes(self.out, public_key_bin)
+            self.known.add(digest)
+
+    def add_transaction(self, tx) -> None:
+        self.add_key(tx.public_key_bin)
+        self.out.extend(tx.get_encoded_fields())
+        write_bytes(self.out, tx.signature)
+        write_uint(self.out, tx.ttl)
+
+    def add_header(self, block) -> None:
+        self.out.extend(block.get_encoded_header())
+        self.add_key(block.miner)
+
+    def add_block(self, block) -> None:
+        self.add_header(block)
+        write_uint(self.out, len(block.transactions))
+        for tx in block.transactions:
+            self.add_transaction(tx)
+
+
+class WireReader:
+    def __init__(self, codec: WireCodec, peer, data: bytes) -> None:
+        self.codec = codec
+        self.known = codec.known_by(peer)
+        self.data = data
+        self.offset = 0
+        self.keys: List[bytes] = []
+        self.missing: List[bytes] = []
+
+    def at_end(self) -> bool:
+        return self.offset >= len(self.data)
+
+    def finish(self) -> None:
+        if self.missing:
+            raise UnknownKeyError(self.missing)
+
+    def read(self, size: int) -> bytes:
+        end = self.offset + size
+        if end > len(self.data):
+            raise ValueError('truncated message')
+        value, self.offset = self.data[self.offset:end], end
+        return value
+
+    def read_uint(self) -> int:
+        value = shift = 0
+        while True:
+            if self.offset >= len(self.data):
+                raise ValueError('truncated varint')
+            byte = self.data[self.offset]
+            self.offset += 1
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+            if shift > 256:
+                raise ValueError('varint too long')
+
+    def read_int(self) -> int:
+        value = self.read_uint()
+        return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+    def read_bytes(self) -> bytes:
+        return self.read(self.read_uint())
+
+    def read_key(self) -> bytes:
+        tag = self.read_uint()
+        if tag >= KEY_INDEX:
+            if tag - KEY_INDEX >= len(self.keys):
+                raise ValueError(f'key index {tag - KEY_INDEX} out of range')
+            return self.keys[tag - KEY_INDEX]
+        if tag == KEY_FULL:
+            public_key_bin = self.read_bytes()
+            digest = self.codec.learn(public_key_bin)
+        else:
+            digest = self.read(KEY_HASH_SIZE)
+            public_key_bin = self.codec.lookup(digest)
+            if public_key_bin is None:
+                # keep parsing, the whole message is dropped by finish
+                self.missing.append(digest)
+                public_key_bin = b''
+        self.known.add(digest)
+        self.keys.append(public_key_bin)
+        return public_key_bin
+
+    def read_transaction(self):
+        public_key_bin = self.read_key()
+        is_uniswap = self.read(1) != b'\x00'
+        sender, receiver, amount, nonce, fee = (self.read_int() for _ in range(5))
+        coin = self.read_bytes().decode()
+        signature = self.read_bytes()
+        ttl = self.read_uint()
+        tx = self.codec.transaction_cls(sender, receiver, is_uniswap, coin, amount, public_key_bin, signature,
+                                        '', nonce, fee, ttl)
+        tx.tx_id = tx.compute_tx_id()
+        return tx
+
+    def read_header(self):
+        number = self.read_uint()
+        prev_block_time = self.read_int()
+        prev_block_hash = bytes_to_hash(self.read(HASH_SIZE))
+        bits = self.read_uint()
+        block_time = self.read_int()
+        block_hash = bytes_to_hash(self.read(HASH_SIZE))
+        nonce = self.read_uint()
+        merkle_root = self.read_bytes()
+        miner = self.read_key()
+        return self.codec.block_cls(number, prev_block_time, prev_block_hash, bits, [], block_time, block_hash,
+                                    nonce, merkle_root, miner)
+
+    def read_block(self):
+        block = self.read_header()
+        count = self.read_uint()
+        if count > len(self.data) - self.offset:
+            raise ValueError(f'block claims {count} transactions')
+        block.transactions = [self.read_transaction() for _ in range(count)]
+        return block